@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Garrett Reynolds
+"""
+
+import numpy as np
+from graph import UidIndex, _as_uid_array
+from components import (label_components, _GrowableArray, _compress,
+                        _find, _union)
+from infections import evaluate_split
+
+# arm of a component which has users in both groups
+SPLIT = -1
+
+
+class Assignment:
+    '''Which group every user is in after a limited infection, kept up to
+    date as users sign up between runs.
+
+    It holds the component of every user, the arm of every component
+    (infected, not infected, or SPLIT between them) and the group of every
+    user, which is what says how split components were partitioned.  Save
+    it after a run (run.py --assignment), load it in the service which
+    signs users up, and add_user puts each new user in a group straight
+    away: the group most of their coaches and students are in, merging
+    their components with union-find.  It takes a binary search (for users
+    of the run) or a dictionary lookup (for users added since) per user,
+    however many users there are.
+
+    The drift of the proportion infected from the target, and the number
+    of relationships added between groups, tell when the partition should
+    be redone from scratch (see needs_rerun).'''
+
+    def __init__(self, uids, labels, infected, target_ratio, cut=0,
+                 new_cut=0, num_new_users=0):
+        '''
+        INPUT:
+            > uids: sequence of user IDs, one per node
+            > labels: component label of every node
+            > infected: boolean array telling which nodes are infected
+            > target_ratio: proportion of users meant to be infected
+            > cut: number of relationships between groups after the run
+            > new_cut: number of relationships between groups added since
+            > num_new_users: number of users added since the run'''
+        self._base_uids = _as_uid_array(uids)
+        self._uid_index = UidIndex(self._base_uids)
+        # users added since the index of base uids was made
+        self._new_uids = []
+        self._new_nodes = {}
+        labels = np.asarray(labels, dtype=np.int64)
+        infected = np.asarray(infected, dtype=bool)
+        self._node_comps = _GrowableArray(labels)
+        self._infected = _GrowableArray(infected)
+        num_comps = labels.max() + 1 if len(labels) else 0
+        self._parents = _GrowableArray(np.arange(num_comps, dtype=np.int64))
+        self._comp_arms = _GrowableArray(_comp_arms(labels, infected,
+                                                    num_comps))
+        self.target_ratio = target_ratio
+        self.cut = cut
+        self.new_cut = new_cut
+        self.num_new_users = num_new_users
+        self.num_infected = int(infected.sum())
+
+    @classmethod
+    def build(cls, graph, infected_uids, num_to_infect, workers=1):
+        '''Assignment of the users of a Graph after limited_infection
+
+        INPUT:
+            > graph: the Graph which was split
+            > infected_uids: set of uids of the infected users
+            > num_to_infect: number (or proportion, if it's a float) of
+                             users which were to be infected
+            > workers: number of processes to label components with
+
+        RETURN:
+            > an Assignment'''
+        labels, _ = label_components(graph, workers)
+        infected = graph.get_uid_index().mask_of(list(infected_uids))
+        if not isinstance(num_to_infect, float):
+            num_to_infect = num_to_infect / float(max(len(graph), 1))
+        return cls(graph.uids, labels, infected, num_to_infect,
+                   evaluate_split(graph, infected)[0])
+
+    @classmethod
+    def load(cls, filename):
+        '''Load an assignment saved with save()'''
+        with np.load(filename, allow_pickle=True) as data:
+            return cls(data['uids'], data['labels'], data['infected'],
+                       float(data['target_ratio']), int(data['cut']),
+                       int(data['new_cut']), int(data['num_new_users']))
+
+    def save(self, filename):
+        '''Save the assignment to filename (a NumPy .npz file)'''
+        labels, comp_arms = self.components()
+        with open(filename, 'wb') as file:
+            np.savez(file, uids=self.uids, labels=labels,
+                     comp_arms=comp_arms,
+                     infected=self._infected.view().astype(bool),
+                     target_ratio=self.target_ratio, cut=self.cut,
+                     new_cut=self.new_cut,
+                     num_new_users=self.num_new_users)
+
+    @property
+    def uids(self):
+        '''array of user IDs in node order'''
+        if not self._new_uids:
+            return self._base_uids
+        return _as_uid_array(self._base_uids.tolist() + self._new_uids)
+
+    def __len__(self):
+        return len(self._infected)
+
+    def __contains__(self, uid):
+        return uid in self._new_nodes or uid in self._uid_index
+
+    def components(self):
+        '''Current components of the users
+
+        RETURN:
+            > labels: array with the component number (0, 1, ...) of every
+                      node, in the order of uids
+            > comp_arms: array with 1 for every component which is
+                         infected, 0 for those which aren't and SPLIT for
+                         those in both groups'''
+        parents = self._parents.view()
+        _compress(parents)
+        roots, labels = np.unique(parents[self._node_comps.view()],
+                                  return_inverse=True)
+        return labels, self._comp_arms.view()[roots]
+
+    def arm_of(self, uid):
+        '''True if the user with the given uid is infected'''
+        return bool(self._infected[self._node_of(uid)])
+
+    def component_of(self, uid):
+        '''label of the component of the user with the given uid (which
+        stays the same until that component is merged with another)'''
+        return self._find(self._node_comps[self._node_of(uid)])
+
+    def arm_of_component(self, comp):
+        '''1 if component comp is infected, 0 if it isn't, or SPLIT'''
+        return int(self._comp_arms[self._find(comp)])
+
+    def add_user(self, uid, coaches=(), students=()):
+        '''Put a new user in a group
+
+        The user joins the group most of their coaches and students are in,
+        or if that's a tie (e.g. they have none), the group which keeps the
+        proportion infected closest to the target.
+
+        INPUT:
+            > uid: user ID of the new user
+            > coaches, students: uids of the user's coaches and students,
+                                 who must already have a group
+
+        RETURN:
+            > True if the new user is infected'''
+        if uid in self:
+            raise RuntimeError("You tried to create more than one user with "
+                               "uid:", uid, ". uids must be unique!")
+        neighbors = [self._node_of(neighbor) for neighbor
+                     in list(coaches) + list(students)]
+        num_infected = sum(self._infected[node] for node in neighbors)
+        num_uninfected = len(neighbors) - num_infected
+        if num_infected != num_uninfected:
+            infected = bool(num_infected > num_uninfected)
+        else:
+            infected = self.num_infected + 0.5 < \
+                self.target_ratio * (len(self) + 1)
+
+        node = len(self)
+        self._new_nodes[uid] = node
+        self._new_uids.append(uid)
+        self._infected.append(infected)
+        self._parents.append(len(self._parents))
+        self._comp_arms.append(int(infected))
+        self._node_comps.append(len(self._parents) - 1)
+        self.num_infected += int(infected)
+        self.num_new_users += 1
+        for neighbor in neighbors:
+            self._join(node, neighbor)
+        return infected
+
+    def add_relationship(self, coach, student):
+        '''Record a new relationship between two users who already have a
+        group (neither of them changes group)'''
+        self._join(self._node_of(coach), self._node_of(student))
+
+    def ratio(self):
+        '''proportion of users infected'''
+        return self.num_infected / float(max(len(self), 1))
+
+    def drift(self):
+        '''how far the proportion infected is above the target (below, if
+        it's negative)'''
+        return self.ratio() - self.target_ratio
+
+    def needs_rerun(self, max_drift=0.01, max_new_cut=None):
+        '''True if the partition should be redone: the proportion infected
+        has drifted more than max_drift from the target, or more than
+        max_new_cut relationships between groups were added (if given)'''
+        return abs(self.drift()) > max_drift or \
+            (max_new_cut is not None and self.new_cut > max_new_cut)
+
+    def _node_of(self, uid):
+        if uid in self._new_nodes:
+            return self._new_nodes[uid]
+        return self._uid_index.index_of(uid)
+
+    def _join(self, node, other):
+        '''add a relationship between two nodes'''
+        if self._infected[node] != self._infected[other]:
+            self.new_cut += 1
+        root, hooked = _union(self._parents, self._node_comps[node],
+                              self._node_comps[other])
+        if hooked is not None and \
+                self._comp_arms[root] != self._comp_arms[hooked]:
+            self._comp_arms[root] = SPLIT
+
+    def _find(self, comp):
+        return _find(self._parents, comp)
+
+
+def _comp_arms(labels, infected, num_comps):
+    '''arm of every component: 1 if all of its users are infected, 0 if
+    none are, else SPLIT'''
+    sizes = np.bincount(labels, minlength=num_comps)
+    num_infected = np.bincount(labels[infected], minlength=num_comps)
+    return np.where(num_infected == sizes, 1,
+                    np.where(num_infected == 0, 0, SPLIT)).astype(np.int64)
@@ -0,0 +1,655 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+@author: Garrett Reynolds
+"""
+
+from __future__ import print_function
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+from copy import deepcopy
+from time import time
+import numpy as np
+from user import User
+from graph import Graph
+from components import label_components
+from infections import (evaluate_split, _choose_components, _split_graph,
+                        _find_max_left_justified_subarray, _kernighan_lin,
+                        _uid_mask, PARTITIONERS)
+from save_load import (load_users, load_graph, save_graph, save_infected,
+                       _try_converting_to_int)
+
+
+def _scale_example(filename, copies, scaled_filename):
+    '''Write copies of the .csv file filename one after another, offsetting
+    the uids of each copy so they don't overlap.  The result has the same
+    shape (component sizes, number of students, etc.) but is copies times
+    larger.'''
+    with open(filename, 'r') as file:
+        lines = [[int(uid) for uid in line.split(',')]
+                 for line in file if line.strip()]
+    offset = max(max(line) for line in lines) + 1
+    with open(scaled_filename, 'w') as file:
+        for copy_i in range(copies):
+            shift = copy_i * offset
+            file.writelines(','.join(str(uid + shift) for uid in line) + '\n'
+                            for line in lines)
+
+
+def _load_users_two_pass(filename):
+    '''The original load_users, which reads the file twice and adds the
+    students one at a time.  Kept here as the baseline.'''
+    users = dict()
+    with open(filename, 'r') as file:
+        for line in file:
+            line = line.split('\n')[0]
+            split_line = line.split(',')
+            new_uid = _try_converting_to_int(split_line[0])
+            new_user = User(new_uid)
+            users.update({new_user.get_uid(): new_user})
+    with open(filename, 'r') as file:
+        for line in file:
+            line = line.split('\n')[0]
+            split_line = line.split(',')
+            current_uid = _try_converting_to_int(split_line[0])
+            for student_uid in split_line[1:]:
+                student_uid = _try_converting_to_int(student_uid)
+                users[current_uid].add_students(users[student_uid])
+    return set(users.values())
+
+
+def _kernighan_lin_sets(graph, infected, max_iter=10000):
+    '''_kernighan_lin on a Graph as it was before it was reworked around
+    arrays, which keeps the infected users in a set and recomputes every D
+    value and scans every pair of users for each swap.  The rework makes
+    the same swaps, which test.py checks against this.'''
+
+    # the weight of the connections of every node, for fast lookups
+    indptr = graph.indptr.tolist()
+    indices = graph.indices.tolist()
+    edge_weights = graph.get_edge_weights().tolist()
+    neighbor_weights = [dict(zip(indices[indptr[node]:indptr[node + 1]],
+                                 edge_weights[indptr[node]:indptr[node + 1]]))
+                        for node in range(len(graph))]
+
+    def _get_D_value(node, infected_set):
+        '''see the Wikipage Kernighan-Lin algorithm for the meaning of D'''
+        num_conn_infected = num_conn_uninfected = 0
+        for conn, weight in neighbor_weights[node].items():
+            if conn in infected_set:
+                num_conn_infected += weight
+            else:
+                num_conn_uninfected += weight
+        if node in infected_set:
+            return num_conn_uninfected - num_conn_infected
+        else:
+            return num_conn_infected - num_conn_uninfected
+
+    def _toggle_infected(nodes, infected_set):
+        '''toggle on/off the infected status of nodes in infected_set'''
+        for node in nodes:
+            if node in infected_set:
+                infected_set.remove(node)
+            else:
+                infected_set.update((node,))
+
+    infected_nodes = set(np.flatnonzero(infected).tolist())
+    remaining_to_infect = len(infected_nodes)
+    num_uninfected = len(graph) - remaining_to_infect
+    all_nodes = set(range(len(graph)))
+    d_values = np.zeros(len(graph), dtype=np.int64)
+
+    for _ in range(max_iter):
+
+        g_values = []
+        g_pairs = []
+        # the infected nodes for this round
+        temp_inf_nodes = deepcopy(infected_nodes)
+        # nodes that have already been moved during this round
+        completed_nodes = set()
+        for nn in range(min(remaining_to_infect, num_uninfected)):
+            for node in (all_nodes - completed_nodes):
+                d_values[node] = _get_D_value(node, temp_inf_nodes)
+            # find maximum g value
+            max_g_value = -1000000000
+            max_g_pair = (-1, -1)
+            for inf in sorted(temp_inf_nodes - completed_nodes):
+                for non_inf in sorted(all_nodes - temp_inf_nodes -
+                                      completed_nodes):
+                    g_value = d_values[inf] + d_values[non_inf] \
+                        - 2 * neighbor_weights[inf].get(non_inf, 0)
+                    if g_value > max_g_value:
+                        max_g_value = g_value
+                        max_g_pair = (inf, non_inf)
+            # end of find max g value
+            completed_nodes.update(max_g_pair)
+            g_pairs.append(max_g_pair)
+            g_values.append(max_g_value)
+            _toggle_infected(max_g_pair, temp_inf_nodes)
+        # end for
+
+        # now we find number which maximizes g_values subarray
+        subarray_length = _find_max_left_justified_subarray(g_values)
+        g_max = sum(g_values[:subarray_length])
+        if g_max <= 0:
+            break
+        for g_pair_i in range(subarray_length):
+            nodes_to_switch = g_pairs[g_pair_i]
+            _toggle_infected(nodes_to_switch, infected_nodes)
+
+    infected = np.zeros(len(graph), dtype=bool)
+    infected[list(infected_nodes)] = True
+    return infected
+
+
+def _split_component_original(users, infected_uids, max_iter=10000):
+    '''The Kernighan-Lin of the first version of infections.py, on User
+    objects, which benchmark_kl times as the baseline.  It's unchanged but
+    for starting from infected_uids rather than from the users which came
+    first out of a set.'''
+
+    users = set(users)
+
+    def _get_D_value(user, infected_set):
+        '''see the Wikipage Kernighan-Lin algorithm for the meaning of D'''
+        num_conn_infected = num_conn_uninfected = 0
+        for conn in (user.get_students() | user.get_coaches()):
+            if conn.get_uid() in infected_set:
+                num_conn_infected += 1
+            else:
+                num_conn_uninfected += 1
+        if user.get_uid() in infected_set:
+            return num_conn_uninfected - num_conn_infected
+        else:
+            return num_conn_infected - num_conn_uninfected
+
+    def _toggle_infected(uids, infected_set):
+        '''toggle on/off the infected status of uids in infected_set'''
+        for uid in uids:
+            if uid in infected_set:
+                infected_set.remove(uid)
+            else:
+                infected_set.update((uid,))
+
+    remaining_to_infect = len(infected_uids)
+    num_uninfected = len(users) - remaining_to_infect
+    infected_uids = set(infected_uids)
+    users_dict = {user.get_uid(): user for user in users}
+    all_uids = set(users_dict.keys())
+
+    for _ in range(max_iter):
+
+        g_values = []
+        g_pairs = []
+        # the infected UIDs for this round
+        temp_inf_uids = deepcopy(infected_uids)
+        # uids that have already been moved during this round
+        completed_uids = set()
+        for nn in range(min(remaining_to_infect, num_uninfected)):
+            for uid in (all_uids - completed_uids):
+                user = users_dict[uid]
+                user._d = _get_D_value(user, temp_inf_uids)
+            # find maximum g value
+            max_g_value = -1000000000
+            max_g_pair = (-1, -1)
+            for inf in temp_inf_uids - completed_uids:
+                for non_inf in (all_uids - temp_inf_uids - completed_uids):
+                    g_value = users_dict[inf]._d + users_dict[non_inf]._d \
+                        - 2 * (_are_connected(users_dict[inf],
+                                              users_dict[non_inf]))
+                    if g_value > max_g_value:
+                        max_g_value = g_value
+                        max_g_pair = (inf, non_inf)
+            # end of find max g value
+            completed_uids.update(max_g_pair)
+            g_pairs.append(max_g_pair)
+            g_values.append(max_g_value)
+            _toggle_infected(max_g_pair, temp_inf_uids)
+        # end for
+
+        # now we find number which maximizes g_values subarray
+        subarray_length = _find_max_left_justified_subarray(g_values)
+        g_max = sum(g_values[:subarray_length])
+        if g_max <= 0:
+            break
+        for g_pair_i in range(subarray_length):
+            uids_to_switch = g_pairs[g_pair_i]
+            _toggle_infected(uids_to_switch, infected_uids)
+
+    # end for (KL alogorithm main loop)
+    else:
+        print("WARNING: maximum number of iteration reached during KL "
+              "algorithm...")
+
+    for user in users:
+        del user._d
+
+    return infected_uids
+
+
+def _are_connected(user1, user2):
+    '''return true if the users have a connection'''
+    return user1 in (user2.get_students() | user2.get_coaches())
+
+
+def _users_of(graph):
+    '''User objects of the users of graph'''
+    User.clear_users()
+    users = [User(uid) for uid in graph.uids.tolist()]
+    for coach, user in enumerate(users):
+        user.add_students([users[student] for student
+                           in graph.students(coach).tolist()])
+    return users
+
+
+def benchmark_loaders(filename):
+    '''Time the original two pass loader, load_users and load_graph on
+    filename
+
+    RETURN:
+        > dictionary with the seconds taken by each loader'''
+    seconds = {}
+    for name, loader in (('two pass', _load_users_two_pass),
+                         ('load_users', load_users),
+                         ('load_graph', load_graph)):
+        User.clear_users()
+        time1 = time()
+        users = loader(filename)
+        seconds[name] = time() - time1
+        print(name, "took", round(seconds[name], 2), "seconds")
+    User.clear_users()
+    print("Users:", len(users), " Relationships:", users.num_edges)
+    print("load_graph speed up:",
+          round(seconds['two pass'] / seconds['load_graph'], 1))
+    return seconds
+
+
+def generate_graph(num_users, seed=0, max_comp_size=10000,
+                   comp_size_exponent=2.0, prob_coach=0.1, mean_students=20):
+    '''Generate a random graph shaped like real coach-student data
+
+    This is a fast, vectorized take on test._create_users, which can make
+    graphs with tens of millions of users.  Component sizes follow a power
+    law (lots of lone users and small classes, a few huge schools).  Every
+    component is connected by a random tree, where each user's coach is one
+    of the users before it, and on top of that a proportion prob_coach of
+    users coach a log-normally distributed number of students from their own
+    component.
+
+    INPUT:
+        > num_users: number of users
+        > seed: seed of the random numbers; the same seed gives the same
+                graph
+        > max_comp_size: the maximum size of any connected component
+        > comp_size_exponent: exponent of the power law of component sizes
+        > prob_coach: probability of a user coaching extra students
+        > mean_students: mean number of extra students of those coaches
+
+    RETURN:
+        > a Graph with uids 0, 1, ..., num_users - 1'''
+    random_state = np.random.RandomState(seed)
+
+    # power law component sizes, drawn in batches until there are enough
+    comp_sizes = []
+    total = 0
+    while total < num_users:
+        uniform = random_state.random_sample(max(num_users // 4, 16))
+        batch = np.minimum(np.floor((1 - uniform) **
+                                    (-1 / (comp_size_exponent - 1))),
+                           max_comp_size).astype(np.int64)
+        comp_sizes.append(batch)
+        total += int(batch.sum())
+    comp_sizes = np.concatenate(comp_sizes)
+    comp_ends = np.cumsum(comp_sizes)
+    num_comps = int(np.searchsorted(comp_ends, num_users)) + 1
+    comp_sizes = comp_sizes[:num_comps]
+    comp_sizes[-1] -= comp_ends[num_comps - 1] - num_users
+    return _generate_components(comp_sizes, random_state, prob_coach,
+                                mean_students)
+
+
+def generate_component(num_users, seed=0, prob_coach=0.1, mean_students=20):
+    '''Generate one connected component of num_users users, shaped like
+    those of generate_graph (see there for the arguments)'''
+    return _generate_components(np.array([num_users], dtype=np.int64),
+                                np.random.RandomState(seed), prob_coach,
+                                mean_students)
+
+
+def _generate_components(comp_sizes, random_state, prob_coach,
+                         mean_students):
+    '''Graph with connected components of the given sizes, for
+    generate_graph'''
+    num_users = int(comp_sizes.sum())
+    comp_starts = np.cumsum(comp_sizes) - comp_sizes
+
+    # first user and size of the component of every user
+    users = np.arange(num_users, dtype=np.int64)
+    starts = np.repeat(comp_starts, comp_sizes)
+    sizes = np.repeat(comp_sizes, comp_sizes)
+
+    # a random tree joining each component together
+    rank = users - starts
+    joined = rank > 0
+    tree_coaches = starts[joined] + np.floor(random_state.random_sample(
+        int(joined.sum())) * rank[joined]).astype(np.int64)
+    tree_students = users[joined]
+
+    # extra students within the component
+    coaches = np.flatnonzero((random_state.random_sample(num_users) <
+                              prob_coach) & (sizes > 1))
+    sigma = 1.0
+    num_students = np.round(random_state.lognormal(
+        np.log(mean_students) - sigma**2 / 2, sigma, len(coaches)))
+    num_students = np.clip(num_students, 1, sizes[coaches] - 1).astype(
+        np.int64)
+    extra_coaches = np.repeat(coaches, num_students)
+    extra_students = starts[extra_coaches] + np.floor(
+        random_state.random_sample(len(extra_coaches)) *
+        sizes[extra_coaches]).astype(np.int64)
+
+    return Graph.from_edges(users,
+                            np.concatenate((tree_coaches, extra_coaches)),
+                            np.concatenate((tree_students, extra_students)))
+
+
+def _peak_rss_mb():
+    '''highest resident memory of this process (since the last
+    _reset_peak_rss, where Linux supports that) in megabytes'''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    import resource
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024. ** 2 if platform.system() == 'Darwin' else 1024.)
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except IOError:
+        pass
+
+
+def _measure(phases, name, function, *args, **kwargs):
+    '''Call function, recording its wall time and peak memory in phases'''
+    _reset_peak_rss()
+    time1 = time()
+    result = function(*args, **kwargs)
+    phases[name] = {'seconds': round(time() - time1, 4),
+                    'peak_rss_mb': round(_peak_rss_mb(), 1)}
+    return result
+
+
+def benchmark_suite(sizes, seed=0, proportion=0.3, method='fm', csv=False):
+    '''Time the phases of limited infection on generated graphs
+
+    For each size, a graph is made with generate_graph and saved to a
+    binary graph file (and a .csv file if csv is True).  Then loading it,
+    labelling the components, selecting whole components and splitting a
+    component are timed separately, the same way limited_infection does
+    them.
+
+    INPUT:
+        > sizes: list of numbers of users
+        > seed: seed for generate_graph
+        > proportion: proportion of the users to infect
+        > method: partitioning algorithm, one of PARTITIONERS
+        > csv: also time loading the graph from a .csv file
+
+    RETURN:
+        > a list with a dictionary of results for every size, which can be
+          saved as JSON'''
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    for num_users in sizes:
+        print("Benchmarking", num_users, "users...")
+        phases = {}
+        graph = _measure(phases, 'generate', generate_graph, num_users, seed)
+        filename = os.path.join(tmp_dir, 'graph.bin')
+        save_graph(graph, filename)
+        graph = _measure(phases, 'load', load_graph, filename)
+        if csv:
+            csv_filename = os.path.join(tmp_dir, 'graph.csv')
+            save_infected(graph, np.ones(len(graph), dtype=bool),
+                          csv_filename)
+            _measure(phases, 'load_csv', load_graph, csv_filename)
+            os.remove(csv_filename)
+
+        comp_labels, comp_counts = _measure(phases, 'components',
+                                            label_components, graph)
+        num_to_infect = int(proportion * num_users)
+        comps_to_keep, num_infected, comp_to_split = _measure(
+            phases, 'selection', _choose_components, comp_counts,
+            num_to_infect, 0)
+        infected = comps_to_keep[comp_labels]
+
+        # if whole components were enough, the largest one is split anyway
+        # so there's always a partitioning time to compare
+        missed = num_infected != num_to_infect
+        if not missed:
+            comp_to_split = int(np.argmax(comp_counts))
+        comp_nodes = np.flatnonzero(comp_labels == comp_to_split)
+        remaining_to_infect = num_to_infect - num_infected if missed else \
+            int(proportion * len(comp_nodes))
+        comp_graph = graph.subgraph(comp_nodes)
+        split = _measure(phases, 'partition', _split_graph, comp_graph,
+                         remaining_to_infect, method=method)
+        if missed:
+            infected[comp_nodes] = split
+
+        results.append({
+            'num_users': num_users,
+            'num_edges': int(graph.num_edges),
+            'num_components': len(comp_counts),
+            'largest_component': int(comp_counts.max()),
+            'seed': seed,
+            'method': method,
+            'num_to_infect': num_to_infect,
+            'num_infected': int(infected.sum()),
+            'cut': evaluate_split(graph, infected, comp_labels)[0],
+            'split_component_size': len(comp_nodes),
+            'split_num_to_infect': remaining_to_infect,
+            'split_cut': evaluate_split(comp_graph, split)[0],
+            'phases': phases})
+        del graph
+        os.remove(filename)
+    os.rmdir(tmp_dir)
+    return results
+
+
+def benchmark_kl(sizes, seed=0, baseline_max=5000):
+    '''Time a pass of _kernighan_lin, and of the original one
+    (_split_component_original), on generated components
+
+    For each size, a generated component of that many users is split a
+    third of the way, starting from its first users, and one pass of each
+    is timed.  The original takes ~O(n^3) per pass (most of an hour at
+    5000 users), so it's only timed on components of up to baseline_max
+    users.
+
+    RETURN:
+        > a list with a dictionary of results for every size'''
+    results = []
+    for num_users in sizes:
+        graph = generate_component(num_users, seed)
+        infected = np.zeros(len(graph), dtype=bool)
+        infected[:len(graph) // 3] = True
+        result = {'component_size': len(graph),
+                  'num_edges': int(graph.num_edges)}
+        # one pass is all we want, so don't warn that it's the last
+        with redirect_stdout(io.StringIO()):
+            time1 = time()
+            split = _kernighan_lin(graph, infected, max_iter=1)
+            result['seconds_per_pass'] = round(time() - time1, 4)
+        result['cut'] = evaluate_split(graph, split)[0]
+        if len(graph) <= baseline_max:
+            users = _users_of(graph)
+            with redirect_stdout(io.StringIO()):
+                time1 = time()
+                baseline_uids = _split_component_original(
+                    users, set(graph.uids[infected].tolist()), max_iter=1)
+                result['baseline_seconds_per_pass'] = round(time() - time1,
+                                                            4)
+            baseline = _uid_mask(graph.uids, baseline_uids)
+            result['baseline_cut'] = evaluate_split(graph, baseline)[0]
+            # ties between swaps are broken in the order of sets there, so
+            # the splits may differ even when the cuts are the same
+            result['same_split'] = bool(np.array_equal(split, baseline))
+            result['speed_up'] = round(result['baseline_seconds_per_pass'] /
+                                       result['seconds_per_pass'], 1)
+        print(result)
+        results.append(result)
+    return results
+
+
+def benchmark_partitioners(sizes, methods=('fm', 'multilevel', 'grow'),
+                           seed=0, proportion=0.3):
+    '''Time splitting generated components with each partitioner
+
+    For each size, a generated component of that many users is split with
+    each of methods so that proportion of it is infected, the way
+    limited_infection splits a component.  On components of a hundred
+    thousand users or more, multilevel should give a smaller cut than fm,
+    in less time.
+
+    RETURN:
+        > a list with a dictionary of results for every size and method'''
+    results = []
+    for num_users in sizes:
+        graph = generate_component(num_users, seed)
+        num_to_infect = int(proportion * len(graph))
+        for method in methods:
+            time1 = time()
+            split = _split_graph(graph, num_to_infect, method=method)
+            result = {'component_size': len(graph),
+                      'num_edges': int(graph.num_edges),
+                      'method': method,
+                      'seconds': round(time() - time1, 4),
+                      'cut': evaluate_split(graph, split)[0]}
+            print(result)
+            results.append(result)
+    return results
+
+
+def _environment():
+    '''what the benchmark ran on, so results can be compared across
+    commits'''
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loading users "
+                                     "from a .csv file, or every phase of "
+                                     "limited infection on generated graphs")
+    parser.add_argument('-i', '--input', default='test_data/example_large.csv',
+                        help="""Example .csv file to scale up (it's created
+                        by ./test.py)""", type=str)
+    parser.add_argument('-c', '--copies', default=10, type=int,
+                        help="""Number of copies of the example in the scaled
+                        up file.  100 copies of the large example is a million
+                        rows.""")
+    parser.add_argument('-s', '--sizes', type=str,
+                        help="""Comma separated numbers of users, e.g.
+                        1e4,1e5,1e6.  If given, the suite of phase timings is
+                        run on generated graphs of these sizes instead of
+                        the loader benchmark.""")
+    parser.add_argument('-k', '--kl', type=str,
+                        help="""Comma separated component sizes, e.g.
+                        500,1000,5000,50000.  If given, one pass of
+                        Kernighan-Lin is timed on generated components of
+                        these sizes, against the original implementation on
+                        the ones up to --klBaselineMax users.""")
+    parser.add_argument('--klBaselineMax', default=5000, type=int,
+                        help="""Largest component the original
+                        Kernighan-Lin is timed on""")
+    parser.add_argument('-p', '--partitioners', type=str,
+                        help="""Comma separated component sizes, e.g.
+                        1e5,5e5.  If given, splitting generated components
+                        of these sizes is timed with each of
+                        --partitionerMethods.""")
+    parser.add_argument('--partitionerMethods', default='fm,multilevel,grow',
+                        type=str, help="""Comma separated partitioners for
+                        --partitioners""")
+    parser.add_argument('--seed', default=0, type=int,
+                        help="Seed of the generated graphs")
+    parser.add_argument('-m', '--method', default='fm',
+                        choices=sorted(PARTITIONERS),
+                        help="Algorithm for splitting a connected component")
+    parser.add_argument('--csv', action="store_true",
+                        help="""Also time loading the generated graphs from
+                        .csv files (which take a while to write)""")
+    parser.add_argument('-j', '--json', type=str,
+                        help="""File to save the suite's results to as JSON
+                        (they're printed if not given)""")
+    args = parser.parse_args()
+
+    if args.kl is not None:
+        sizes = [int(float(size)) for size in args.kl.split(',')]
+        report = _environment()
+        report['results'] = benchmark_kl(sizes, args.seed, args.klBaselineMax)
+        if args.json is not None:
+            with open(args.json, 'w') as file:
+                json.dump(report, file, indent=2)
+        return
+
+    if args.partitioners is not None:
+        sizes = [int(float(size)) for size in args.partitioners.split(',')]
+        methods = args.partitionerMethods.split(',')
+        if not set(methods) <= set(PARTITIONERS):
+            print("--partitionerMethods must be some of",
+                  ', '.join(sorted(PARTITIONERS)) + ". Exiting....")
+            return
+        report = _environment()
+        report['results'] = benchmark_partitioners(sizes, methods,
+                                                   args.seed)
+        if args.json is not None:
+            with open(args.json, 'w') as file:
+                json.dump(report, file, indent=2)
+        return
+
+    if args.sizes is not None:
+        sizes = [int(float(size)) for size in args.sizes.split(',')]
+        report = _environment()
+        report['results'] = benchmark_suite(sizes, args.seed,
+                                            method=args.method, csv=args.csv)
+        if args.json is None:
+            print(json.dumps(report, indent=2))
+        else:
+            with open(args.json, 'w') as file:
+                json.dump(report, file, indent=2)
+        return
+
+    root, extension = os.path.splitext(args.input)
+    scaled_filename = root + '_x' + str(args.copies) + extension
+    if not os.path.exists(scaled_filename):
+        print("Creating", scaled_filename, "...")
+        _scale_example(args.input, args.copies, scaled_filename)
+    benchmark_loaders(scaled_filename)
+
+
+if __name__ == '__main__':
+    main()
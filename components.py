@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Garrett Reynolds
+"""
+
+from collections import OrderedDict
+import numpy as np
+from user import User
+from graph import Graph, UidIndex, _as_uid_array, _is_int64
+
+
+# label_components only uses more than one worker for graphs of at least
+# this many users (starting a pool of processes and copying the graph into
+# shared memory takes ~0.1 s, as long as labelling a million users does)
+PARALLEL_MIN_USERS = 2 * 10**6
+# ... and when at most this fraction of the relationships join nodes of
+# different ranges, since those are all labelled after the workers are done
+# (when the nodes are in no particular order, most of them do)
+PARALLEL_MAX_CROSSING = 0.25
+
+
+def label_components(graph, workers=1, min_parallel_users=PARALLEL_MIN_USERS):
+    '''Label the connected component of every user of the graph
+
+    This is an array version of union-find: every round, the root of each
+    edge's larger label is hooked under the smaller label, then pointers are
+    jumped until every node points straight at its root.  There's no
+    recursion, and no Python-level work per node.
+
+    With more than one worker, the nodes are cut into one range per worker
+    and each worker process labels the components of its range (using only
+    the relationships inside it) in shared memory.  The relationships
+    between ranges are then used to merge those labels.  Every component
+    ends up labelled by its first node either way, so the labels don't
+    depend on the number of workers.  That only pays off for large graphs
+    whose components are mostly inside one range, so smaller ones, or ones
+    where more than PARALLEL_MAX_CROSSING of the relationships cross
+    between ranges, are labelled by this process alone.
+
+    INPUT:
+        > graph: Graph object
+        > workers: number of processes to use
+        > min_parallel_users: fewest users to use more than one process for
+
+    RETURN:
+        > labels: array with the component number of every node.  Components
+                  are numbered 0, 1, ... in order of their first node.
+        > sizes: array with the number of users in each component'''
+    num_users = len(graph)
+    # each relationship is stored in both directions, we only need one
+    sources = graph.edge_sources()
+    targets = graph.indices
+    one_way = sources < targets
+    labels = None
+    if workers > 1 and num_users > workers and \
+            num_users >= min_parallel_users:
+        chunk_size = -(-num_users // workers)
+        crossing = one_way & ((sources // chunk_size) !=
+                              (targets // chunk_size))
+        if crossing.sum() <= PARALLEL_MAX_CROSSING * one_way.sum():
+            labels = _label_chunks_in_parallel(graph, chunk_size, workers)
+            # the relationships inside a chunk are already taken care of
+            one_way = crossing
+    if labels is None:
+        labels = np.arange(num_users, dtype=np.int64)
+    _hook(labels, sources[one_way], targets[one_way])
+
+    roots, labels = np.unique(labels, return_inverse=True)
+    labels = labels.astype(graph.indices.dtype)
+    return labels, np.bincount(labels, minlength=len(roots))
+
+
+def _hook(labels, sources, targets):
+    '''union-find over the relationships between sources and targets, where
+    labels (which is updated in place) starts off as a forest of roots'''
+    while True:
+        source_labels = labels[sources]
+        target_labels = labels[targets]
+        differ = source_labels != target_labels
+        if not differ.any():
+            return labels
+        # only edges which still join two different trees matter from now on
+        sources = sources[differ]
+        targets = targets[differ]
+        source_labels = source_labels[differ]
+        target_labels = target_labels[differ]
+        np.minimum.at(labels, np.maximum(source_labels, target_labels),
+                      np.minimum(source_labels, target_labels))
+        _compress(labels)
+
+
+def _label_chunks_in_parallel(graph, chunk_size, workers):
+    '''Label every node with the first node of its component within the
+    range of chunk_size nodes it's in, one range per task of a pool of
+    worker processes.  The graph's arrays and the labels are put in shared
+    memory, so they aren't copied to every process.'''
+    from multiprocessing import Pool
+    from multiprocessing.shared_memory import SharedMemory
+    num_users = len(graph)
+    arrays = (graph.indptr, graph.indices,
+              np.zeros(num_users, dtype=np.int64))
+    blocks = [SharedMemory(create=True, size=max(array.nbytes, 1))
+              for array in arrays]
+    try:
+        specs = []
+        for block, array in zip(blocks, arrays):
+            np.ndarray(array.shape, array.dtype, block.buf)[:] = array
+            specs.append((block.name, array.shape, array.dtype.str))
+        tasks = [(specs, start, min(start + chunk_size, num_users))
+                 for start in range(0, num_users, chunk_size)]
+        pool = Pool(workers)
+        try:
+            pool.map(_label_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        return np.ndarray(num_users, np.int64, blocks[2].buf).copy()
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def _label_chunk(task):
+    '''worker for _label_chunks_in_parallel'''
+    from multiprocessing.shared_memory import SharedMemory
+    specs, start, stop = task
+    blocks = [SharedMemory(name=name) for name, _, _ in specs]
+    try:
+        indptr, indices, labels = (np.ndarray(shape, dtype, block.buf)
+                                   for block, (_, shape, dtype)
+                                   in zip(blocks, specs))
+        chunk_indptr = indptr[start:stop + 1]
+        sources = np.repeat(np.arange(stop - start), np.diff(chunk_indptr))
+        targets = indices[chunk_indptr[0]:chunk_indptr[-1]] - start
+        inside = (sources < targets) & (targets < stop - start)
+        chunk_labels = _hook(np.arange(stop - start, dtype=np.int64),
+                             sources[inside], targets[inside])
+        labels[start:stop] = chunk_labels + start
+        # the arrays must be gone before the shared memory can be closed
+        del indptr, indices, labels
+    finally:
+        for block in blocks:
+            block.close()
+
+
+def _compress(parents):
+    '''pointer jumping: point every node directly at the root of its tree'''
+    while True:
+        grandparents = parents[parents]
+        if np.array_equal(grandparents, parents):
+            return parents
+        parents[:] = grandparents
+
+
+def _find(parents, comp):
+    '''root of comp in the union-find forest parents (with path halving)'''
+    while parents[comp] != comp:
+        parents[comp] = parents[parents[comp]]
+        comp = parents[comp]
+    return comp
+
+
+def _union(parents, comp, other_comp):
+    '''Join the trees of comp and other_comp in the union-find forest
+    parents, hooking the later root under the earlier one
+
+    RETURN:
+        > root: root of the joined tree
+        > hooked: root which was hooked under it, or None if they were in
+                  the same tree already'''
+    comp = _find(parents, comp)
+    other_comp = _find(parents, other_comp)
+    if comp == other_comp:
+        return comp, None
+    root = min(comp, other_comp)
+    hooked = max(comp, other_comp)
+    parents[hooked] = root
+    return root, hooked
+
+
+class ComponentIndex:
+    '''Connected components of a group of users, kept up to date as
+    coach-student relationships are added or removed.
+
+    Build it once (from the output of load_users or from a Graph), save it to
+    disk, and pass it to limited_infection so that only the subset selection
+    has to be done on each run.  While it watches the users, new
+    relationships made with User.add_students/add_coaches merge components
+    with union-find, and removed relationships mark their component so that
+    only that component is searched again the next time it's needed.  Only
+    the watched users count: users of another group (e.g. loaded by
+    load_users), even with the same uids, are ignored, and new users count
+    once they're in the watched dictionary.
+
+    The fingerprint of the graph an index was built from is saved with it,
+    so that matches() can tell whether it's still right for the users of a
+    later run.'''
+
+    def __init__(self, uids, labels, users=None, fingerprint=None):
+        '''
+        INPUT:
+            > uids: sequence of user IDs, one per node
+            > labels: component label of every node
+            > users: (optional) dictionary with UID as keys and the
+                     corresponding User objects as values.  If given, the
+                     index watches these users for changes.
+            > fingerprint: (optional) Graph.fingerprint() of the graph the
+                           labels were found for'''
+        self._uids = list(uids.tolist() if isinstance(uids, np.ndarray)
+                          else uids)
+        self._node_of = {uid: node for node, uid in enumerate(self._uids)}
+        labels = np.asarray(labels, dtype=np.int64)
+        # component of every node (as of when the node was assigned one) and
+        # the union-find forest over those components
+        self._node_comps = _GrowableArray(labels)
+        num_comps = labels.max() + 1 if len(labels) else 0
+        self._parents = _GrowableArray(np.arange(num_comps, dtype=np.int64))
+        # components which lost a relationship and may have fallen apart
+        self._dirty_comps = set()
+        self._cache = None
+        self._users = users
+        # users created after the index was built
+        self._new_users = {}
+        self.fingerprint = fingerprint
+        if users is not None:
+            User.add_listener(self)
+
+    @classmethod
+    def build(cls, users, workers=1):
+        '''Find the components of users from scratch
+
+        INPUT:
+            > users: a dictionary with UID as keys and the corresponding User
+                     objects as values (which are then watched for changes),
+                     or a Graph.
+            > workers: number of processes to label the components with
+
+        RETURN:
+            > a ComponentIndex'''
+        if isinstance(users, Graph):
+            labels, _ = label_components(users, workers)
+            return cls(users.uids, labels, fingerprint=users.fingerprint())
+        graph = Graph.from_users(users.values())
+        labels, _ = label_components(graph, workers)
+        return cls(graph.uids, labels, users, graph.fingerprint())
+
+    @classmethod
+    def load(cls, filename, users=None):
+        '''Load an index saved with save(), optionally watching users'''
+        with np.load(filename, allow_pickle=True) as data:
+            # indexes saved by older versions have no fingerprint
+            fingerprint = str(data['fingerprint']) \
+                if 'fingerprint' in data.files else None
+            return cls(data['uids'], data['labels'], users, fingerprint)
+
+    def save(self, filename):
+        '''Save the index to filename (a NumPy .npz file)'''
+        labels, _ = self.components()
+        fingerprint = {} if self.fingerprint is None else \
+            {'fingerprint': self.fingerprint}
+        with open(filename, 'wb') as file:
+            np.savez(file, uids=self.uids, labels=labels, **fingerprint)
+
+    def matches(self, graph):
+        '''True if the index was built from graph (and the users haven't
+        changed since)'''
+        return self.fingerprint is not None and \
+            self.fingerprint == graph.fingerprint()
+
+    def unwatch(self):
+        '''stop following changes to the users'''
+        if self._users is not None:
+            User.remove_listener(self)
+            self._users = None
+            self._new_users = {}
+
+    @property
+    def uids(self):
+        '''array of user IDs in node order'''
+        return _as_uid_array(self._uids)
+
+    def __len__(self):
+        return len(self._uids)
+
+    def components(self):
+        '''Current components of the users
+
+        RETURN:
+            > labels: array with the component number (0, 1, ...) of every
+                      node, in the order of uids
+            > sizes: array with the number of users in each component'''
+        if self._users is not None and len(self._users) > len(self._uids):
+            self._add_missing_users()
+        if self._cache is None:
+            for comp in list(self._dirty_comps):
+                self._split_dirty(comp)
+            self._dirty_comps = set()
+            parents = self._parents.view()
+            _compress(parents)
+            roots = parents[self._node_comps.view()]
+            _, labels = np.unique(roots, return_inverse=True)
+            self._cache = (labels, np.bincount(labels))
+        return self._cache
+
+    def component_of(self, uid):
+        '''component number of the user with the given uid: a dictionary
+        lookup, once the labels are up to date (see components)'''
+        labels, _ = self.components()
+        return labels[self._node_of[uid]]
+
+    def user_added(self, user):
+        # a new user isn't in the watched dictionary yet when it's made, so
+        # it's added once it is (see components) or gets a relationship
+        pass
+
+    def edge_added(self, coach, student):
+        if not (self._is_watched(coach) and self._is_watched(student)):
+            return
+        self.fingerprint = None
+        self._join(self._node_comp(coach), self._node_comp(student))
+
+    def edge_removed(self, coach, student):
+        if not (self._is_watched(coach) and self._is_watched(student)):
+            return
+        self.fingerprint = None
+        self._dirty_comps.add(self._find(self._node_comp(coach)))
+        self._cache = None
+
+    def _node_comp(self, user):
+        self._add_node(user)
+        return self._node_comps[self._node_of[user.get_uid()]]
+
+    def _is_watched(self, user):
+        '''True if user is one of the watched users, rather than a user of
+        some other group which happens to have the same uid'''
+        return self._users is not None and \
+            self._users.get(user.get_uid()) is user
+
+    def _add_missing_users(self):
+        '''add the watched users who aren't nodes yet'''
+        for uid, user in list(self._users.items()):
+            if uid not in self._node_of:
+                self._add_node(user)
+
+    def _add_node(self, user):
+        '''add a new user, joined with the watched users it already has
+        relationships with (adding those too if they aren't nodes yet,
+        since a user can be given coaches and students before it's put in
+        the watched dictionary)'''
+        to_add = [user]
+        added = []
+        while to_add:
+            user = to_add.pop()
+            uid = user.get_uid()
+            if uid in self._node_of:
+                continue
+            self._new_users[uid] = user
+            self._node_of[uid] = len(self._uids)
+            self._uids.append(uid)
+            self._node_comps.append(self._new_comp())
+            self._cache = None
+            self.fingerprint = None
+            added.append(user)
+            to_add.extend(neighbor for neighbor
+                          in self._watched_neighbors(user)
+                          if neighbor.get_uid() not in self._node_of)
+        for user in added:
+            comp = self._node_comps[self._node_of[user.get_uid()]]
+            for neighbor in self._watched_neighbors(user):
+                self._join(comp,
+                           self._node_comps[self._node_of[neighbor.get_uid()]])
+
+    def _watched_neighbors(self, user):
+        return [neighbor for neighbor
+                in user.get_students() | user.get_coaches()
+                if self._is_watched(neighbor)]
+
+    def _join(self, comp, other_comp):
+        '''merge the components of two nodes, given the components the nodes
+        were assigned'''
+        root, hooked = _union(self._parents, comp, other_comp)
+        if hooked is None:
+            return
+        if root in self._dirty_comps or hooked in self._dirty_comps:
+            self._dirty_comps -= set((root, hooked))
+            self._dirty_comps.add(root)
+        self._cache = None
+
+    def _new_comp(self):
+        self._parents.append(len(self._parents))
+        return len(self._parents) - 1
+
+    def _find(self, comp):
+        return _find(self._parents, comp)
+
+    def _get_user(self, uid):
+        if uid in self._new_users:
+            return self._new_users[uid]
+        return self._users[uid]
+
+    def _split_dirty(self, comp):
+        '''search the component comp again, giving every piece it fell into
+        a new component of its own'''
+        parents = self._parents.view()
+        _compress(parents)
+        nodes = np.flatnonzero(parents[self._node_comps.view()] ==
+                               self._find(comp))
+        users = [self._get_user(self._uids[node]) for node in nodes.tolist()]
+        # only the relationships within the component, since its users may
+        # also have some with users who aren't watched
+        position = {user: index for index, user in enumerate(users)}
+        coaches = []
+        students = []
+        for index, user in enumerate(users):
+            for student in user.get_students():
+                if student in position:
+                    coaches.append(index)
+                    students.append(position[student])
+        graph = Graph.from_edges(nodes, coaches, students)
+        labels, sizes = label_components(graph)
+        new_comps = [self._new_comp() for _ in range(len(sizes))]
+        self._node_comps[nodes] = np.array(new_comps)[labels]
+
+
+# ComponentLookup keeps the component of every uid between the lowest and
+# the highest when there are at most this many times as many of those as
+# there are users
+MAX_TABLE_SPAN = 4
+
+
+class ComponentLookup:
+    '''Read-only answers to "which users are in this user's component?"
+
+    Built once from the component labels, it finds a user's component with
+    a UidIndex (so the components of many users are found at once with
+    components_of), and the members of a component are a slice of an
+    array of all uids sorted by component (a view, nothing is copied).  The
+    members of the most recently asked for components are also kept as
+    frozensets, up to cache_size of them.
+
+    When the uids are integers that are dense enough (such as the IDs of a
+    database table), the component of every uid from the lowest to the
+    highest is also kept in one array, so component_of is O(1).  Otherwise
+    it's the O(log n) binary search of the UidIndex (or, for uids which
+    aren't integers, a dictionary lookup).'''
+
+    def __init__(self, uids, labels, cache_size=128):
+        '''
+        INPUT:
+            > uids: sequence of user IDs, one per node
+            > labels: component number (0, 1, ...) of every node
+            > cache_size: number of member sets to keep'''
+        uids = _as_uid_array(uids)
+        self._labels = np.asarray(labels)
+        self._uid_index = UidIndex(uids)
+        order = np.argsort(self._labels, kind='stable')
+        self._members = uids[order]
+        self._members.flags.writeable = False
+        # members of component c are self._members[offsets[c]:offsets[c+1]]
+        sizes = np.bincount(self._labels)
+        self._offsets = np.concatenate(([0], np.cumsum(sizes)))
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        # component of uid self._low + i is self._table[i] (-1 for no user)
+        self._low = self._table = None
+        if uids.dtype.kind in 'iu' and len(uids):
+            low = int(uids.min())
+            span = int(uids.max()) - low + 1
+            if span <= MAX_TABLE_SPAN * len(uids):
+                self._low = low
+                self._table = np.full(span, -1, dtype=np.int64)
+                self._table[uids - low] = self._labels
+
+    @classmethod
+    def build(cls, users, workers=1, cache_size=128):
+        '''Find the components of users (a Graph, a dictionary of {uid:
+        User} or a ComponentIndex) and index them'''
+        if isinstance(users, ComponentIndex):
+            labels, _ = users.components()
+            return cls(users.uids, labels, cache_size)
+        if not isinstance(users, Graph):
+            users = Graph.from_users(users.values())
+        labels, _ = label_components(users, workers)
+        return cls(users.uids, labels, cache_size)
+
+    def __len__(self):
+        '''number of components'''
+        return len(self._offsets) - 1
+
+    def component_of(self, uid):
+        '''component number of the user with the given uid'''
+        if self._table is not None:
+            offset = int(uid) - self._low if _is_int64(uid) else -1
+            if 0 <= offset < len(self._table):
+                comp = int(self._table[offset])
+                if comp >= 0:
+                    return comp
+            raise KeyError(uid)
+        return int(self._labels[self._uid_index.index_of(uid)])
+
+    def components_of(self, uids):
+        '''component numbers of a sequence of uids (-1 for unknown ones)'''
+        nodes = self._uid_index.indices_of(uids)
+        comps = np.full(len(nodes), -1, dtype=np.int64)
+        comps[nodes >= 0] = self._labels[nodes[nodes >= 0]]
+        return comps
+
+    def size(self, comp):
+        '''number of users in component comp'''
+        return int(self._offsets[comp + 1] - self._offsets[comp])
+
+    def members(self, comp):
+        '''read-only array of the uids of component comp, which shares
+        memory with the index'''
+        return self._members[self._offsets[comp]:self._offsets[comp + 1]]
+
+    def member_set(self, comp):
+        '''frozenset of the uids of component comp'''
+        if comp in self._cache:
+            self._cache.move_to_end(comp)
+            return self._cache[comp]
+        members = frozenset(self.members(comp).tolist())
+        self._cache[comp] = members
+        if len(self._cache) > self._cache_size:
+            # forget the least recently used one
+            self._cache.popitem(last=False)
+        return members
+
+
+class _GrowableArray:
+    '''NumPy array which can be appended to in amortized constant time'''
+
+    def __init__(self, array):
+        self._data = np.array(array, dtype=np.int64)
+        self._size = len(array)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        return self._data[index]
+
+    def __setitem__(self, index, value):
+        self._data[index] = value
+
+    def append(self, value):
+        if self._size == len(self._data):
+            self._data = np.concatenate((self._data,
+                                         np.empty(max(self._size, 16),
+                                                  dtype=np.int64)))
+        self._data[self._size] = value
+        self._size += 1
+
+    def view(self):
+        '''the filled part of the array (shares memory)'''
+        return self._data[:self._size]
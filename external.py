@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Garrett Reynolds
+"""
+
+import os
+import numpy as np
+from graph import Graph
+from infections import _choose_components, _split_graph
+from profiling import span
+from save_load import (CHUNK_SIZE, OUTPUT_FORMATS, _csv_chunks,
+                       _parse_lines, _raise_duplicate)
+
+# nodes labelled or saved at a time
+BLOCK_SIZE = 2**22
+
+
+class ExternalGraph:
+    '''The users of a .csv file (in the format of load_users), for graphs
+    too large to load into memory.
+
+    The relationships are never all in memory: they're streamed from the
+    file a chunk at a time whenever they're needed.  The arrays with an
+    entry per user (uids, the union-find forest, component labels) are
+    memory mapped files in work_dir.  Only sorting the uids, to look up
+    their node indices, is done in memory.  Users are numbered like
+    load_graph does: in the order of their rows, then the users who only
+    appear as students, by uid.  User IDs must be integers.'''
+
+    def __init__(self, filename, work_dir, chunk_size=CHUNK_SIZE,
+                 block_size=BLOCK_SIZE):
+        '''
+        INPUT:
+            > filename: .csv file of the users
+            > work_dir: directory for the files of the arrays (which is
+                        created if needed)
+            > chunk_size: number of bytes of the .csv file to read at a
+                          time
+            > block_size: number of users labelled or saved at a time'''
+        self.filename = filename
+        self.work_dir = work_dir
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+
+        # the uid of every row, in order
+        uids_filename = self._path('uids')
+        with open(uids_filename, 'wb') as file:
+            for lines in _csv_chunks(filename, chunk_size):
+                row_uids, _, _ = self._parse(lines)
+                file.write(row_uids.astype(np.int64).tobytes())
+        self.num_rows = os.path.getsize(uids_filename) // 8
+        row_uids = self._memmap('uids', np.int64, self.num_rows, 'r')
+        row_order = np.argsort(row_uids, kind='stable')
+        sorted_rows = row_uids[row_order]
+        is_duplicate = sorted_rows[1:] == sorted_rows[:-1]
+        if is_duplicate.any():
+            _raise_duplicate(sorted_rows[1:][is_duplicate][0])
+        self._row_order = self._save('row_order', row_order)
+        self._sorted_rows = self._save('sorted_rows', sorted_rows)
+        del row_uids, row_order, sorted_rows
+
+        # the users without a row of their own are added after the rows
+        new_uids = []
+        for lines in _csv_chunks(filename, chunk_size):
+            _, _, student_uids = self._parse(lines)
+            new_uids.append(np.unique(student_uids[
+                ~self._is_row_uid(student_uids)]))
+        self._new_uids = np.unique(np.concatenate(new_uids)) if new_uids \
+            else np.zeros(0, dtype=np.int64)
+        with open(uids_filename, 'ab') as file:
+            file.write(self._new_uids.astype(np.int64).tobytes())
+        self.uids = self._memmap('uids', np.int64, len(self), 'r')
+
+    def __len__(self):
+        return self.num_rows + len(self._new_uids)
+
+    def nodes_of(self, uids):
+        '''node indices of an array of uids, which must all be users'''
+        nodes = self._row_order[np.minimum(
+            np.searchsorted(self._sorted_rows, uids),
+            max(self.num_rows - 1, 0))] if self.num_rows else \
+            np.zeros(len(uids), dtype=np.int64)
+        is_new = ~self._is_row_uid(uids)
+        nodes[is_new] = self.num_rows + np.searchsorted(self._new_uids,
+                                                        uids[is_new])
+        return nodes
+
+    def edge_chunks(self):
+        '''yield (coaches, students), the node indices of the relationships
+        of a chunk of the file at a time'''
+        for lines in _csv_chunks(self.filename, self.chunk_size):
+            _, coach_uids, student_uids = self._parse(lines)
+            yield self.nodes_of(coach_uids), self.nodes_of(student_uids)
+
+    def blocks(self):
+        '''yield slices of block_size nodes covering every node'''
+        for start in range(0, len(self), self.block_size):
+            yield slice(start, min(start + self.block_size, len(self)))
+
+    def label_components(self):
+        '''Label the connected component of every user with a union-find
+        forest in a memory mapped file, which only the users of the
+        relationships of one chunk are looked up in at a time
+
+        RETURN:
+            > labels: memory mapped array with the component number of every
+                      node.  Like components.label_components, components
+                      are numbered 0, 1, ... in order of their first node.
+            > sizes: array with the number of users in each component'''
+        parents = self._memmap('labels', np.int64, len(self), 'w+')
+        for block in self.blocks():
+            parents[block] = np.arange(block.start, block.stop)
+        for coaches, students in self.edge_chunks():
+            _union(parents, coaches, students)
+
+        # point every node straight at its root.  Every root is the first
+        # node of its tree and every parent comes before its child, so
+        # the roots of a block's nodes are known by the time it's labelled,
+        # and the parents can become the labels.
+        for block in self.blocks():
+            _find_roots(parents, np.arange(block.start, block.stop))
+        comp_sizes = np.zeros(0, dtype=np.int64)
+        for block in self.blocks():
+            nodes = np.arange(block.start, block.stop)
+            roots = parents[block]
+            is_root = roots == nodes
+            labels = np.empty(len(nodes), dtype=np.int64)
+            labels[is_root] = len(comp_sizes) + np.arange(is_root.sum())
+            in_block = ~is_root & (roots >= block.start)
+            labels[in_block] = labels[roots[in_block] - block.start]
+            before = roots < block.start
+            labels[before] = parents[roots[before]]
+            parents[block] = labels
+            block_sizes = np.bincount(labels, minlength=len(comp_sizes) +
+                                      int(is_root.sum()))
+            block_sizes[:len(comp_sizes)] += comp_sizes
+            comp_sizes = block_sizes
+        if isinstance(parents, np.memmap):
+            parents.flush()
+        return parents, comp_sizes
+
+    def component_graph(self, labels, comp):
+        '''Load the Graph of the users of one component, with one more pass
+        over the file
+
+        RETURN:
+            > nodes: node indices of the users of the component
+            > graph: their Graph, in the same order'''
+        nodes = np.concatenate([np.flatnonzero(labels[block] == comp) +
+                                block.start for block in self.blocks()])
+        coach_list = []
+        student_list = []
+        for coaches, students in self.edge_chunks():
+            # both users of a relationship are in the same component
+            inside = labels[coaches] == comp
+            coach_list.append(np.searchsorted(nodes, coaches[inside]))
+            student_list.append(np.searchsorted(nodes, students[inside]))
+        return nodes, Graph.from_edges(self.uids[nodes],
+                                       np.concatenate(coach_list),
+                                       np.concatenate(student_list))
+
+    def _parse(self, lines):
+        parsed = _parse_lines(lines)
+        if any(uids.dtype == object for uids in parsed):
+            raise RuntimeError("Users can only be handled out of memory if "
+                               "their uids are integers.")
+        return parsed
+
+    def _is_row_uid(self, uids):
+        if not self.num_rows:
+            return np.zeros(len(uids), dtype=bool)
+        positions = np.minimum(np.searchsorted(self._sorted_rows, uids),
+                               self.num_rows - 1)
+        return self._sorted_rows[positions] == uids
+
+    def _path(self, name):
+        return os.path.join(self.work_dir, name + '.bin')
+
+    def _memmap(self, name, dtype, length, mode):
+        if length == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self._path(name), dtype=dtype, mode=mode,
+                         shape=(length,))
+
+    def _save(self, name, array):
+        '''write array to its file and memory map it instead'''
+        array.astype(np.int64).tofile(self._path(name))
+        return self._memmap(name, np.int64, len(array), 'r')
+
+
+def _find_roots(parents, nodes):
+    '''roots of the trees of nodes in the union-find forest parents, which
+    are also made the parents of nodes so the next search is shorter'''
+    roots = parents[nodes]
+    while True:
+        grandparents = parents[roots]
+        if np.array_equal(grandparents, roots):
+            break
+        roots = grandparents
+    parents[nodes] = roots
+    return roots
+
+
+def _union(parents, sources, targets):
+    '''union-find over the relationships between sources and targets, like
+    components._hook, but only looking up the roots of their own trees'''
+    while len(sources):
+        source_roots = _find_roots(parents, sources)
+        target_roots = _find_roots(parents, targets)
+        differ = source_roots != target_roots
+        if not differ.any():
+            return
+        sources = sources[differ]
+        targets = targets[differ]
+        source_roots = source_roots[differ]
+        target_roots = target_roots[differ]
+        np.minimum.at(parents, np.maximum(source_roots, target_roots),
+                      np.minimum(source_roots, target_roots))
+
+
+def limited_infection_external(filename, num_to_infect, work_dir, tol=0,
+                               method='fm', chunk_size=CHUNK_SIZE,
+                               block_size=BLOCK_SIZE, verbose=False,
+                               observer=None):
+    '''limited_infection for a .csv file of users too large to load
+
+    The components are labelled with an ExternalGraph, whole components are
+    selected the same way as limited_infection, and if one has to be split,
+    only that component is loaded into memory.
+
+    INPUT:
+        > filename: .csv file of the users
+        > num_to_infect: (int or float) number or proportion of users to
+                         infect, as for limited_infection
+        > work_dir: directory for the memory mapped files
+        > tol: (int or float) tolerance, as for limited_infection
+        > method: algorithm used to split a component, one of PARTITIONERS
+        > chunk_size: number of bytes of the .csv file to read at a time
+        > block_size: number of users labelled or saved at a time
+        > verbose: print what's going on
+        > observer: (optional) a profiling.Profiler, see limited_infection
+
+    RETURN:
+        > graph: the ExternalGraph of the users
+        > infected: memory mapped boolean array telling which users are
+                    infected'''
+    with span(observer, 'components'):
+        graph = ExternalGraph(filename, work_dir, chunk_size, block_size)
+        labels, comp_counts = graph.label_components()
+    num_users = len(graph)
+    if observer is not None:
+        observer.histogram('component_sizes', comp_counts)
+    if isinstance(num_to_infect, float):
+        num_to_infect = int(num_to_infect * num_users)
+    if isinstance(tol, float):
+        tol = int(tol * num_users)
+    if not 0 <= num_to_infect <= num_users:
+        raise RuntimeError("You're trying to infect", num_to_infect, "users, "
+                           "when you have", num_users, "users.")
+
+    with span(observer, 'selection'):
+        comps_to_keep, num_infected, comp_to_split = _choose_components(
+            comp_counts, num_to_infect, 0, tol, observer)
+    infected = graph._memmap('infected', bool, num_users, 'w+')
+    for block in graph.blocks():
+        infected[block] = comps_to_keep[labels[block]]
+
+    if ((num_to_infect - tol) <= num_infected and
+            num_infected <= (num_to_infect + tol)):
+        if verbose:
+            print("A split without any coflicts was found!")
+    else:
+        with span(observer, 'subgraph'):
+            comp_nodes, comp_graph = graph.component_graph(labels,
+                                                           comp_to_split)
+        if verbose:
+            print("Splitting a component of", len(comp_nodes), "users")
+        with span(observer, 'split'):
+            infected[comp_nodes] = _split_graph(comp_graph,
+                                                num_to_infect - num_infected,
+                                                method=method,
+                                                observer=observer)
+    if isinstance(infected, np.memmap):
+        infected.flush()
+    return graph, infected
+
+
+def save_infected_external(graph, infected, filename, output_format='csv'):
+    '''save_infected for an ExternalGraph, a block of users at a time
+
+    For the 'csv' format, the rows of the infected users are copied from
+    the graph's .csv file, followed by a row for each infected user who only
+    appears as a student.
+
+    INPUT:
+        > graph: an ExternalGraph
+        > infected: boolean array telling which users to save
+        > filename: filename to save to
+        > output_format: one of OUTPUT_FORMATS'''
+    if output_format not in OUTPUT_FORMATS:
+        raise RuntimeError("Unknown output format:", output_format)
+    if output_format == 'npy':
+        num_infected = sum(int(infected[block].sum())
+                           for block in graph.blocks())
+        uids = np.lib.format.open_memmap(filename, mode='w+', dtype=np.int64,
+                                         shape=(num_infected,))
+        start = 0
+        for block in graph.blocks():
+            block_uids = graph.uids[block][infected[block]]
+            uids[start:start + len(block_uids)] = block_uids
+            start += len(block_uids)
+        uids.flush()
+        return
+
+    with open(filename, 'w') as file:
+        if output_format == 'csv':
+            for lines in _csv_chunks(graph.filename, graph.chunk_size):
+                rows = [line for line in lines.decode().splitlines()
+                        if line.strip(' ,\r')]
+                row_uids, _, _ = graph._parse(lines)
+                keep = infected[graph.nodes_of(row_uids)]
+                if keep.any():
+                    file.write('\n'.join(row for row, kept in
+                                         zip(rows, keep.tolist()) if kept) +
+                               '\n')
+        for block in graph.blocks():
+            if output_format == 'csv':
+                block = slice(max(block.start, graph.num_rows), block.stop)
+            block_uids = graph.uids[block][infected[block]]
+            if len(block_uids):
+                file.write('\n'.join(map(str, block_uids.tolist())) + '\n')
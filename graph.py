@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Garrett Reynolds
+"""
+
+import hashlib
+import numbers
+import numpy as np
+from user import User
+
+# bit flags stored for every entry of Graph.indices, telling us whether the
+# neighbor is a student of the node, a coach of it, or both
+STUDENT = 1
+COACH = 2
+
+_INT64_MIN = int(np.iinfo(np.int64).min)
+_INT64_MAX = int(np.iinfo(np.int64).max)
+
+
+class Graph:
+    '''Compact coach-student graph in compressed sparse row (CSR) form.
+
+    The connections of node i are indices[indptr[i]:indptr[i+1]] and the
+    matching entries of kinds tell whether each one is a student (STUDENT), a
+    coach (COACH) or both of node i.  Every relationship is stored in both
+    directions, so the graph can be traversed as an undirected graph, and each
+    node's connections are sorted and unique.
+
+    A Graph behaves like the dictionary of {uid: User} used elsewhere, where
+    the values are UserView objects, so existing callers keep working.
+
+    Optionally, relationships and users can have (integer) weights:
+    edge_weights[k] is the weight of the connection indices[k] (the same in
+    both directions), and node_weights[i] the weight of node i, e.g. how
+    much traffic the user brings.  Limited infection then minimizes the
+    weight of the relationships between groups, and infects a given weight
+    of users.  Either is None when all weights are 1.'''
+
+    def __init__(self, uids, indptr, indices, kinds, edge_weights=None,
+                 node_weights=None):
+        self.uids = np.asarray(uids)
+        self.indptr = np.asarray(indptr)
+        self.indices = np.asarray(indices)
+        self.kinds = np.asarray(kinds, dtype=np.int8)
+        self.edge_weights = None if edge_weights is None else \
+            np.asarray(edge_weights, dtype=np.int64)
+        self.node_weights = None if node_weights is None else \
+            np.asarray(node_weights, dtype=np.int64)
+        self._uid_index = None
+
+    @classmethod
+    def from_edges(cls, uids, coaches, students, weights=None,
+                   node_weights=None):
+        '''Build a graph from coach-student relationships
+
+        INPUT:
+            > uids: sequence of user IDs, one per node
+            > coaches: array of node indices of the coaches
+            > students: array of node indices of the students, so that
+                        students[k] is a student of coaches[k]
+            > weights: (optional) integer weight of every relationship.  If
+                       two users coach each other, the weights are added.
+            > node_weights: (optional) integer weight of every node
+
+        RETURN:
+            > a Graph'''
+        uids = _as_uid_array(uids)
+        num_users = len(uids)
+        coaches = np.asarray(coaches, dtype=np.int64)
+        students = np.asarray(students, dtype=np.int64)
+        # a node can't be connected to itself
+        not_loop = coaches != students
+        coaches = coaches[not_loop]
+        students = students[not_loop]
+
+        # store every relationship in both directions
+        rows = np.concatenate((coaches, students))
+        cols = np.concatenate((students, coaches))
+        kinds = np.concatenate((np.full(len(students), STUDENT, np.int8),
+                                np.full(len(coaches), COACH, np.int8)))
+
+        # sort by row then column, carrying the kind along in the lowest bits
+        keys = (rows * num_users + cols) * 4 + kinds
+        if weights is None:
+            keys = np.sort(keys)
+        else:
+            weights = np.asarray(weights, dtype=np.int64)[not_loop]
+            order = np.argsort(keys)
+            keys = keys[order]
+            weights = np.concatenate((weights, weights))[order]
+        kinds = (keys & 3).astype(np.int8)
+        keys >>= 2
+        # merge duplicate entries, e.g. when two users coach each other
+        is_first = np.ones(len(keys), dtype=bool)
+        is_first[1:] = keys[1:] != keys[:-1]
+        starts = np.flatnonzero(is_first)
+        if len(starts):
+            kinds = np.bitwise_or.reduceat(kinds, starts)
+            if weights is not None:
+                weights = np.add.reduceat(weights, starts)
+        keys = keys[starts]
+
+        index_dtype = _index_dtype(num_users)
+        indices = (keys % num_users).astype(index_dtype) if num_users else \
+            np.zeros(0, dtype=index_dtype)
+        counts = np.bincount(keys // num_users, minlength=num_users) \
+            if num_users else np.zeros(0, dtype=np.int64)
+        indptr = np.zeros(num_users + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return cls(uids, indptr, indices, kinds, weights, node_weights)
+
+    @classmethod
+    def from_users(cls, users):
+        '''Build a graph from User objects
+
+        INPUT:
+            > users: iterable of User objects.  All students and coaches of
+                     these users must be included as well.
+
+        RETURN:
+            > a Graph'''
+        users = list(users)
+        user_index = {user: index for index, user in enumerate(users)}
+        coaches = []
+        students = []
+        for index, user in enumerate(users):
+            for student in user.get_students():
+                coaches.append(index)
+                students.append(user_index[student])
+        return cls.from_edges([user.get_uid() for user in users], coaches,
+                              students)
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __getitem__(self, uid):
+        return UserView(self, self.index_of(uid))
+
+    def __contains__(self, uid):
+        return uid in self.get_uid_index()
+
+    def __iter__(self):
+        return iter(self.uids.tolist())
+
+    def keys(self):
+        return self.uids.tolist()
+
+    def values(self):
+        return [UserView(self, index) for index in range(len(self))]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    @property
+    def num_edges(self):
+        '''number of connected pairs of users'''
+        return len(self.indices) // 2
+
+    @property
+    def nbytes(self):
+        '''memory used by the graph's arrays'''
+        return sum(array.nbytes for array in (self.uids, self.indptr,
+                                              self.indices, self.kinds,
+                                              self.edge_weights,
+                                              self.node_weights)
+                   if array is not None)
+
+    def fingerprint(self):
+        '''hash of the uids and relationships, which tells whether two
+        graphs (e.g. loaded on different runs) are the same'''
+        digest = hashlib.sha1()
+        if self.uids.dtype.kind in 'iu':
+            digest.update(self.uids.astype(np.int64).tobytes())
+        else:
+            digest.update(repr(self.uids.tolist()).encode())
+        for array in (self.indptr, self.indices, self.kinds):
+            digest.update(np.asarray(array, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def with_weights(self, edge_weights=None, node_weights=None):
+        '''the same graph (sharing its arrays) with the given weights'''
+        return Graph(self.uids, self.indptr, self.indices, self.kinds,
+                     edge_weights, node_weights)
+
+    def get_edge_weights(self):
+        '''weight of every entry of indices (all 1 if not weighted)'''
+        if self.edge_weights is None:
+            return np.ones(len(self.indices), dtype=np.int64)
+        return self.edge_weights
+
+    def get_node_weights(self):
+        '''weight of every node (all 1 if not weighted)'''
+        if self.node_weights is None:
+            return np.ones(len(self), dtype=np.int64)
+        return self.node_weights
+
+    def total_weight(self):
+        '''total weight of the nodes (the number of users if not
+        weighted)'''
+        if self.node_weights is None:
+            return len(self)
+        return int(self.node_weights.sum())
+
+    def attribute_weights(self, attributes, same_weight=2, other_weight=1):
+        '''Edge weights preferring to keep users with the same attribute
+        (e.g. zip code) in the same group
+
+        INPUT:
+            > attributes: array with the attribute of every node
+            > same_weight: weight of relationships between users with the
+                           same attribute
+            > other_weight: weight of the other relationships
+
+        RETURN:
+            > edge weights, to give to with_weights'''
+        attributes = np.asarray(attributes)
+        same = attributes[self.edge_sources()] == attributes[self.indices]
+        return np.where(same, same_weight, other_weight).astype(np.int64)
+
+    def degrees(self):
+        '''number of connections of every node'''
+        return np.diff(self.indptr)
+
+    def neighbors(self, index):
+        '''node indices of all students and coaches of node index'''
+        return self.indices[self.indptr[index]:self.indptr[index + 1]]
+
+    def students(self, index):
+        '''node indices of the students of node index'''
+        return self._neighbors_of_kind(index, STUDENT)
+
+    def coaches(self, index):
+        '''node indices of the coaches of node index'''
+        return self._neighbors_of_kind(index, COACH)
+
+    def _neighbors_of_kind(self, index, kind):
+        start, end = self.indptr[index], self.indptr[index + 1]
+        return self.indices[start:end][(self.kinds[start:end] & kind) > 0]
+
+    def edge_sources(self):
+        '''the node each entry of indices belongs to'''
+        return np.repeat(np.arange(len(self), dtype=self.indices.dtype),
+                         self.degrees())
+
+    def index_of(self, uid):
+        '''node index of the user with the given uid'''
+        return self.get_uid_index().index_of(uid)
+
+    def indices_of(self, uids):
+        '''node indices of an array of uids (-1 for those not in the
+        graph)'''
+        return self.get_uid_index().indices_of(uids)
+
+    def get_uid(self, index):
+        '''uid of node index as a plain Python object'''
+        return self.uids[index:index + 1].tolist()[0]
+
+    def get_uids(self, nodes):
+        '''set of uids for the given node indices or boolean node mask'''
+        return set(self.uids[nodes].tolist())
+
+    def subgraph(self, nodes):
+        '''Graph induced by the given node indices, renumbered in the order
+        they're given'''
+        nodes = np.asarray(nodes, dtype=np.int64)
+        new_index = np.full(len(self), -1, dtype=np.int64)
+        new_index[nodes] = np.arange(len(nodes))
+        positions, counts = _row_positions(self.indptr, nodes)
+        rows = np.repeat(np.arange(len(nodes)), counts)
+        cols = new_index[self.indices[positions]]
+        keep = cols >= 0
+        # the rows are in order already, but the renumbered columns may not be
+        order = np.lexsort((cols[keep], rows[keep]))
+        positions = positions[keep][order]
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=len(nodes)),
+                  out=indptr[1:])
+        return Graph(self.uids[nodes], indptr,
+                     cols[keep][order].astype(_index_dtype(len(nodes))),
+                     self.kinds[positions],
+                     None if self.edge_weights is None else
+                     self.edge_weights[positions],
+                     None if self.node_weights is None else
+                     self.node_weights[nodes])
+
+    def get_uid_index(self):
+        '''the UidIndex of the graph's uids, made the first time it's
+        needed'''
+        if self._uid_index is None:
+            self._uid_index = UidIndex(self.uids)
+        return self._uid_index
+
+
+class UidIndex:
+    '''Maps uids to dense node indices 0..N-1, where uids[i] is the uid of
+    node i
+
+    Integer uids are looked up all at once by binary search in a sorted
+    copy of them, so no dictionary with a Python object per user is made
+    (which takes more memory than the whole Graph).  Other uids, which
+    can't always be sorted (e.g. a mix of numbers and strings), use a
+    dictionary.  Every Graph has its own, so any number of graphs can have
+    users with the same uids.'''
+
+    def __init__(self, uids):
+        self.uids = uids
+        self._order = None
+        self._sorted_uids = None
+        self._node_of = None
+        if uids.dtype.kind not in 'iu':
+            self._node_of = {uid: node for node, uid
+                             in enumerate(uids.tolist())}
+        else:
+            self._order = np.argsort(uids, kind='stable')
+            self._sorted_uids = uids[self._order]
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __contains__(self, uid):
+        return self.indices_of([uid])[0] >= 0
+
+    def index_of(self, uid):
+        '''node index of uid, which raises a KeyError if it's missing'''
+        node = int(self.indices_of([uid])[0])
+        if node < 0:
+            raise KeyError(uid)
+        return node
+
+    def indices_of(self, uids):
+        '''node indices of a sequence of uids (-1 for missing ones)'''
+        if self._node_of is not None:
+            if isinstance(uids, np.ndarray):
+                uids = uids.tolist()
+            return np.array([self._node_of.get(uid, -1) for uid in uids],
+                            dtype=np.int64)
+        uids = _as_uid_array(uids)
+        nodes = np.full(len(uids), -1, dtype=np.int64)
+        if uids.dtype == object:
+            # only the integers can be uids of this graph
+            is_int = np.array([_is_int64(uid) for uid in uids.tolist()],
+                              dtype=bool)
+            nodes[is_int] = self.indices_of(uids[is_int].astype(np.int64))
+            return nodes
+        if uids.dtype.kind not in 'iu' or not len(self._sorted_uids) or \
+                not len(uids):
+            return nodes
+        positions = np.minimum(np.searchsorted(self._sorted_uids, uids),
+                               len(self._sorted_uids) - 1)
+        found = self._sorted_uids[positions] == uids
+        nodes[found] = self._order[positions[found]]
+        return nodes
+
+    def mask_of(self, uids):
+        '''boolean array telling which nodes have one of the given uids'''
+        nodes = self.indices_of(uids)
+        mask = np.zeros(len(self), dtype=bool)
+        mask[nodes[nodes >= 0]] = True
+        return mask
+
+
+class UserView(User):
+    '''Read-only User backed by a node of a Graph'''
+
+    def __init__(self, graph, index):
+        self._graph = graph
+        self._index = index
+
+    def __eq__(self, other):
+        return (isinstance(other, UserView) and self._graph is other._graph
+                and self._index == other._index)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._graph), self._index))
+
+    def add_students(self, students):
+        raise RuntimeError("Users of a Graph are read-only.")
+
+    def add_coaches(self, coaches):
+        raise RuntimeError("Users of a Graph are read-only.")
+
+    def get_students(self):
+        return set(UserView(self._graph, index)
+                   for index in self._graph.students(self._index).tolist())
+
+    def get_coaches(self):
+        return set(UserView(self._graph, index)
+                   for index in self._graph.coaches(self._index).tolist())
+
+    def get_uid(self):
+        return self._graph.get_uid(self._index)
+
+    def get_graph(self):
+        return self._graph
+
+    def get_index(self):
+        return self._index
+
+
+def _index_dtype(num_users):
+    '''smallest integer type that can hold a node index'''
+    if num_users < np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+
+def _row_positions(indptr, nodes):
+    '''positions in the indices of a CSR graph of every entry of the rows
+    of the given nodes, in order, and the number of entries of each row'''
+    starts = indptr[nodes]
+    counts = indptr[nodes + 1] - starts
+    positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + \
+        np.arange(counts.sum())
+    return positions, counts
+
+
+def _is_int64(uid):
+    '''True if uid is an integer (of Python or NumPy) which fits in an
+    int64'''
+    return isinstance(uid, numbers.Integral) and \
+        not isinstance(uid, bool) and _INT64_MIN <= uid <= _INT64_MAX
+
+
+def _as_uid_array(uids):
+    '''integer uids are stored compactly, anything else as Python objects'''
+    if isinstance(uids, np.ndarray):
+        return uids
+    uids = list(uids)
+    if all(_is_int64(uid) for uid in uids):
+        return np.array(uids, dtype=np.int64)
+    uid_array = np.empty(len(uids), dtype=object)
+    uid_array[:] = uids
+    return uid_array
@@ -7,29 +7,44 @@
 from __future__ import print_function
 import numpy as np
 from user import User
-from copy import deepcopy
+from graph import Graph, UserView, _row_positions, _is_int64
+from components import label_components
+from profiling import span
+from time import time
+import heapq
 
 
-def total_infection(user):
+def total_infection(user, component_lookup=None):
     '''Infect all users of the connected component which user is a part of
 
     INPUT:
-        > user:  a User object
+        > user:  a User object (or a UserView of a Graph)
+        > component_lookup: (optional) components.ComponentLookup of the
+                    users.  If given, the component isn't searched for, and
+                    the answer (a frozenset) may come from its cache.
     RETURN:
         > set of user IDs for the users in the connected component.
     '''
     assert(isinstance(user, User))
+    if component_lookup is not None:
+        return component_lookup.member_set(
+            component_lookup.component_of(user.get_uid()))
+    if isinstance(user, UserView):
+        graph = user.get_graph()
+        return graph.get_uids(_component_nodes(graph, user.get_index()))
     # the set of infected users so far
     infected_users = set((user,))
-    # recursively infect all coaches and students
+    # infect all coaches and students, and their coaches and students, etc.
     _infect_coaches_students(user, infected_users)
     return set((user.get_uid() for user in infected_users))
 
 
 def _infect_coaches_students(user, infected_users):
-    '''Infect all coaches and students of the user and recursively infect
-    their coaches and stuents, etc. until entire connected component is
-    infected.
+    '''Infect all coaches and students of the user and their coaches and
+    stuents, etc. until entire connected component is infected.
+
+    We keep our own stack of users to visit rather than recursing, so long
+    chains of coaches don't hit Python's recursion limit.
 
     INPUT:
         > user: User object
@@ -38,20 +53,53 @@ def _infect_coaches_students(user, infected_users):
     RETURN:
         > infected_users: set of User objects
     '''
-    # infect the students and coaches of this user who aren't already infected
-    for user_to_infect in (user.get_students() | user.get_coaches()
-                           - infected_users):
-        # due to the fact the graph can be cyclic, a user may have gotten
-        # infected since starting the for loop, so we double check
-        if user_to_infect in infected_users:
-            continue
-        infected_users.add(user_to_infect)
-        _infect_coaches_students(user_to_infect, infected_users)
+    to_visit = [user]
+    while to_visit:
+        user = to_visit.pop()
+        # infect the students and coaches of this user who aren't already
+        # infected
+        for user_to_infect in (user.get_students() | user.get_coaches()):
+            if user_to_infect in infected_users:
+                continue
+            infected_users.add(user_to_infect)
+            to_visit.append(user_to_infect)
 
     return infected_users
 
 
-def limited_infection(all_users, num_to_infect, tol=0, verbose=False):
+def _component_nodes(graph, start, visited=None):
+    '''Node indices of the connected component of graph containing node start
+
+    The component is found breadth first, one whole frontier at a time: the
+    neighbors of a frontier are gathered from the graph's arrays at once.
+
+    INPUT:
+        > graph: Graph object
+        > start: node index of the first infected user
+        > visited: (optional) boolean array over all nodes, which is updated
+                   in place.  Pass the same array to repeated calls to avoid
+                   allocating a new one each time.
+
+    RETURN:
+        > sorted array of the node indices in the connected component'''
+    if visited is None:
+        visited = np.zeros(len(graph), dtype=bool)
+    visited[start] = True
+    frontier = np.array([start], dtype=np.int64)
+    component = [frontier]
+    while len(frontier):
+        neighbors = graph.indices[_row_positions(graph.indptr,
+                                                 frontier)[0]]
+        frontier = np.unique(neighbors[~visited[neighbors]])
+        visited[frontier] = True
+        component.append(frontier)
+    return np.sort(np.concatenate(component))
+
+
+def limited_infection(all_users, num_to_infect, tol=0, verbose=False,
+                      component_index=None, method='kl', previous=None,
+                      workers=1, observer=None, starts=1, seed=None,
+                      time_limit=None, initial='first'):
     '''Find a subset of all_users while minimizing coach-student 'conflicts'
 
     By 'conflicts', we mean when only one party of a student-coach relationship
@@ -59,7 +107,11 @@ def limited_infection(all_users, num_to_infect, tol=0, verbose=False):
 
     INPUT:
         > all_users: A dictionary with UID as keys and the corresponding User
-                    objects as values.
+                    objects as values, or a Graph.  If the Graph has edge
+                    weights, the weight of the relationships between groups
+                    is minimized, and if it has node weights, num_to_infect
+                    and tolerance are weights of users (e.g. traffic) rather
+                    than numbers of users.
         > num_to_infected: (int or float) If integer, that is the number of
                         people who will be infected.  If float, then it must be
                         between 0 and 1 and represents the proportion of
@@ -69,70 +121,72 @@ def limited_infection(all_users, num_to_infect, tol=0, verbose=False):
                     find a subset without conflicts.  If it is a float, it'll
                     be interpreted as a proportion of the total population.
                     (ignored if perfect_only is True)
+        > component_index: (optional) ComponentIndex of all_users.  If given,
+                    the connected components are taken from it instead of
+                    being searched for again.
+        > method: algorithm used to split a connected component when
+                    needed, one of PARTITIONERS ('kl' for Kernighan-Lin,
+                    'fm' for Fiduccia-Mattheyses, which is much faster on
+                    large components, or 'multilevel' for huge ones)
+        > previous: (optional) set of UIDs which are already infected, e.g.
+                    from the last stage of a rollout.  They're kept infected
+                    when growing to num_to_infect and only uninfected when
+                    shrinking to it, by adding or removing whole components
+                    first, then by moving users of a component which is
+                    already split.  UIDs not in all_users are ignored.
+        > workers: number of processes used to label the components and
+                    split them.  The result is the same for any number.
+        > observer: (optional) a profiling.Profiler (or anything with the
+                    same methods) which is told how long each phase took
+                    ('components', 'selection', 'split', ...), the component
+                    sizes, and what the partitioner did
+        > starts, seed, time_limit: if seed is given, a component is split
+                    from up to starts random starts, see _multi_start_split.
+                    The seed of the best one is told to the observer
+                    ('split_seed').  Otherwise a component is split once,
+                    starting from its first users.
+        > initial: how a split starts when there's no seed, one of
+                    INITIAL_SPLITS: 'first' infects the first users of the
+                    component, 'grow' grows a region from a user with few
+                    relationships (see _grow)
 
     RETURN:
         > a set of UIDs of the infected people'''
 
-    # while searching for an exact match, we "cure" whole connected components
-    # and we want to make sure not to reconsider users who have ever been
-    # infected
-    users_ever_infected = set()
+    comps = _Components(all_users, component_index, workers, observer)
+    uids, comp_labels, comp_counts = comps.uids, comps.labels, comps.counts
+    node_weights, num_users = comps.node_weights, comps.num_users
+    num_to_infect = comps.num_to_infect(num_to_infect)
+    tol = comps.num_users_of(tol, 'tolerance')
 
-    if isinstance(num_to_infect, float):
-        if 0.0 <= num_to_infect and num_to_infect <= 1.0:
-            num_to_infect = int(num_to_infect * len(all_users))
-        else:
-            print("Error: the number of infected users was a float and not "
-                  "between 0.0 and 1.0.  Make sure it's an integer.")
-            raise RuntimeError
-    if isinstance(tol, float):
-        if 0.0 <= tol and tol <= 1.0:
-            tol = int(tol * len(all_users))
-        else:
-            print("Error: the tolerance was a float and not "
-                  "between 0.0 and 1.0.  Make sure it's an integer.")
-            raise RuntimeError
-    if num_to_infect > len(all_users):
-        raise RuntimeError("You're trying to infect", num_to_infect, "users, "
-                           "when you only have", len(all_users), "users.")
-    if num_to_infect < 0:
-        raise RuntimeError("You must infect a positive number of users.")
-
-    # number of users in each connected component
-    comp_counts = []
-    # the uids for each connected component
-    comp_uids = []
-
-    # get all connected components and the number users in each one
-    for uid, user in all_users.items():
-        if uid in users_ever_infected:
-            continue
+    # infected users so far, which is nobody unless we're continuing a rollout
+    infected = np.zeros(len(uids), dtype=bool) if previous is None else \
+        _uid_mask(uids, set(previous))
+    num_infected = _total_weight(infected, node_weights)
+    if previous is not None and ((num_to_infect - tol) <= num_infected and
+            num_infected <= (num_to_infect + tol)):
+        return set(uids[infected].tolist())
+    # shrinking the infected group is growing the uninfected one, so flip
+    # the groups around and grow
+    flipped = num_infected > num_to_infect
+    if flipped:
+        infected = ~infected
+        num_infected = num_users - num_infected
+        num_to_infect = num_users - num_to_infect
 
-        newly_infected_uids = total_infection(user)
-        num_newly_infected = len(newly_infected_uids)
+    # number of users of each component we could still infect
+    comp_infected = np.bincount(comp_labels, weights=infected if
+                                node_weights is None else
+                                infected * node_weights,
+                                minlength=len(comp_counts)).astype(np.int64)
+    comp_room = comp_counts - comp_infected
 
-        users_ever_infected.update(newly_infected_uids)
-        comp_uids.append(newly_infected_uids)
-        comp_counts.append(num_newly_infected)
+    with span(observer, 'selection'):
+        comps_to_keep, num_infected, smallest_uninfected_comp = \
+            _choose_components(comp_room, num_to_infect, num_infected, tol,
+                               observer)
 
-    # sort the connected components from largest to smallest
-    sorted_ind = np.argsort(comp_counts)
-    reverse_ind = sorted_ind[::-1]
-    comp_counts = [comp_counts[ind] for ind in reverse_ind]
-    comp_uids = [comp_uids[ind] for ind in reverse_ind]
-
-    # add components one at a time as long as the total doesn't overshoot
-    num_infected = 0
-    comps_to_keep = []
-    smallest_uninfected_comp = -1
-    for comp_i, comp_count in enumerate(comp_counts):
-        if num_infected + comp_count > num_to_infect:
-            smallest_uninfected_comp = comp_i  # (we use this later on)
-            continue
-        num_infected += comp_count
-        comps_to_keep.append(comp_i)
-
-    infected_uids = set.union(*(comp_uids[comp_i] for comp_i in comps_to_keep))
+    infected |= comps_to_keep[comp_labels]
 
     # if we're lucky, we got an exact split, otherwise, we'll have to break
     # up a connected component
@@ -141,162 +195,1648 @@ def limited_infection(all_users, num_to_infect, tol=0, verbose=False):
         if verbose:
             print("A split without any coflicts was found!")
     else:
-        # we already know the smallest uninfected component is larger than we
-        # need so we only need to split that one
-        smallest_comp_users = [all_users[user_i]
-                               for user_i
-                               in comp_uids[smallest_uninfected_comp]]
+        # every component left has more room than we need, so we only need
+        # to split one.  A component which is already split is moved from
+        # its current split, otherwise we split the smallest one.
+        already_split = np.flatnonzero(~comps_to_keep & (comp_room > 0) &
+                                       (comp_infected > 0))
+        if len(already_split):
+            comp_to_split = already_split[np.argmin(comp_room[already_split])]
+        else:
+            comp_to_split = smallest_uninfected_comp
+        with span(observer, 'subgraph'):
+            comp_nodes = np.flatnonzero(comp_labels == comp_to_split)
+            comp_graph = comps.subgraph(comp_nodes)
+        start_split = infected[comp_nodes] if len(already_split) else None
         # number of users left to infect
         remaining_to_infect = num_to_infect - num_infected
-        extra_infected_users = _split_component(smallest_comp_users,
-                                                remaining_to_infect)
+        with span(observer, 'split'):
+            infected[comp_nodes], = _split_graphs([(comp_graph,
+                                                    remaining_to_infect,
+                                                    start_split)],
+                                                  method=method,
+                                                  workers=workers,
+                                                  observer=observer,
+                                                  starts=starts, seed=seed,
+                                                  time_limit=time_limit,
+                                                  initial=initial)
         if verbose:
             # report number of conflicting relationships
-            num_conflicts = 0
-            for user in smallest_comp_users:
-                num_conflicts += _find_num_conflicts(user,
-                                                     extra_infected_users)
+            num_conflicts, _, _ = evaluate_split(comp_graph,
+                                                 infected[comp_nodes])
             print("The number of conflicting relationships is: ",
                   num_conflicts)
 
-        infected_uids.update(extra_infected_users)
+    if flipped:
+        infected = ~infected
+    return set(uids[infected].tolist())
+
+
+def limited_infection_groups(all_users, group_sizes, tol=0, verbose=False,
+                             component_index=None, method='kl', workers=1,
+                             observer=None):
+    '''Split all_users into several groups (e.g. the arms of an A/B/C test)
+    of given sizes while minimizing the relationships between groups
+
+    This is limited_infection for k groups at once.  The components are
+    found once, then whole components are put in every group but the last,
+    one group at a time, the same way limited_infection picks them.  The
+    last group gets the components left over.  Groups which are still short
+    take users from a left over component, sharing one component between
+    them when it's big enough, so usually only one component is split.  A
+    split component is carved into its groups one group at a time with the
+    method, then every pair of its groups is refined with
+    Fiduccia-Mattheyses.  Moving users between two groups doesn't change
+    which of their relationships to the other groups are cut, so that
+    refines the k-way split with incremental gains.
+
+    INPUT:
+        > all_users: A dictionary with UID as keys and the corresponding User
+                    objects as values, or a Graph (with weights, see
+                    limited_infection)
+        > group_sizes: list with the size of every group.  If they're
+                    integers they're numbers of users, and must add up to
+                    the number of users.  If floats, they're relative sizes,
+                    e.g. [40., 30., 30.] or [0.4, 0.3, 0.3].
+        > tolerance: (int or float) The tolerance in number of users of each
+                    group but the last, which gets the rest.  If it is a
+                    float, it'll be interpreted as a proportion of the total
+                    population.
+        > component_index, method, workers, observer: see limited_infection
+
+    RETURN:
+        > a list with a set of UIDs for every group'''
+    comps = _Components(all_users, component_index, workers, observer)
+    uids, comp_labels, comp_counts = comps.uids, comps.labels, comps.counts
+    node_weights, num_users = comps.node_weights, comps.num_users
+    tol = comps.num_users_of(tol, 'tolerance')
+
+    if all(isinstance(size, (int, np.integer)) for size in group_sizes):
+        targets = np.array(group_sizes, dtype=np.int64)
+        if targets.sum() != num_users or (targets < 0).any():
+            raise RuntimeError("The groups have", int(targets.sum()), "users "
+                               "in total, instead of", num_users, "users.")
+    else:
+        proportions = np.array(group_sizes, dtype=float)
+        if (proportions < 0).any() or proportions.sum() <= 0:
+            raise RuntimeError("The sizes of the groups must be positive.")
+        ends = np.round(np.cumsum(proportions) / proportions.sum() *
+                        num_users).astype(np.int64)
+        targets = np.diff(np.concatenate(([0], ends)))
+    num_groups = len(targets)
+
+    # the group of every component, which is the last group unless it's
+    # picked for another one
+    comp_groups = np.full(len(comp_counts), num_groups - 1, dtype=np.int64)
+    deficits = np.zeros(num_groups, dtype=np.int64)
+    with span(observer, 'selection'):
+        for group in range(num_groups - 1):
+            comp_room = np.where(comp_groups == num_groups - 1, comp_counts,
+                                 0)
+            comps_to_keep, num_in_group, _ = _choose_components(
+                comp_room, int(targets[group]), 0, tol, observer)
+            comps_to_keep &= comp_room > 0
+            comp_groups[comps_to_keep] = group
+            num_in_group = int(comp_counts[comps_to_keep].sum())
+            if num_in_group < targets[group] - tol:
+                deficits[group] = targets[group] - num_in_group
+
+    # number of users every split component gives to each group, the rest
+    # stay in the last group
+    quotas = {}
+    left_over = np.flatnonzero(comp_groups == num_groups - 1)
+    room = comp_counts.copy()
+    for group in np.argsort(-deficits, kind='stable').tolist():
+        deficit = int(deficits[group])
+        while deficit > 0:
+            # a component split already, or the smallest one with room, or
+            # failing that, the one with the most room
+            candidates = left_over[room[left_over] >= deficit]
+            split_already = candidates[np.isin(candidates, list(quotas))]
+            if len(split_already):
+                comp = split_already[np.argmin(room[split_already])]
+            elif len(candidates):
+                comp = candidates[np.argmin(room[candidates])]
+            else:
+                comp = left_over[np.argmax(room[left_over])]
+            quota = min(deficit, int(room[comp]))
+            quotas.setdefault(int(comp), []).append((group, quota))
+            room[comp] -= quota
+            deficit -= quota
+
+    groups = comp_groups[comp_labels]
+    for comp, comp_quotas in sorted(quotas.items()):
+        with span(observer, 'subgraph'):
+            comp_nodes = np.flatnonzero(comp_labels == comp)
+            comp_graph = comps.subgraph(comp_nodes)
+        if verbose:
+            print("Splitting a component of", len(comp_nodes), "users "
+                  "between", len(comp_quotas) + 1, "groups")
+        with span(observer, 'split'):
+            groups[comp_nodes] = _split_groups(comp_graph, comp_quotas,
+                                               num_groups - 1, method,
+                                               observer=observer)
+
+    if verbose:
+        graph = comps.graph if comps.graph is not None else \
+            _as_graph(all_users)
+        num_conflicts, _, _ = evaluate_split(graph, groups, comp_labels)
+        print("The groups have", [_total_weight(groups == group,
+                                                node_weights)
+                                  for group in range(num_groups)],
+              "users, with", num_conflicts, "relationships between them.")
+    return [set(uids[groups == group].tolist())
+            for group in range(num_groups)]
+
+
+def infection_sweep(all_users, targets, tol=0, method='kl',
+                    component_index=None, workers=1, return_uids=False,
+                    observer=None, max_work=None):
+    '''limited_infection for many numbers to infect at once, e.g. to plan
+    the stages of a rollout
+
+    The components are found, and the table of the totals whole components
+    can add up to is made, only once for every target (unless the table
+    would be too big, see _select_components).  Targets which whole
+    components can't reach split one component each, like
+    limited_infection, and those splits run in a pool of worker processes
+    if there are several workers.
+
+    INPUT:
+        > all_users: A dictionary with UID as keys and the corresponding User
+                    objects as values, or a Graph
+        > targets: list of numbers to infect, each an integer number of
+                   users or a float proportion, as for limited_infection
+        > tol, method, component_index, workers: see limited_infection
+        > return_uids: also return the set of infected UIDs of each target
+        > observer: (optional) see limited_infection
+        > max_work: see _select_components (SUBSET_SUM_MAX_WORK if None)
+
+    RETURN:
+        > a list with a dictionary for every target, with the
+          'num_to_infect', the 'num_infected', the number of relationships
+          between groups ('cut'), and if return_uids is True, the set of
+          infected UIDs ('uids')'''
+    comps = _Components(all_users, component_index, workers, observer)
+    uids, comp_labels, comp_counts = comps.uids, comps.labels, comps.counts
+    targets = [comps.num_to_infect(target) for target in targets]
+    tol = comps.num_users_of(tol, 'tolerance')
+
+    if max_work is None:
+        max_work = SUBSET_SUM_MAX_WORK
+
+    with span(observer, 'selection'):
+        sizes, size_counts = np.unique(comp_counts, return_counts=True)
+        num_chunks = int(np.sum(np.floor(np.log2(size_counts)) + 1))
+        max_total = max(targets) + tol if targets else 0
+        table = _subset_sum_table(sizes, size_counts, max_total) \
+            if num_chunks * (max_total + 1) <= max_work else None
+        choices = []
+        for target in targets:
+            total = None if table is None else \
+                _closest_total(table, target, tol)
+            if total is not None:
+                comps_to_keep = _comps_of_sizes(
+                    comp_counts, sizes, size_counts,
+                    _num_taken(table, total, len(sizes)))
+                choices.append((comps_to_keep, total, -1))
+            else:
+                choices.append(_choose_components(
+                    comp_counts, target, 0, tol, observer,
+                    subset_sum=table is None))
+
+    # split a component for every target which whole components miss
+    tasks = []
+    task_targets = []
+    for target_i, (target, (_, num_infected, comp_to_split)) \
+            in enumerate(zip(targets, choices)):
+        if abs(num_infected - target) <= tol:
+            continue
+        comp_nodes = np.flatnonzero(comp_labels == comp_to_split)
+        tasks.append((comps.subgraph(comp_nodes), target - num_infected, None))
+        task_targets.append((target_i, comp_nodes))
+    with span(observer, 'split'):
+        splits = _split_graphs(tasks, method=method, workers=workers,
+                               observer=observer)
+
+    results = [{'num_to_infect': target, 'num_infected': num_infected,
+                'cut': 0}
+               for target, (_, num_infected, _) in zip(targets, choices)]
+    for (target_i, comp_nodes), (comp_graph, _, _), split in \
+            zip(task_targets, tasks, splits):
+        results[target_i]['num_infected'] += _total_weight(
+            split, comp_graph.node_weights)
+        results[target_i]['cut'] = evaluate_split(
+            comp_graph, split, np.zeros(len(comp_graph), dtype=np.int64))[0]
+    if return_uids:
+        split_of = dict((target_i, (comp_nodes, split)) for
+                        (target_i, comp_nodes), split in
+                        zip(task_targets, splits))
+        for target_i, (comps_to_keep, _, _) in enumerate(choices):
+            infected = comps_to_keep[comp_labels]
+            if target_i in split_of:
+                comp_nodes, split = split_of[target_i]
+                infected[comp_nodes] = split
+            results[target_i]['uids'] = set(uids[infected].tolist())
+    return results
+
+
+def _split_groups(graph, quotas, rest_group, method='kl', max_iter=10000,
+                  max_rounds=10, observer=None):
+    '''Split a component between groups
+
+    INPUT:
+        > graph: Graph of the component
+        > quotas: list of (group, number of users) pairs
+        > rest_group: group of the users left over
+        > method: one of PARTITIONERS, for carving out each group
+        > max_iter: maximum number of passes of every refinement
+        > max_rounds: maximum number of times every pair of groups is
+                      refined
+
+    RETURN:
+        > groups: array with the group of every user'''
+    groups = np.full(len(graph), rest_group, dtype=np.int64)
+    for group, quota in quotas:
+        rest = np.flatnonzero(groups == rest_group)
+        split = _split_graph(graph.subgraph(rest), quota, max_iter, method,
+                             observer=observer)
+        groups[rest[split]] = group
+
+    pairs = [(group_1, group_2) for group_1 in sorted(set(groups.tolist()))
+             for group_2 in sorted(set(groups.tolist())) if group_1 < group_2]
+    comp_labels = np.zeros(len(graph), dtype=np.int64)
+    for _ in range(max_rounds):
+        cut = evaluate_split(graph, groups, comp_labels)[0]
+        for group_1, group_2 in pairs:
+            nodes = np.flatnonzero((groups == group_1) | (groups == group_2))
+            pair_graph = graph.subgraph(nodes)
+            in_group_1 = _fiduccia_mattheyses(pair_graph,
+                                              groups[nodes] == group_1,
+                                              max_iter, observer=observer)
+            groups[nodes] = np.where(in_group_1, group_1, group_2)
+        if evaluate_split(graph, groups, comp_labels)[0] >= cut:
+            break
+    return groups
+
+
+def evaluate_split(graph, infected, comp_labels=None):
+    '''Measure how good a split is, with array operations over every
+    relationship at once
+
+    INPUT:
+        > graph: Graph of the users
+        > infected: boolean array telling which users are infected (or an
+                    array with the group of every user, see
+                    limited_infection_groups)
+        > comp_labels: (optional) component number of every user, as given
+                       by components.label_components.  They're found if
+                       not given.
+
+    RETURN:
+        > num_conflicts: number of relationships between an infected and an
+                         uninfected user (the cut), or their total weight
+                         if the graph has edge weights
+        > comp_conflicts: array with the number (or weight) of those in each
+                          component
+        > boundary: boolean array telling which users have a relationship
+                    with a user of the other group'''
+    if comp_labels is None:
+        comp_labels, _ = label_components(graph)
+    sources = graph.edge_sources()
+    # every relationship is stored in both directions, so is counted twice
+    between_groups = infected[sources] != infected[graph.indices]
+    conflict_sources = sources[between_groups]
+    boundary = np.zeros(len(graph), dtype=bool)
+    boundary[conflict_sources] = True
+    num_comps = int(comp_labels.max()) + 1 if len(comp_labels) else 0
+    if graph.edge_weights is None:
+        comp_conflicts = np.bincount(comp_labels[conflict_sources],
+                                     minlength=num_comps) // 2
+        return len(conflict_sources) // 2, comp_conflicts, boundary
+    conflict_weights = graph.edge_weights[between_groups]
+    comp_conflicts = np.bincount(comp_labels[conflict_sources],
+                                 weights=conflict_weights,
+                                 minlength=num_comps).astype(np.int64) // 2
+    return int(conflict_weights.sum()) // 2, comp_conflicts, boundary
+
 
-    return infected_uids
+class _Components:
+    '''The connected components of the users of limited_infection,
+    limited_infection_groups or infection_sweep, found once (or taken from
+    a ComponentIndex).  With node weights, the users are counted by weight:
+    counts has the weight of every component and num_users the total.'''
 
+    def __init__(self, all_users, component_index=None, workers=1,
+                 observer=None):
+        self._all_users = all_users
+        self.graph = None
+        with span(observer, 'components'):
+            if component_index is None:
+                self.graph = _as_graph(all_users)
+                # label the connected component of every user, and count
+                # the number of users in each one
+                self.labels, self.counts = label_components(self.graph,
+                                                            workers)
+                self.uids = self.graph.uids
+            else:
+                self.labels, self.counts = component_index.components()
+                self.uids = component_index.uids
+        self.num_users = len(self.uids)
+        self.node_weights = _node_weights_of(all_users, self.uids)
+        if self.node_weights is not None:
+            self.counts = np.bincount(self.labels, weights=self.node_weights,
+                                      minlength=len(self.counts)
+                                      ).astype(np.int64)
+            self.num_users = int(self.node_weights.sum())
+        if observer is not None:
+            observer.histogram('component_sizes', self.counts)
+
+    def num_users_of(self, number, name):
+        '''number (e.g. the tolerance) as a number of users, where a float
+        is a proportion of all of them'''
+        if not isinstance(number, float):
+            return number
+        if not 0.0 <= number <= 1.0:
+            raise RuntimeError("The " + name + " was a float and not "
+                               "between 0.0 and 1.0.  Make sure it's an "
+                               "integer.")
+        return int(number * self.num_users)
+
+    def num_to_infect(self, num_to_infect):
+        '''the number of users to infect, checked to be possible'''
+        num_to_infect = self.num_users_of(num_to_infect,
+                                          'number of infected users')
+        if num_to_infect > self.num_users:
+            raise RuntimeError("You're trying to infect", num_to_infect,
+                               "users, when you only have", self.num_users,
+                               "users.")
+        if num_to_infect < 0:
+            raise RuntimeError("You must infect a positive number of users.")
+        return num_to_infect
+
+    def subgraph(self, comp_nodes):
+        '''Graph of the users of a component'''
+        if self.graph is not None:
+            return self.graph.subgraph(comp_nodes)
+        return _component_graph(self._all_users, self.uids[comp_nodes])
+
+
+def _node_weights_of(users, uids):
+    '''node weights of users (if it's a Graph with node weights) in the
+    order of uids, or None'''
+    if not isinstance(users, Graph) or users.node_weights is None:
+        return None
+    if users.uids is uids or np.array_equal(users.uids, uids):
+        return users.node_weights
+    return users.node_weights[users.indices_of(uids)]
+
+
+def _total_weight(infected, node_weights):
+    '''weight of the infected users (the number of them if node_weights is
+    None)'''
+    if node_weights is None:
+        return int(infected.sum())
+    return int(node_weights[infected].sum())
+
+
+def _uid_mask(uids, uid_set):
+    '''boolean array telling which of uids are in uid_set'''
+    if uids.dtype != object and all(_is_int64(uid) for uid in uid_set):
+        return np.isin(uids, np.fromiter(uid_set, dtype=np.int64,
+                                         count=len(uid_set)))
+    return np.array([uid in uid_set for uid in uids.tolist()], dtype=bool)
+
+
+def _choose_components(comp_room, num_to_infect, num_infected, tol=0,
+                       observer=None, subset_sum=True):
+    '''Pick whole components to infect, on top of the num_infected users
+    already infected, to get within tol of num_to_infect
+
+    INPUT:
+        > comp_room: array with the number of users of each component who
+                     aren't infected yet
+        > num_to_infect: target number of infected users
+        > num_infected: number of users infected already
+        > tol: allowed difference from num_to_infect
+        > observer: (optional) see limited_infection
+        > subset_sum: look for whole components which add up to
+                      num_to_infect if the greedy pass misses (set this to
+                      False if they're known not to)
+
+    RETURN:
+        > comps_to_keep: boolean array telling which components to infect
+        > num_infected: number infected once they are
+        > smallest_uninfected_comp: smallest component skipped by the greedy
+                                    pass (only meaningful if we missed)'''
+    # sort the connected components from largest to smallest
+    with span(observer, 'sort'):
+        sorted_ind = np.argsort(comp_room)
+    reverse_ind = sorted_ind[::-1]
+
+    # add components one at a time as long as the total doesn't overshoot
+    num_already_infected = num_infected
+    comps_to_keep = np.zeros(len(comp_room), dtype=bool)
+    smallest_uninfected_comp = -1
+    for comp_i, comp_room_i in zip(reverse_ind.tolist(),
+                                   comp_room[reverse_ind].tolist()):
+        if num_infected + comp_room_i > num_to_infect:
+            smallest_uninfected_comp = comp_i
+            continue
+        num_infected += comp_room_i
+        comps_to_keep[comp_i] = True
+
+    # if that missed, look harder for whole components which add up to the
+    # number to infect
+    if subset_sum and not ((num_to_infect - tol) <= num_infected and
+                           num_infected <= (num_to_infect + tol)):
+        has_room = np.flatnonzero(comp_room)
+        with span(observer, 'subset_sum'):
+            selected_comps = _select_components(comp_room[has_room],
+                                                num_to_infect -
+                                                num_already_infected, tol)
+        if selected_comps is not None:
+            comps_to_keep[:] = False
+            comps_to_keep[has_room[selected_comps]] = True
+            num_infected = num_already_infected + \
+                int(comp_room[comps_to_keep].sum())
+
+    return comps_to_keep, num_infected, smallest_uninfected_comp
+
+
+# most bit operations the subset sum search for whole components may do
+SUBSET_SUM_MAX_WORK = 10**9
+
+
+def _select_components(comp_counts, num_to_infect, tol=0,
+                       max_work=SUBSET_SUM_MAX_WORK):
+    '''Find whole components with num_to_infect +/- tol users in total
+
+    This is the subset sum problem, which we solve with an array of the
+    totals reachable so far (a bitset), remembering which step first reached
+    each total so the components can be recovered.  Components of the same
+    size are grouped and added in chunks of 1, 2, 4, ... of them, so the work
+    grows with the number of distinct sizes rather than of components.  If
+    that would still be more than max_work, the largest components are
+    taken greedily until what's left to infect is small enough to solve
+    exactly (so we may miss a fit in that case).
+
+    INPUT:
+        > comp_counts: array with the number of users in each component
+        > num_to_infect: target number of users
+        > tol: allowed difference from num_to_infect
+        > max_work: rough limit on the number of bit operations
+
+    RETURN:
+        > boolean array telling which components to infect (closest to
+          num_to_infect first), or None if no combination fits'''
+    sizes, size_counts = np.unique(comp_counts, return_counts=True)
+    num_taken = np.zeros(len(sizes), dtype=np.int64)
 
-def _split_component(users, remaining_to_infect, max_iter=10000):
+    # the number of chunks for each size is about log2 of its count
+    num_chunks = int(np.sum(np.floor(np.log2(size_counts)) + 1))
+    remaining = num_to_infect
+    for size_i in range(len(sizes) - 1, -1, -1):
+        if num_chunks * (remaining + tol + 1) <= max_work:
+            break
+        size = int(sizes[size_i])
+        num_to_take = min(int(size_counts[size_i]), remaining // size,
+                          -(-(remaining - max_work // num_chunks) // size))
+        if num_to_take > 0:
+            num_taken[size_i] = num_to_take
+            remaining -= num_to_take * size
+
+    table = _subset_sum_table(sizes, size_counts - num_taken, remaining + tol,
+                              stop_at=remaining)
+    # the reachable total closest to what's left to infect
+    total = _closest_total(table, remaining, tol)
+    if total is None:
+        return None
+    num_taken += _num_taken(table, total, len(sizes))
+    return _comps_of_sizes(comp_counts, sizes, size_counts, num_taken)
+
+
+def _subset_sum_table(sizes, size_counts, max_total, stop_at=None):
+    '''The totals up to max_total that some components add up to, for
+    _select_components.  Components of the same size are added in chunks
+    of 1, 2, 4, ... of them.
+
+    INPUT:
+        > sizes: array of the distinct sizes of components
+        > size_counts: number of components of each size
+        > max_total: largest total to look for
+        > stop_at: (optional) stop as soon as this total is reached
+
+    RETURN:
+        > table: (reached, reached_by, chunks) where reached[t] tells if some
+                 chunks add up to t, reached_by[t] which chunk got there
+                 first, and chunks is a list of (size index, number of
+                 components, total) for every chunk'''
+    # each chunk is a number of components of one size
+    chunks = []
+    for size_i, (size, count) in enumerate(zip(sizes.tolist(),
+                                               size_counts.tolist())):
+        chunk = 1
+        while count > 0:
+            chunks.append((size_i, min(chunk, count), size * min(chunk,
+                                                                  count)))
+            count -= chunk
+            chunk *= 2
+
+    max_total = max(max_total, 0)
+    reached = np.zeros(max_total + 1, dtype=bool)
+    reached[0] = True
+    reached_by = np.full(max_total + 1, -1, dtype=np.int32)
+    for chunk_i, (_, _, chunk_total) in enumerate(chunks):
+        if chunk_total > max_total or chunk_total == 0:
+            continue
+        newly_reached = np.flatnonzero(reached[:max_total + 1 - chunk_total] &
+                                       ~reached[chunk_total:]) + chunk_total
+        reached[newly_reached] = True
+        reached_by[newly_reached] = chunk_i
+        if stop_at is not None and reached[stop_at]:
+            break
+    return reached, reached_by, chunks
+
+
+def _closest_total(table, target, tol=0):
+    '''the total of a _subset_sum_table within tol of target which is
+    closest to it, or None'''
+    reached = table[0]
+    lowest = max(target - tol, 0)
+    totals = np.flatnonzero(reached[lowest:target + tol + 1]) + lowest
+    if not len(totals):
+        return None
+    return int(totals[np.argmin(np.abs(totals - target))])
+
+
+def _num_taken(table, total, num_sizes):
+    '''number of components of each size which add up to a reached total
+    of a _subset_sum_table'''
+    _, reached_by, chunks = table
+    num_taken = np.zeros(num_sizes, dtype=np.int64)
+    while total > 0:
+        size_i, count, chunk_total = chunks[reached_by[total]]
+        num_taken[size_i] += count
+        total -= chunk_total
+    return num_taken
+
+
+def _comps_of_sizes(comp_counts, sizes, size_counts, num_taken):
+    '''boolean array with the first num_taken[i] components of size
+    sizes[i] (as given by np.unique) for every i'''
+    order = np.argsort(comp_counts, kind='stable')
+    size_of_ordered = np.searchsorted(sizes, comp_counts[order])
+    first_of_size = np.concatenate(([0], np.cumsum(size_counts)[:-1]))
+    rank = np.arange(len(order)) - first_of_size[size_of_ordered]
+    comps_to_keep = np.zeros(len(comp_counts), dtype=bool)
+    comps_to_keep[order[rank < num_taken[size_of_ordered]]] = True
+    return comps_to_keep
+
+
+# multilevel partitioning coarsens the graph until it has about this many
+# nodes
+COARSEST_SIZE = 200
+# ... and refines the split at every level with at most this many passes
+# (a third one hardly ever gains anything)
+MULTILEVEL_MAX_PASSES = 2
+
+
+def _split_component(users, remaining_to_infect, max_iter=10000,
+                     method='kl', observer=None, initial='first'):
     '''Split the graph while minimizing the number of connections between
     groups.
 
-    We will use the Kernighan-Lin alrogithm for this graph partition.  For more
-    details, see: wikipedia.org/wiki/Kernighan–Lin_algorithm.  We modify the
-    algorithm to accomodate a specified number of nodes to partition out.
-    This takes ~O(n^2 log(n)).
+    By default, we will use the Kernighan-Lin alrogithm for this graph
+    partition.  For more details, see:
+    wikipedia.org/wiki/Kernighan–Lin_algorithm.  We modify the algorithm to
+    accomodate a specified number of nodes to partition out.  Each pass
+    takes ~O(n^2), in array operations.  The Fiduccia-Mattheyses method
+    ('fm') gives similar splits with passes that take ~O(number of
+    relationships), and 'grow' grows a region without any passes at all.
     TODO: make this function reusable instead of specific to the infection
           task.
 
     INPUT:
-        > users: set or list with User objects
+        > users: set or list with User objects, or a Graph
         > remaining_to_infect: integer representing how many need to be
                                 infected
         > max_iter: maximum number of iterations of KL algorithm before
                     stopping and settling on the current solution.
+        > method: the partitioning algorithm, one of PARTITIONERS
+        > observer: (optional) a profiling.Profiler (or anything with the
+                    same methods) which is told how long the partitioning
+                    took and what the partitioner did
+        > initial: one of INITIAL_SPLITS; with 'grow', the method refines
+                   the region grown by _grow instead of starting from the
+                   first users
 
     RETURN:
         > infected_uids: set of uids of infected users'''
 
-    users = set(users)
+    if isinstance(users, Graph):
+        graph = users
+    else:
+        graph = Graph.from_users(set(users))
 
-    def _get_D_value(user, infected_set):
-        '''see the Wikipage Kernighan-Lin algorithm for the meaning of D'''
-        num_conn_infected = num_conn_uninfected = 0
-        for conn in (user.get_students() | user.get_coaches()):
-            if conn.get_uid() in infected_set:
-                num_conn_infected += 1
-            else:
-                num_conn_uninfected += 1
-        if user.get_uid() in infected_set:
-            return num_conn_uninfected - num_conn_infected
+    return graph.get_uids(_split_graph(graph, remaining_to_infect, max_iter,
+                                       method, observer=observer,
+                                       initial=initial))
+
+
+def _split_graph(graph, remaining_to_infect, max_iter=10000, method='kl',
+                 infected=None, observer=None, starts=1, seed=None,
+                 time_limit=None, workers=1, initial='first'):
+    '''_split_component for a Graph, which returns a boolean array
+
+    Without a seed, the method starts from the first remaining_to_infect
+    users, or with initial='grow', from the region _grow finds.
+
+    If seed is given, the split is the best of up to starts random starts
+    (see _multi_start_split), and the observer is told its seed
+    ('split_seed') and the cut of every start ('start_cuts').
+
+    If infected (a boolean array) is given, those users stay infected and
+    remaining_to_infect more are added to them: the infected region is grown
+    into its neighbors with the best gains, then refined one user at a time
+    (whatever the method), never moving the users who were infected to
+    begin with.
+
+    With node weights, remaining_to_infect is a weight, which is hit within
+    half the weight of the heaviest user.'''
+    if infected is None and seed is not None:
+        with span(observer, 'partition'):
+            infected, best_seed, cuts = _multi_start_split(
+                graph, remaining_to_infect, max_iter, method, starts, seed,
+                time_limit, workers=workers, observer=observer)
+        if observer is not None:
+            observer.record('split_seed', best_seed)
+            observer.record('start_cuts', cuts)
+        return infected
+    if infected is None:
+        # start off by assigning the first users to small group
+        infected = np.zeros(len(graph), dtype=bool)
+        if graph.node_weights is None:
+            infected[:remaining_to_infect] = True
         else:
-            return num_conn_infected - num_conn_uninfected
+            cum_weights = np.concatenate(([0], np.cumsum(graph.node_weights)))
+            infected[:np.argmin(np.abs(cum_weights - remaining_to_infect))] \
+                = True
+        if initial == 'grow':
+            with span(observer, 'grow'):
+                infected = _grow(graph, infected)
+        elif initial != 'first':
+            raise RuntimeError("Unknown initial split:", initial)
+        with span(observer, 'partition'):
+            return PARTITIONERS[method](graph, infected, max_iter,
+                                        observer=observer,
+                                        target_weight=remaining_to_infect)
+
+    with span(observer, 'partition'):
+        level = _Level.from_graph(graph)
+        num_to_infect = int(level.node_weights[infected].sum()) + \
+            remaining_to_infect
+        grown = _grow_region(level, None, num_to_infect, infected=infected)
+        grown = _balance(level, grown, num_to_infect, locked=infected)
+        return _refine_balanced(level, grown, num_to_infect,
+                                *_user_tolerances(level), max_iter=max_iter,
+                                locked=infected)
+
+
+def _split_graphs(tasks, max_iter=10000, method='kl', workers=1,
+                  observer=None, starts=1, seed=None, time_limit=None,
+                  initial='first'):
+    '''Run _split_graph for every (graph, remaining_to_infect, infected)
+    in tasks, in a pool of worker processes when there's more than one task
+    and more than one worker (or for the starts of a single task, if there
+    are several).  The splits are returned in the order of the tasks, and
+    don't depend on the number of workers.  The observer only hears about
+    tasks run in this process.'''
+    args = [(graph, remaining_to_infect, max_iter, method, infected, None,
+             starts, seed, time_limit, 1, initial)
+            for graph, remaining_to_infect, infected in tasks]
+    if workers > 1 and len(tasks) > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(workers, len(tasks)))
+        try:
+            return pool.starmap(_split_graph, args)
+        finally:
+            pool.close()
+            pool.join()
+    return [_split_graph(*task_args[:5], observer=observer,
+                         starts=starts, seed=seed, time_limit=time_limit,
+                         workers=workers, initial=initial)
+            for task_args in args]
 
-    def _toggle_infected(uids, infected_set):
-        '''toggle on/off the infected status of uids in infected_set'''
-        for uid in uids:
-            if uid in infected_set:
-                infected_set.remove(uid)
-            else:
-                infected_set.update((uid,))
 
-    num_uninfected = len(users) - remaining_to_infect
-    infected_uids = set()
-    users_dict = {user.get_uid(): user for user in users}
-    all_uids = set(users_dict.keys())
+def _multi_start_split(graph, remaining_to_infect, max_iter=10000,
+                       method='kl', starts=4, seed=0, time_limit=None,
+                       patience=3, workers=1, observer=None):
+    '''Split graph from several random starts, and keep the best split
 
-    # start off by randomly assigning users to small group
-    for user_i, user in enumerate(users):
-        infected_uids.update((user.get_uid(),))
-        if user_i + 1 >= remaining_to_infect:
+    Start i grows a region of remaining_to_infect users from a random root
+    picked with seed + i, and improves it with the method (for
+    'multilevel', seed + i seeds the matching instead, and for 'grow', the
+    region is the split).  No more starts are
+    made once one has no relationships between the groups, once patience
+    starts in a row haven't beaten the best one, or once time_limit seconds
+    have passed.  With several workers, that many starts are run at a time
+    in a pool, but only the starts which would have been made one at a
+    time count, so the split only depends on the seed (unless time_limit
+    stops the starts).
+
+    INPUT:
+        > graph: Graph of the users to split
+        > remaining_to_infect: number of users to infect
+        > max_iter: maximum number of passes of every start
+        > method: one of PARTITIONERS
+        > starts: maximum number of starts
+        > seed: seed of the first start
+        > time_limit: (optional) seconds after which no more starts are made
+        > patience: number of starts in a row without improvement before
+                    stopping
+        > workers: number of processes to run starts in
+        > observer: (optional) see _split_component
+
+    RETURN:
+        > infected: boolean array of the best split
+        > best_seed: seed of the start which found it, so that
+                     _split_graph with starts=1 and this seed finds it again
+        > cuts: cut of every start, in order'''
+    start_time = time()
+    comp_labels = np.zeros(len(graph), dtype=np.int64)
+    best_infected = best_seed = None
+    cuts = []
+    num_without_improving = 0
+    for batch_start in range(0, starts, max(workers, 1)):
+        seeds = list(range(seed + batch_start,
+                           seed + min(batch_start + workers, starts)))
+        args = [(graph, remaining_to_infect, max_iter, method, start_seed)
+                for start_seed in seeds]
+        if len(args) > 1:
+            from multiprocessing import Pool
+            pool = Pool(len(args))
+            try:
+                splits = pool.starmap(_seeded_split, args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            splits = [_seeded_split(*args[0], observer=observer)]
+        for start_seed, infected in zip(seeds, splits):
+            cuts.append(evaluate_split(graph, infected, comp_labels)[0])
+            if best_infected is None or cuts[-1] < min(cuts[:-1]):
+                best_infected = infected
+                best_seed = start_seed
+                num_without_improving = 0
+            else:
+                num_without_improving += 1
+            if cuts[-1] == 0 or num_without_improving >= patience:
+                return best_infected, best_seed, cuts
+        if time_limit is not None and time() - start_time >= time_limit:
             break
+    return best_infected, best_seed, cuts
+
+
+def _seeded_split(graph, remaining_to_infect, max_iter, method, seed,
+                  observer=None):
+    '''one start of _multi_start_split'''
+    level = _Level.from_graph(graph)
+    root = np.random.RandomState(seed).randint(len(graph))
+    infected = _grow_region(level, root, remaining_to_infect)
+    if method == 'grow':
+        # _grow would start again from the same user every time
+        return _balance(level, infected, remaining_to_infect)
+    if method == 'multilevel':
+        return _multilevel(graph, infected, max_iter, seed=seed,
+                           observer=observer,
+                           target_weight=remaining_to_infect)
+    return PARTITIONERS[method](graph, infected, max_iter, observer=observer,
+                                target_weight=remaining_to_infect)
+
+
+def _kernighan_lin(graph, infected, max_iter=10000, observer=None,
+                   target_weight=None):
+    '''Improve a split of graph with the Kernighan-Lin algorithm
+
+    INPUT:
+        > graph: Graph of the users to split.  If it has node weights, the
+                 split is refined like _multilevel's finest level instead,
+                 since swapping pairs would change the infected weight.
+        > infected: boolean array telling which users start off infected
+        > max_iter: maximum number of iterations of KL algorithm before
+                    stopping and settling on the current solution.
+        > observer: (optional) told the number of passes ('kl_passes'),
+                    of pairs of users evaluated ('kl_swaps_evaluated') and
+                    the gain of every pass ('kl_gain')
+        > target_weight: (optional) with node weights, the weight to
+                         infect, if it isn't the weight of infected
+
+    RETURN:
+        > infected: boolean array of the improved split, with the same
+                    number of infected users'''
+
+    if graph.node_weights is not None:
+        return _refine_users(graph, infected, max_iter, target_weight)
+
+    indptr = graph.indptr
+    indices = graph.indices
+    edge_weights = graph.get_edge_weights()
+
+    infected = infected.copy()
+    num_users = len(graph)
+    num_infected = int(infected.sum())
+    num_swaps = min(num_infected, num_users - num_infected)
 
     for _ in range(max_iter):
 
-        g_values = []
+        # D values (see the Wikipage Kernighan-Lin algorithm), the side of
+        # every node as the pass goes on, and the nodes not swapped yet
+        d_values = _get_gains(graph, infected)
+        side = infected.copy()
+        unlocked = np.ones(num_users, dtype=bool)
+        g_values = np.zeros(num_swaps, dtype=np.int64)
         g_pairs = []
-        # the infected UIDs for this round
-        temp_inf_uids = deepcopy(infected_uids)
-        # uids that have already been moved during this round
-        completed_uids = set()
-        for nn in range(min(remaining_to_infect, num_uninfected)):
-            for uid in (all_uids - completed_uids):
-                user = users_dict[uid]
-                user._d = _get_D_value(user, temp_inf_uids)
-            # find maximum g value
-            max_g_value = -1000000000
-            max_g_pair = (-1, -1)
-            for inf in temp_inf_uids - completed_uids:
-                for non_inf in (all_uids - temp_inf_uids - completed_uids):
-                    g_value = users_dict[inf]._d + users_dict[non_inf]._d \
-                        - 2 * (_are_connected(users_dict[inf],
-                                              users_dict[non_inf]))
-                    if g_value > max_g_value:
-                        max_g_value = g_value
-                        max_g_pair = (inf, non_inf)
-            # end of find max g value
-            completed_uids.update(max_g_pair)
-            g_pairs.append(max_g_pair)
-            g_values.append(max_g_value)
-            _toggle_infected(max_g_pair, temp_inf_uids)
-        # end for
+        num_evaluated = 0
+        for nn in range(num_swaps):
+            num_evaluated += (num_infected - nn) * (num_users -
+                                                    num_infected - nn)
+            inf, non_inf, g_values[nn] = _best_swap(graph, edge_weights,
+                                                    d_values, side, unlocked)
+            g_pairs.append((inf, non_inf))
+            unlocked[inf] = unlocked[non_inf] = False
+            # only the D values of the swapped nodes' connections change
+            for node in (inf, non_inf):
+                from_side = side[node]
+                side[node] = not from_side
+                conns = indices[indptr[node]:indptr[node + 1]]
+                weights = edge_weights[indptr[node]:indptr[node + 1]]
+                keep = unlocked[conns]
+                conns = conns[keep]
+                d_values[conns] += np.where(side[conns] == from_side, 2,
+                                            -2) * weights[keep]
 
         # now we find number which maximizes g_values subarray
         subarray_length = _find_max_left_justified_subarray(g_values)
-        g_max = sum(g_values[:subarray_length])
+        g_max = int(g_values[:subarray_length].sum())
+        if observer is not None:
+            observer.count('kl_passes')
+            observer.count('kl_swaps_evaluated', num_evaluated)
+            observer.record('kl_gain', g_max)
         if g_max <= 0:
             break
-        for g_pair_i in range(subarray_length):
-            uids_to_switch = g_pairs[g_pair_i]
-            _toggle_infected(uids_to_switch, infected_uids)
+        swapped = np.array(g_pairs[:subarray_length]).ravel()
+        infected[swapped] = ~infected[swapped]
 
     # end for (KL alogorithm main loop)
     else:
         print("WARNING: maximum number of iteration reached during KL "
               "algorithm...")
 
-    for user in users:
-        del user._d
+    return infected
+
+
+def _best_swap(graph, edge_weights, d_values, side, unlocked):
+    '''The unlocked infected node inf and uninfected node non_inf with the
+    highest gain from swapping them, g = D[inf] + D[non_inf] - 2 c(inf,
+    non_inf), where c is the weight of their relationship.  Of the pairs
+    with the highest gain, the one with the lowest (inf, non_inf) is
+    returned, as if every pair was scanned in order.
+
+    Since c is never negative, the highest gain is the sum of the highest D
+    values on each side when two nodes with those D values aren't
+    connected, which is almost always.  Otherwise, infected nodes are
+    scanned in order of decreasing D values, only while they could still
+    reach the highest gain.  An infected node is connected to at most as
+    many uninfected nodes as its degree, so its gains are only computed
+    for the uninfected nodes with D values as high as the (degree + 1)th
+    highest.
+
+    RETURN:
+        > inf, non_inf, g'''
+    infected_nodes = np.flatnonzero(unlocked & side)
+    uninfected_nodes = np.flatnonzero(unlocked & ~side)
+    infected_d = d_values[infected_nodes]
+    uninfected_d = d_values[uninfected_nodes]
+    max_infected_d = int(infected_d.max())
+    max_uninfected_d = int(uninfected_d.max())
+    top_uninfected = uninfected_nodes[uninfected_d == max_uninfected_d]
+    for inf in infected_nodes[infected_d == max_infected_d].tolist():
+        free = np.flatnonzero(_connection_weights(graph, edge_weights, inf,
+                                                  top_uninfected) == 0)
+        if len(free):
+            return (inf, int(top_uninfected[free[0]]),
+                    max_infected_d + max_uninfected_d)
+
+    infected_nodes = infected_nodes[np.lexsort((infected_nodes,
+                                                -infected_d))]
+    order = np.lexsort((uninfected_nodes, -uninfected_d))
+    uninfected_nodes = uninfected_nodes[order]
+    uninfected_d = uninfected_d[order]
+    degrees = np.diff(graph.indptr)
+    best = None
+    for inf in infected_nodes.tolist():
+        inf_d = int(d_values[inf])
+        if best is not None and inf_d + max_uninfected_d < best[2]:
+            break
+        lowest_d = uninfected_d[min(degrees[inf], len(uninfected_d) - 1)]
+        if best is not None:
+            lowest_d = max(lowest_d, best[2] - inf_d)
+        # the D values are decreasing, so the candidates are a prefix
+        num_candidates = np.searchsorted(-uninfected_d, -lowest_d,
+                                         side='right')
+        candidates = uninfected_nodes[:num_candidates]
+        g_values = inf_d + uninfected_d[:num_candidates] - 2 * \
+            _connection_weights(graph, edge_weights, inf, candidates)
+        g_value = int(g_values.max())
+        non_inf = int(candidates[g_values == g_value].min())
+        if best is None or g_value > best[2] or \
+                (g_value == best[2] and (inf, non_inf) < best[:2]):
+            best = (inf, non_inf, g_value)
+    return best
+
+
+def _connection_weights(graph, edge_weights, node, others):
+    '''weight of the relationship of node with each of others (0 for those
+    it isn't connected to), found in its sorted row of the graph'''
+    start, stop = graph.indptr[node], graph.indptr[node + 1]
+    row = graph.indices[start:stop]
+    if not len(row):
+        return np.zeros(len(others), dtype=edge_weights.dtype)
+    positions = np.minimum(np.searchsorted(row, others), len(row) - 1)
+    return np.where(row[positions] == others,
+                    edge_weights[start:stop][positions], 0)
+
+
+def _fiduccia_mattheyses(graph, infected, max_iter=10000, observer=None,
+                         target_weight=None):
+    '''Improve a split of graph with the Fiduccia-Mattheyses algorithm
+
+    Like Kernighan-Lin, each pass tentatively moves every user once and then
+    keeps the best run of moves from the start.  But instead of looking for
+    the best pair of users to swap, we move the infected user with the
+    highest gain, then the uninfected user with the highest gain, so that the
+    number infected is right again after every pair of moves.  The gains are
+    kept in buckets and only the gains of the moved user's connections
+    change, so each pass takes ~O(number of relationships).
+
+    INPUT:
+        > graph: Graph of the users to split.  If it has node weights, the
+                 split is refined like _multilevel's finest level instead,
+                 since moving pairs would change the infected weight.
+        > infected: boolean array telling which users start off infected
+        > max_iter: maximum number of passes before stopping and settling on
+                    the current solution.
+        > observer: (optional) told the number of passes ('fm_passes'),
+                    of users moved tentatively ('fm_moves') and the gain of
+                    every pass ('fm_gain')
+        > target_weight: (optional) see _kernighan_lin
+
+    RETURN:
+        > infected: boolean array of the improved split, with the same
+                    number of infected users'''
+
+    if graph.node_weights is not None:
+        return _refine_users(graph, infected, max_iter, target_weight)
+
+    infected = infected.copy()
+    num_users = len(graph)
+    num_infected = int(infected.sum())
+    num_swaps = min(num_infected, num_users - num_infected)
+    indptr = graph.indptr.tolist()
+    indices = graph.indices.tolist()
+    if graph.edge_weights is None:
+        edge_weights = None
+        max_gain = int(graph.degrees().max()) if num_users else 0
+    else:
+        edge_weights = graph.edge_weights.tolist()
+        max_gain = int(np.bincount(graph.edge_sources(),
+                                   weights=graph.edge_weights,
+                                   minlength=num_users).max()) \
+            if num_users else 0
+
+    for _ in range(max_iter):
+        gains = _get_gains(graph, infected).tolist()
+        side = infected.tolist()
+        # buckets[False] holds the uninfected users, buckets[True] the
+        # infected ones.  Users are taken out once they've been moved.
+        buckets = (_GainBuckets(num_users, max_gain),
+                   _GainBuckets(num_users, max_gain))
+        for node in range(num_users):
+            buckets[side[node]].insert(node, gains[node])
+
+        moves = []
+        total_gain = best_gain = best_num_moves = 0
+        for _ in range(num_swaps):
+            for from_side in (True, False):
+                node = buckets[from_side].pop_max()
+                total_gain += gains[node]
+                side[node] = not from_side
+                moves.append(node)
+                for edge in range(indptr[node], indptr[node + 1]):
+                    conn = indices[edge]
+                    conn_buckets = buckets[side[conn]]
+                    if conn not in conn_buckets:
+                        continue
+                    # the relationship is now between groups if conn was in
+                    # the same group as node, or within a group if not
+                    change = 2 if edge_weights is None else \
+                        2 * edge_weights[edge]
+                    gains[conn] += change if side[conn] == from_side else \
+                        -change
+                    conn_buckets.update(conn, gains[conn])
+            if total_gain > best_gain:
+                best_gain = total_gain
+                best_num_moves = len(moves)
+
+        if observer is not None:
+            observer.count('fm_passes')
+            observer.count('fm_moves', len(moves))
+            observer.record('fm_gain', best_gain)
+        if best_gain <= 0:
+            break
+        moved = moves[:best_num_moves]
+        infected[moved] = ~infected[moved]
+
+    else:
+        print("WARNING: maximum number of iteration reached during FM "
+              "algorithm...")
+
+    return infected
+
+
+def _grow(graph, infected, max_iter=10000, observer=None,
+          target_weight=None):
+    '''Split graph by growing a region from a user with the fewest
+    relationships
+
+    Starting from that user, the uninfected neighbor of the region with the
+    highest gain is infected, one at a time (from a priority queue), until
+    exactly as many users are infected as in infected (with node weights,
+    until they weigh the same to within half the heaviest user's weight).
+    This takes ~O(number of relationships * log(number of users)) and
+    there's no refinement, so it's the fastest method.  On tree-shaped
+    components, like classes hanging off a school, the region is usually a
+    few whole branches, which is close to the best split.  It's also a good
+    start for the other methods (see _split_graph).
+
+    INPUT:
+        > graph: Graph of the users to split
+        > infected: boolean array; only the number (or weight) of infected
+                    users is used
+        > max_iter: not used, for the same signature as the other methods
+        > observer: not used
+        > target_weight: (optional) see _multilevel
+
+    RETURN:
+        > infected: boolean array of the split'''
+    level = _Level.from_graph(graph)
+    if not len(level):
+        return infected.copy()
+    if target_weight is None:
+        target_weight = int(level.node_weights[infected].sum())
+    start = int(np.argmin(graph.degrees()))
+    # with node weights, the last user may take the region past the target
+    return _balance(level, _grow_region(level, start, target_weight),
+                    target_weight)
+
+
+def _get_gains(graph, infected):
+    '''Decrease in number (or weight) of conflicts from moving each user to
+    the other group (the D value of Kernighan-Lin)'''
+    sources = graph.edge_sources()
+    between_groups = infected[sources] != infected[graph.indices]
+    if graph.edge_weights is None:
+        weights = np.where(between_groups, 1, -1)
+    else:
+        weights = np.where(between_groups, graph.edge_weights,
+                           -graph.edge_weights)
+    return np.bincount(sources, weights=weights,
+                       minlength=len(graph)).astype(np.int64)
+
+
+def _refine_users(graph, infected, max_iter, target_weight=None):
+    '''Refine a split of a Graph with node weights one user at a time,
+    getting the infected weight within half the heaviest user of
+    target_weight (what it started at, if None) and keeping it there'''
+    level = _Level.from_graph(graph)
+    if target_weight is None:
+        target_weight = int(level.node_weights[infected].sum())
+    infected = _balance(level, infected, target_weight)
+    return _refine_balanced(level, infected, target_weight,
+                            *_user_tolerances(level), max_iter=max_iter)
+
+
+class _GainBuckets:
+    '''Users in buckets by their (integer) gain, so that the user with the
+    highest gain can be found, and gains changed, in constant time.  Every
+    bucket is a doubly linked list stored in Python lists.'''
+
+    def __init__(self, num_users, max_gain):
+        self._offset = max_gain
+        self._heads = [-1] * (2 * max_gain + 1)
+        self._next = [-1] * num_users
+        self._prev = [-1] * num_users
+        self._bucket_of = [-1] * num_users
+        # no bucket above this one has any users in it
+        self._top = -1
+
+    def __contains__(self, node):
+        return self._bucket_of[node] != -1
+
+    def insert(self, node, gain):
+        bucket = gain + self._offset
+        head = self._heads[bucket]
+        self._next[node] = head
+        self._prev[node] = -1
+        if head != -1:
+            self._prev[head] = node
+        self._heads[bucket] = node
+        self._bucket_of[node] = bucket
+        if bucket > self._top:
+            self._top = bucket
+
+    def remove(self, node):
+        prev_node, next_node = self._prev[node], self._next[node]
+        if prev_node != -1:
+            self._next[prev_node] = next_node
+        else:
+            self._heads[self._bucket_of[node]] = next_node
+        if next_node != -1:
+            self._prev[next_node] = prev_node
+        self._bucket_of[node] = -1
 
-    return infected_uids
+    def update(self, node, gain):
+        self.remove(node)
+        self.insert(node, gain)
 
+    def peek_max(self):
+        '''a user with the highest gain, or -1 if there are none'''
+        while self._top >= 0 and self._heads[self._top] == -1:
+            self._top -= 1
+        return self._heads[self._top] if self._top >= 0 else -1
 
-def _are_connected(user1, user2):
-    '''return true if the users have a connection'''
-    return user1 in (user2.get_students() | user2.get_coaches())
+    def pop_max(self):
+        '''remove and return a user with the highest gain'''
+        node = self.peek_max()
+        self.remove(node)
+        return node
+
+
+def _multilevel(graph, infected, max_iter=10000, seed=0, observer=None,
+                target_weight=None):
+    '''Split graph with a multilevel scheme, like METIS
+
+    The graph is coarsened by repeatedly merging pairs of users joined by the
+    heaviest relationships (heavy edge matching).  The small coarsest graph
+    is split by growing a region, then the split is projected back up one
+    level at a time and refined with Fiduccia-Mattheyses at every level.
+    Since a coarse user stands for several users, each level only keeps the
+    number infected within about the weight of its users.  At the finest
+    level, users with the best gains are moved to get exactly the right
+    number infected, and the split is refined a last time.
+
+    INPUT:
+        > graph: Graph of the users to split
+        > infected: boolean array; only the number (or weight) of infected
+                    users is used
+        > max_iter: maximum number of refinement passes at each level (no
+                    more than MULTILEVEL_MAX_PASSES)
+        > seed: seed for breaking ties in the matching
+        > observer: (optional) told the number of users at every level
+                    ('multilevel_level_sizes') and timings of the
+                    'coarsen', 'initial_split' and 'refine' phases
+        > target_weight: (optional) number (or weight) of users to infect,
+                         if it isn't the weight of infected
+
+    RETURN:
+        > infected: boolean array of the split, with the same number of
+                    infected users'''
+
+    num_users = graph.total_weight()
+    num_to_infect = int(graph.get_node_weights()[infected].sum()) \
+        if target_weight is None else target_weight
+    if min(num_to_infect, num_users - num_to_infect) <= 0:
+        return _balance(_Level.from_graph(graph), infected, num_to_infect)
+
+    # coarse users must stay light enough to be able to get close to the
+    # number to infect
+    max_node_weight = max(1, min(2 * num_users // COARSEST_SIZE,
+                                 min(num_to_infect,
+                                     num_users - num_to_infect) // 8))
+    random_state = np.random.RandomState(seed)
+    levels = [_Level.from_graph(graph)]
+    coarse_ofs = []
+    with span(observer, 'coarsen'):
+        while len(levels[-1]) > COARSEST_SIZE:
+            coarse_of = _heavy_edge_matching(levels[-1], max_node_weight,
+                                             random_state)
+            coarse = levels[-1].contract(coarse_of)
+            # stop once the matching doesn't shrink the graph much anymore
+            if len(coarse) > 0.95 * len(levels[-1]):
+                break
+            levels.append(coarse)
+            coarse_ofs.append(coarse_of)
+    if observer is not None:
+        observer.record('multilevel_level_sizes',
+                        [len(level) for level in levels])
+
+    max_iter = min(max_iter, MULTILEVEL_MAX_PASSES)
+    with span(observer, 'initial_split'):
+        infected = _initial_split(levels[-1], num_to_infect, max_iter)
+    with span(observer, 'refine'):
+        for level, coarse_of in reversed(list(zip(levels[:-1],
+                                                  coarse_ofs))):
+            infected = _refine_balanced(level, infected[coarse_of],
+                                        num_to_infect, *_tolerances(level),
+                                        max_iter=max_iter)
+
+        infected = _rebalance(levels[0], infected, num_to_infect)
+        # one user at a time, only keeping moves which end up exactly
+        # balanced (or as close as the users' weights allow)
+        return _refine_balanced(levels[0], infected, num_to_infect,
+                                *_user_tolerances(levels[0]),
+                                max_iter=max_iter)
+
+
+class _Level:
+    '''A graph for multilevel partitioning, in CSR form like Graph, where
+    each node stands for node_weights[i] users and each edge for
+    edge_weights[k] relationships'''
+
+    def __init__(self, indptr, indices, edge_weights, node_weights):
+        self.indptr = indptr
+        self.indices = indices
+        self.edge_weights = edge_weights
+        self.node_weights = node_weights
+
+    @classmethod
+    def from_graph(cls, graph):
+        return cls(graph.indptr, graph.indices, graph.get_edge_weights(),
+                   graph.get_node_weights())
+
+    def __len__(self):
+        return len(self.node_weights)
+
+    def edge_sources(self):
+        return np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+    def gains(self, infected):
+        '''decrease in the weight of relationships between groups from
+        moving each node to the other group'''
+        sources = self.edge_sources()
+        between_groups = infected[sources] != infected[self.indices]
+        return np.bincount(sources,
+                           weights=np.where(between_groups, self.edge_weights,
+                                            -self.edge_weights),
+                           minlength=len(self)).astype(np.int64)
+
+    def cut(self, infected):
+        '''weight of the relationships between groups'''
+        between_groups = infected[self.edge_sources()] != \
+            infected[self.indices]
+        return int(self.edge_weights[between_groups].sum()) // 2
+
+    def contract(self, coarse_of):
+        '''the coarser _Level where node i becomes node coarse_of[i]'''
+        num_coarse = int(coarse_of.max()) + 1
+        sources = coarse_of[self.edge_sources()]
+        targets = coarse_of[self.indices]
+        keep = sources != targets
+        keys, inverse = np.unique(sources[keep] * num_coarse + targets[keep],
+                                  return_inverse=True)
+        edge_weights = np.bincount(inverse, weights=self.edge_weights[keep])
+        indptr = np.zeros(num_coarse + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // num_coarse, minlength=num_coarse),
+                  out=indptr[1:])
+        return _Level(indptr, keys % num_coarse, edge_weights.astype(np.int64),
+                      np.bincount(coarse_of, weights=self.node_weights,
+                                  minlength=num_coarse).astype(np.int64))
+
+
+def _heavy_edge_matching(level, max_node_weight, random_state,
+                         num_rounds=10):
+    '''Match up pairs of nodes joined by heavy edges
+
+    Every round, each unmatched node proposes to the unmatched neighbor with
+    the heaviest edge (ties are broken randomly), and nodes which propose to
+    each other are matched.  Any nodes left after that are matched one at a
+    time.  Nodes whose neighbors are all matched by then (such as the
+    students of one coach, who aren't related to each other) are matched
+    in pairs with nodes sharing their heaviest neighbor (two-hop matching),
+    or the graph would hardly shrink where it's shaped like a star.
+
+    RETURN:
+        > coarse_of: coarse node number of every node, where matched nodes
+                     share a number'''
+    num_nodes = len(level)
+    nodes = np.arange(num_nodes)
+    mate = nodes.copy()
+    sources = level.edge_sources()
+    targets = level.indices
+    node_weights = level.node_weights
+    fits = node_weights[sources] + node_weights[targets] <= max_node_weight
+    # the same random tie breaker for both directions of an edge, which is
+    # below 1 so that it only orders edges of the same weight
+    node_random = random_state.random_sample(num_nodes)
+    edge_keys = level.edge_weights + (node_random[sources] +
+                                      node_random[targets]) / 2
+    for _ in range(num_rounds):
+        unmatched = mate == nodes
+        usable = np.flatnonzero(fits & unmatched[sources] &
+                                unmatched[targets])
+        if not len(usable):
+            break
+        # the edges are in order of their sources, so each node's best one
+        # is the first with the highest key in its run of edges
+        usable_sources = sources[usable]
+        starts = np.flatnonzero(np.concatenate((
+            [True], usable_sources[1:] != usable_sources[:-1])))
+        keys = edge_keys[usable]
+        best = keys == np.repeat(np.maximum.reduceat(keys, starts),
+                                 np.diff(np.append(starts, len(usable))))
+        best = usable[best]
+        is_first = np.ones(len(best), dtype=bool)
+        is_first[1:] = sources[best][1:] != sources[best][:-1]
+        proposal = np.full(num_nodes, -1, dtype=np.int64)
+        proposal[sources[best][is_first]] = targets[best][is_first]
+        proposers = np.flatnonzero(proposal >= 0)
+        mutual = proposers[proposal[proposal[proposers]] == proposers]
+        mate[mutual] = proposal[mutual]
+
+    # match whatever nodes are left greedily (only those with an unmatched
+    # neighbor they fit with can be)
+    indptr = level.indptr
+    unmatched = mate == nodes
+    for node in np.unique(sources[fits & unmatched[sources] &
+                                  unmatched[targets]]).tolist():
+        if mate[node] != node:
+            continue
+        edges = np.arange(indptr[node], indptr[node + 1])
+        edges = edges[fits[edges] & (mate[targets[edges]] == targets[edges])]
+        if len(edges):
+            mate_node = targets[edges[np.argmax(level.edge_weights[edges])]]
+            mate[node] = mate_node
+            mate[mate_node] = node
+    _match_two_hops(level, mate, max_node_weight)
+    _, coarse_of = np.unique(np.minimum(nodes, mate), return_inverse=True)
+    return coarse_of
+
+
+def _match_two_hops(level, mate, max_node_weight):
+    '''Match up pairs of unmatched nodes (where mate is the node itself)
+    whose heaviest neighbor is the same node, lightest nodes first, as long
+    as they fit within max_node_weight together.  mate is updated in
+    place.'''
+    sources = level.edge_sources()
+    edges = np.flatnonzero(mate[sources] == sources)
+    if not len(edges):
+        return
+    edges = edges[np.lexsort((-level.edge_weights[edges], sources[edges]))]
+    is_first = np.ones(len(edges), dtype=bool)
+    is_first[1:] = sources[edges][1:] != sources[edges][:-1]
+    lonely = sources[edges[is_first]]
+    hubs = level.indices[edges[is_first]]
+    order = np.lexsort((level.node_weights[lonely], hubs))
+    lonely = lonely[order]
+    hubs = hubs[order]
+    # pair the 1st and 2nd node of every hub, the 3rd and 4th, ...
+    group_starts = np.flatnonzero(np.concatenate(([True],
+                                                  hubs[1:] != hubs[:-1])))
+    rank = np.arange(len(hubs)) - np.repeat(group_starts,
+                                            np.diff(np.append(group_starts,
+                                                              len(hubs))))
+    firsts = np.flatnonzero((rank % 2 == 0)[:-1] & (hubs[1:] == hubs[:-1]))
+    firsts = firsts[level.node_weights[lonely[firsts]] +
+                    level.node_weights[lonely[firsts + 1]] <=
+                    max_node_weight]
+    mate[lonely[firsts]] = lonely[firsts + 1]
+    mate[lonely[firsts + 1]] = lonely[firsts]
+
+
+def _tolerances(level):
+    '''How far from the number to infect moves on a level may go, and how
+    close a split has to be to keep it.  Finer levels have lighter nodes, so
+    they can get closer.'''
+    node_weights = level.node_weights
+    return (int(node_weights.max()),
+            int(np.ceil(node_weights.sum() / len(node_weights))))
+
+
+def _user_tolerances(level):
+    '''_tolerances of the finest level, where nodes are users: they're
+    moved one at a time, and a split is kept within half the weight of the
+    heaviest user (so exactly balanced if every user weighs 1)'''
+    max_weight = int(level.node_weights.max()) if len(level) else 1
+    return max_weight, max_weight // 2
+
+
+def _initial_split(level, num_to_infect, max_iter, num_tries=4):
+    '''Split the coarsest level by growing regions from a few of the
+    lightest nodes, and keep the one with the smallest cut'''
+    best_infected = None
+    best_cut = None
+    starts = np.argsort(level.node_weights, kind='stable')[:num_tries]
+    for start in starts.tolist():
+        infected = _grow_region(level, start, num_to_infect)
+        infected = _refine_balanced(level, infected, num_to_infect,
+                                    *_tolerances(level), max_iter=max_iter)
+        cut = level.cut(infected)
+        if best_cut is None or cut < best_cut:
+            best_cut = cut
+            best_infected = infected
+    return best_infected
+
+
+def _grow_region(level, start, target_weight, infected=None):
+    '''Infect start (or the region of infected nodes, if given), then keep
+    infecting the uninfected node with the highest gain (taken from a
+    priority queue) until the infected nodes weigh at least target_weight
+
+    RETURN:
+        > infected: boolean array'''
+    indptr = level.indptr.tolist()
+    indices = level.indices.tolist()
+    edge_weights = level.edge_weights.tolist()
+    node_weights = level.node_weights.tolist()
+    if infected is None:
+        infected = np.zeros(len(level), dtype=bool)
+        boundary = [start]
+    else:
+        # the uninfected neighbors of the region
+        boundary = np.unique(level.indices[infected[level.edge_sources()]])
+        boundary = boundary[~infected[boundary]].tolist()
+    # gain of infecting a node is (weight into region) - (weight outside)
+    gains = level.gains(infected).tolist()
+    weight = int(level.node_weights[infected].sum())
+    infected = infected.tolist()
+    queue = [(-gains[node], node) for node in boundary]
+    heapq.heapify(queue)
+    next_unvisited = 0
+    while weight < target_weight:
+        if not queue:
+            # the region can't grow anymore, so start a new one
+            while infected[next_unvisited]:
+                next_unvisited += 1
+            queue.append((-gains[next_unvisited], next_unvisited))
+        neg_gain, node = heapq.heappop(queue)
+        if infected[node] or -neg_gain != gains[node]:
+            continue
+        infected[node] = True
+        weight += node_weights[node]
+        for edge in range(indptr[node], indptr[node + 1]):
+            conn = indices[edge]
+            if not infected[conn]:
+                gains[conn] += 2 * edge_weights[edge]
+                heapq.heappush(queue, (-gains[conn], conn))
+    return np.array(infected, dtype=bool)
+
+
+def _refine_balanced(level, infected, target_weight, move_tol, keep_tol,
+                     max_iter, max_bad_moves=100, locked=None):
+    '''Fiduccia-Mattheyses refinement of a split of a _Level, one node at a
+    time
+
+    Moves are allowed while the infected weight stays within move_tol of
+    target_weight (or gets closer to it), but a run of moves is only kept if
+    it ends within keep_tol.  Passes stop early after max_bad_moves balanced
+    moves without improvement.  Nodes where the boolean array locked is True
+    are never moved.
+
+    RETURN:
+        > infected: boolean array of the improved split'''
+    infected = infected.copy()
+    indptr = level.indptr.tolist()
+    indices = level.indices.tolist()
+    edge_weights = level.edge_weights.tolist()
+    node_weights = level.node_weights.tolist()
+    num_nodes = len(level)
+    max_gain = int(np.bincount(level.edge_sources(),
+                               weights=level.edge_weights,
+                               minlength=num_nodes).max()) if num_nodes else 0
+    movable = range(num_nodes) if locked is None else \
+        np.flatnonzero(~locked).tolist()
+
+    for _ in range(max_iter):
+        gains = level.gains(infected).tolist()
+        side = infected.tolist()
+        buckets = (_GainBuckets(num_nodes, max_gain),
+                   _GainBuckets(num_nodes, max_gain))
+        for node in movable:
+            buckets[side[node]].insert(node, gains[node])
+        imbalance = int(level.node_weights[infected].sum()) - target_weight
+
+        moves = []
+        total_gain = num_bad_moves = best_num_moves = 0
+        # an unbalanced split is worse than any balanced one
+        best_gain = 0 if abs(imbalance) <= keep_tol else -np.inf
+        while num_bad_moves < max_bad_moves:
+            node = -1
+            tops = [(gains[top], from_side, top) for from_side, top in
+                    ((True, buckets[True].peek_max()),
+                     (False, buckets[False].peek_max())) if top != -1]
+            for _, from_side, top in sorted(tops, reverse=True):
+                change = -node_weights[top] if from_side else \
+                    node_weights[top]
+                if (abs(imbalance + change) <= move_tol or
+                        abs(imbalance + change) < abs(imbalance)):
+                    node = top
+                    break
+            if node == -1:
+                break
+            buckets[from_side].remove(node)
+            imbalance += change
+            total_gain += gains[node]
+            side[node] = not from_side
+            moves.append(node)
+            for edge in range(indptr[node], indptr[node + 1]):
+                conn = indices[edge]
+                conn_buckets = buckets[side[conn]]
+                if conn not in conn_buckets:
+                    continue
+                if side[conn] == from_side:
+                    gains[conn] += 2 * edge_weights[edge]
+                else:
+                    gains[conn] -= 2 * edge_weights[edge]
+                conn_buckets.update(conn, gains[conn])
+            if abs(imbalance) <= keep_tol:
+                if total_gain > best_gain:
+                    best_gain = total_gain
+                    best_num_moves = len(moves)
+                    num_bad_moves = 0
+                else:
+                    num_bad_moves += 1
+
+        if best_num_moves == 0:
+            break
+        moved = moves[:best_num_moves]
+        infected[moved] = ~infected[moved]
+
+    return infected
+
+
+def _rebalance(level, infected, target_weight, locked=None):
+    '''Move the users with the best gains out of the larger group until
+    the infected users weigh target_weight (or as close as the run of best
+    users gets, which is within half the heaviest one's weight), never
+    moving the users where the boolean array locked is True'''
+    infected = infected.copy()
+    excess = int(level.node_weights[infected].sum()) - target_weight
+    if excess == 0:
+        return infected
+    gains = level.gains(infected)
+    candidates = infected if excess > 0 else ~infected
+    if locked is not None:
+        candidates = candidates & ~locked
+    candidates = np.flatnonzero(candidates)
+    candidates = candidates[np.argsort(-gains[candidates], kind='stable')]
+    cum_weights = np.concatenate(([0], np.cumsum(
+        level.node_weights[candidates])))
+    best = candidates[:np.argmin(np.abs(cum_weights - abs(excess)))]
+    infected[best] = ~infected[best]
+    return infected
+
+
+def _balance(level, infected, target_weight, locked=None):
+    '''_rebalance, if the infected users weigh more than half the heaviest
+    user's weight away from target_weight'''
+    keep_tol = _user_tolerances(level)[1]
+    if abs(int(level.node_weights[infected].sum()) - target_weight) <= \
+            keep_tol:
+        return infected
+    return _rebalance(level, infected, target_weight, locked)
+
+
+# the algorithms _split_component can use, by name
+PARTITIONERS = {'kl': _kernighan_lin,
+                'fm': _fiduccia_mattheyses,
+                'multilevel': _multilevel,
+                'grow': _grow}
+# how _split_graph can start a split when there's no seed
+INITIAL_SPLITS = ('first', 'grow')
+
+
+def _as_graph(users):
+    '''Graph for a dictionary of {uid: User}, or the Graph itself'''
+    if isinstance(users, Graph):
+        return users
+    return Graph.from_users(users.values())
+
+
+def _component_graph(users, uids):
+    '''Graph of the users with the given uids (which must make up whole
+    connected components) out of a dictionary of {uid: User} or a Graph'''
+    if isinstance(users, Graph):
+        return users.subgraph(users.indices_of(uids))
+    return Graph.from_users(users[uid] for uid in uids.tolist())
 
 
 def _find_max_left_justified_subarray(array):
     '''return number of elements to keep in order to maximize the subarray
     which is constrained to start at the first element.'''
-    subarray_length = 0
-    max_sum = 0
-    for ii in range(len(array)):
-        current_sum = sum(array[:ii+1])
-        if current_sum > max_sum:
-            max_sum = current_sum
-            subarray_length = ii + 1
-    return subarray_length
-
-
-def _find_num_conflicts(user, infected_set):
-    '''Number of conlifcting relationships.  For example, if user is infected
-    and has connections to 4 uninfected users, return 4.'''
-    num_conn_infected = num_conn_uninfected = 0
-    for conn in (user.get_students() | user.get_coaches()):
-        if conn.get_uid() in infected_set:
-            num_conn_infected += 1
-        else:
-            num_conn_uninfected += 1
-    if user.get_uid() in infected_set:
-        return num_conn_uninfected
-    else:
-        return num_conn_infected
+    if not len(array):
+        return 0
+    # sum of the first ii + 1 elements, for every ii
+    prefix_sums = np.cumsum(array)
+    best = int(np.argmax(prefix_sums))
+    return best + 1 if prefix_sums[best] > 0 else 0
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Garrett Reynolds
+"""
+
+import json
+from time import time
+import numpy as np
+
+
+class Profiler:
+    '''Collects what happened during a run, to find where the time went.
+
+    Pass a Profiler as the observer of limited_infection or
+    _split_component.  They time each phase with span(), count things like
+    the swaps evaluated by Kernighan-Lin with count(), and keep values like
+    the gain of every pass with record().  Without an observer, none of
+    this is done.'''
+
+    def __init__(self):
+        # {name: {'seconds': total time, 'calls': number of times}}
+        self.spans = {}
+        # {name: total}
+        self.counters = {}
+        # {name: list of values}
+        self.values = {}
+        # {name: list of [low, high, count] bins}
+        self.histograms = {}
+
+    def span(self, name):
+        '''context manager timing the code inside it under name'''
+        return _Span(self, name)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, name, value):
+        self.values.setdefault(name, []).append(value)
+
+    def histogram(self, name, values):
+        '''count the (positive integer) values in bins of 1, 2-3, 4-7, etc.'''
+        values = np.asarray(values)
+        bins = np.bincount(np.log2(values[values > 0]).astype(np.int64))
+        self.histograms[name] = [[2**power, 2**(power + 1) - 1, count]
+                                 for power, count in
+                                 enumerate(bins.tolist()) if count]
+
+    def report(self):
+        '''everything collected, as a dictionary which can be saved as JSON'''
+        return {'spans': self.spans, 'counters': self.counters,
+                'values': self.values, 'histograms': self.histograms}
+
+    def save(self, filename):
+        '''Save the report to filename as JSON'''
+        with open(filename, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+
+class _Span:
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        self._start = time()
+        return self
+
+    def __exit__(self, *exc_info):
+        span = self._profiler.spans.setdefault(self._name,
+                                               {'seconds': 0., 'calls': 0})
+        span['seconds'] += time() - self._start
+        span['calls'] += 1
+        return False
+
+
+class _NoSpan:
+    '''span of a missing observer, which does nothing'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(observer, name):
+    '''observer.span(name), or a context which does nothing if observer is
+    None'''
+    if observer is None:
+        return _NO_SPAN
+    return observer.span(name)
@@ -7,9 +7,20 @@
 
 from __future__ import print_function
 import argparse
+import json
+import os
 from time import time
-from save_load import _try_converting_to_int, load_users, save_users
-from infections import total_infection, limited_infection
+from save_load import (_try_converting_to_int, load_graph, load_uids,
+                       save_graph, save_infected, OUTPUT_FORMATS)
+from infections import (total_infection, limited_infection, evaluate_split,
+                        limited_infection_groups, infection_sweep,
+                        PARTITIONERS,
+                        INITIAL_SPLITS, _uid_mask)
+from components import ComponentIndex, ComponentLookup
+from profiling import Profiler, span
+from external import limited_infection_external, save_infected_external
+from sources import is_source_uri, load_source, open_source
+from assignment import Assignment
 
 
 def main():
@@ -19,11 +30,24 @@ def main():
     parser.add_argument('-i', '--input',
                         help="""Input .csv file where the first number is the
                         user ID, and the following numbers (if any) are IDs
-                        of students""",
+                        of students, a binary graph file made with
+                        --convert, or the URI of a database table of
+                        relationships, e.g. 'sqlite:///users.db?edges=
+                        relationships&coach=coach_id&student=student_id&
+                        users=users&uid=user_id' (the users table is
+                        optional)""",
                         type=str, required=True)
     parser.add_argument('-o', '--output',
-                        help="""Ouput .csv file where infected user IDs will be
-                        saved to""", required=False, type=str)
+                        help="""Ouput file where infected user IDs will be
+                        saved to (see --outputFormat)""", required=False,
+                        type=str)
+    parser.add_argument('-r', '--outputFormat', required=False,
+                        default='csv', choices=OUTPUT_FORMATS,
+                        help="""Format of the output file: 'csv' (each row
+                        is an infected user's ID followed by the IDs of its
+                        students, the default), 'uids' (only the infected
+                        user IDs, one per line) or 'npy' (a NumPy array of
+                        the infected user IDs)""")
     parser.add_argument('-t', '--total',
                         help="""Set this to do total infection.  You must then
                         also give a user ID""", action="store_true",
@@ -38,6 +62,17 @@ def main():
                         of people who will be infected.  If float, then it must
                         be between 0 and 1 and represents the proportion of
                         infected people.)""")
+    parser.add_argument('-g', '--groups', required=False, type=str,
+                        help="""With -l, split the users into groups of these
+                        relative sizes instead, e.g. 40,30,30 for an A/B/C
+                        test.  Group i is saved to the --output filename with
+                        _i added (e.g. infected_users_0.csv).""")
+    parser.add_argument('--sweep', required=False, type=str,
+                        help="""Comma separated numbers (or proportions) of
+                        users to infect, e.g. 0.01,0.05,0.1,0.5, instead of
+                        --numToInfect.  The components are found once for
+                        all of them, and the infected users of number i are
+                        saved to the output filename with _i added.""")
     parser.add_argument('-e', '--tolerance', required=False, type=float,
                         help="""(int or float) The tolerance in number of
                         infected people setting it to be greater than zero
@@ -45,6 +80,82 @@ def main():
                         conflicts.  If it is a float, it'll
                         be interpreted as a proportion of the total population.
                         (ignored if perfect_only is True)""")
+    parser.add_argument('-m', '--method', required=False, default='kl',
+                        choices=sorted(PARTITIONERS),
+                        help="""Algorithm for splitting a connected
+                        component: 'kl' (Kernighan-Lin, the default), 'fm'
+                        (Fiduccia-Mattheyses, much faster for large
+                        components), 'multilevel' (for huge components) or
+                        'grow' (grows a region from a user with few
+                        relationships, the fastest, and good for
+                        tree-shaped components)""")
+    parser.add_argument('--initial', required=False, default='first',
+                        choices=INITIAL_SPLITS,
+                        help="""How --method starts splitting a component:
+                        from its 'first' users (the default) or from the
+                        region 'grow' finds""")
+    parser.add_argument('--starts', required=False, default=1, type=int,
+                        help="""Split a component from up to this many
+                        random starts and keep the best split.  Starts stop
+                        early once one has no relationships between groups
+                        or a few in a row don't improve.  Needs --seed.""")
+    parser.add_argument('--seed', required=False, type=int,
+                        help="""Seed of the first random start of a split
+                        (the next ones use seed + 1, etc.).  The seed of
+                        the best start is saved with --profile, and running
+                        with it and --starts 1 gives the same split again.
+                        Without a seed, splits start from the first users of
+                        the component.""")
+    parser.add_argument('--timeLimit', required=False, type=float,
+                        help="""Seconds after which no more random starts
+                        are made""")
+    parser.add_argument('-b', '--convert', required=False, type=str,
+                        help="""Save the input users to this binary graph
+                        file, which loads much faster than a .csv file
+                        when given as --input.  No infection is done unless
+                        -t or -l is set.""")
+    parser.add_argument('-c', '--componentIndex', required=False, type=str,
+                        help="""File with the connected components of the
+                        users, for limited infection.  It's created if it
+                        doesn't exist yet, and reused on later runs so the
+                        components don't have to be searched for again.  If
+                        the input has changed since, it's created again.""")
+    parser.add_argument('-p', '--previous', required=False, type=str,
+                        help="""Output .csv file of an earlier limited
+                        infection.  When more users are to be infected now,
+                        those users stay infected, and when fewer are, only
+                        they are uninfected, so the next stage of a rollout
+                        only changes who it has to.""")
+    parser.add_argument('-w', '--workers', required=False, default=1,
+                        type=int, help="""Number of processes to use for
+                        reading from a database, finding connected
+                        components and splitting them.
+                        The result is the same for any number.""")
+    parser.add_argument('-f', '--profile', required=False, type=str,
+                        help="""JSON file to save a profile of the run to:
+                        the time taken by each phase (loading, finding
+                        components, selecting them, partitioning, saving),
+                        what the partitioner did and a histogram of
+                        component sizes""")
+    parser.add_argument('-s', '--serve', required=False, type=int,
+                        help="""Keep running and answer which users are in a
+                        user's connected component over HTTP on this port
+                        of localhost, e.g. GET /component/42 or
+                        /members/42""")
+    parser.add_argument('--assignment', required=False, type=str,
+                        help="""Save the groups of the users and their
+                        components to this file (a NumPy .npz file), for
+                        assignment.Assignment to put users who sign up
+                        before the next run in a group straight away""")
+    parser.add_argument('-x', '--external', required=False, type=str,
+                        help="""Do limited infection without loading the
+                        users into memory, for graphs too large for it: the
+                        .csv --input is read a chunk at a time, and the
+                        components are found with files in this directory.
+                        Only the component which has to be split is
+                        loaded.  It can't be used with --previous, --seed,
+                        --starts, --initial, --componentIndex or
+                        --workers.""")
     parser.add_argument('-v', '--verbose', action="store_true", required=False)
 
     args = parser.parse_args()
@@ -70,12 +181,40 @@ def main():
               "Exiting....")
         return
 
-    if args.limited and not args.numToInfect:
+    if args.limited and not (args.numToInfect or args.groups or
+                             args.sweep):
         print("You're doing limited so you must specify the number to infect "
               "by adding, for example, '-n 70'.  Exiting....")
         return
 
-    if not (args.total or args.limited):
+    if args.groups is not None and (args.previous is not None or
+                                    args.external is not None):
+        print("--groups can't be used with --previous or --external. "
+              "Exiting....")
+        return
+
+    if args.assignment is not None and (not args.limited or
+                                        args.groups is not None or
+                                        args.sweep is not None or
+                                        args.external is not None):
+        print("--assignment only works with limited infection (-l) of "
+              "--numToInfect users, without --external. Exiting....")
+        return
+
+    if args.sweep is not None and (args.previous is not None or
+                                   args.external is not None or
+                                   args.groups is not None):
+        print("--sweep can't be used with --previous, --external or "
+              "--groups. Exiting....")
+        return
+
+    if args.previous is not None and not args.limited:
+        print("--previous only works with limited infection (-l). "
+              "Exiting....")
+        return
+
+    if not (args.total or args.limited or args.convert or
+            args.serve is not None):
         if args.user is not None:
             print("We assume you want to do total infection.")
             args.total = True
@@ -84,14 +223,62 @@ def main():
                   "type 'run.py --help' for more information.\nExiting...")
             return
 
+    if args.external is not None and not args.limited:
+        print("--external only works with limited infection (-l). "
+              "Exiting....")
+        return
+
+    if args.external is not None and (args.previous is not None or
+                                      args.seed is not None or
+                                      args.starts != 1 or
+                                      args.initial != 'first' or
+                                      args.componentIndex is not None or
+                                      args.workers != 1):
+        print("--external can't be used with --previous, --seed, --starts, "
+              "--initial, --componentIndex or --workers. Exiting....")
+        return
+
+    if args.external is not None and is_source_uri(args.input):
+        print("--external only works with a .csv --input. Exiting....")
+        return
+
+    if args.starts > 1 and args.seed is None:
+        print("Several --starts need a --seed, e.g. '--seed 0'.  Exiting....")
+        return
+
     if args.user is not None:
         args.user = _try_converting_to_int(args.user)
 
+    profiler = Profiler() if args.profile is not None else None
+
+    if args.external is not None:
+        _run_external(args, profiler)
+        return
+
     print("Loading users...")
-    users = load_users(args.input)
+    # a Graph works like a dictionary of {uid: User}
+    with span(profiler, 'load'):
+        if is_source_uri(args.input):
+            users = load_source(open_source(args.input,
+                                            workers=args.workers))
+        else:
+            users = load_graph(args.input)
     print("Finished loading.")
-    # convert to dictionary
-    users = {user.get_uid(): user for user in users}
+
+    if args.convert is not None:
+        print("Saving binary graph to:", args.convert)
+        save_graph(users, args.convert)
+        if not (args.total or args.limited or args.serve is not None):
+            return
+
+    if args.serve is not None:
+        if args.componentIndex is not None:
+            lookup = ComponentLookup.build(_component_index(
+                args.componentIndex, users, args.workers))
+        else:
+            lookup = ComponentLookup.build(users, args.workers)
+        _serve(lookup, args.serve)
+        return
 
     time1 = time()
     if args.total:
@@ -103,10 +290,48 @@ def main():
             args.tolerance = 0
         if args.tolerance > 1.0:
             args.tolerance = int(args.tolerance)
-        if args.numToInfect > 1.0:
+        if args.numToInfect is not None and args.numToInfect > 1.0:
             args.numToInfect = int(args.numToInfect)
-        infected_uids = limited_infection(users, args.numToInfect,
-                                          args.tolerance, args.verbose)
+        component_index = None
+        if args.componentIndex is not None:
+            with span(profiler, 'component_index'):
+                component_index = _component_index(args.componentIndex,
+                                                   users, args.workers)
+        if args.groups is not None:
+            group_uids = limited_infection_groups(
+                users, [float(size) for size in args.groups.split(',')],
+                args.tolerance, args.verbose,
+                component_index=component_index, method=args.method,
+                workers=args.workers, observer=profiler)
+        elif args.sweep is not None:
+            targets = [float(target) for target in args.sweep.split(',')]
+            targets = [int(target) if target > 1.0 else target
+                       for target in targets]
+            sweep = infection_sweep(
+                users, targets, args.tolerance, method=args.method,
+                component_index=component_index, workers=args.workers,
+                return_uids=args.output is not None, observer=profiler)
+            for result in sweep:
+                print("To infect", result['num_to_infect'], "users,",
+                      result['num_infected'], "were infected with",
+                      result['cut'], "relationships between groups.")
+        else:
+            previous = None
+            if args.previous is not None:
+                previous = load_uids(args.previous)
+            infected_uids = limited_infection(
+                users, args.numToInfect, args.tolerance, args.verbose,
+                component_index=component_index, method=args.method,
+                previous=previous, workers=args.workers, observer=profiler,
+                starts=args.starts, seed=args.seed,
+                time_limit=args.timeLimit, initial=args.initial)
+            if args.verbose:
+                infected = _uid_mask(users.uids, infected_uids)
+                num_conflicts, comp_conflicts, _ = evaluate_split(users,
+                                                                  infected)
+                print("In total,", num_conflicts, "relationships are "
+                      "between groups, in", (comp_conflicts > 0).sum(),
+                      "components.")
     time2 = time()
     if args.verbose:
         print("\nThe algorithm took: " + str(round((time2-time1)/60, 2)) +
@@ -114,13 +339,127 @@ def main():
 
     if args.output is None:
         print("No ouput file specified, so results won't be saved")
+    elif args.limited and args.groups is not None:
+        root, extension = os.path.splitext(args.output)
+        for group, uids in enumerate(group_uids):
+            filename = root + '_' + str(group) + extension
+            print("Saving group", group, "to:", filename)
+            with span(profiler, 'save'):
+                save_infected(users, _uid_mask(users.uids, uids), filename,
+                              args.outputFormat)
+    elif args.limited and args.sweep is not None:
+        root, extension = os.path.splitext(args.output)
+        for target_i, result in enumerate(sweep):
+            filename = root + '_' + str(target_i) + extension
+            print("Saving infected users of", result['num_to_infect'],
+                  "to:", filename)
+            with span(profiler, 'save'):
+                save_infected(users, _uid_mask(users.uids, result['uids']),
+                              filename, args.outputFormat)
     else:
         print("Saving infected users to:", args.output)
-        infected_users = set((users[uid] for uid in infected_uids))
-        save_users(infected_users, args.output)
+        with span(profiler, 'save'):
+            save_infected(users, _uid_mask(users.uids, infected_uids),
+                          args.output, args.outputFormat)
+
+    if args.assignment is not None:
+        print("Saving assignment to:", args.assignment)
+        with span(profiler, 'save'):
+            Assignment.build(users, infected_uids, args.numToInfect,
+                             args.workers).save(args.assignment)
+
+    if profiler is not None:
+        print("Saving profile to:", args.profile)
+        profiler.save(args.profile)
 
     return
 
 
+def _component_index(filename, graph, workers):
+    '''the ComponentIndex saved to filename if it was built from graph,
+    else a new one, which is saved there'''
+    if os.path.exists(filename):
+        component_index = ComponentIndex.load(filename)
+        if component_index.matches(graph):
+            return component_index
+        print("The component index", filename, "was built from other users, "
+              "so it's built again.")
+    component_index = ComponentIndex.build(graph, workers)
+    component_index.save(filename)
+    return component_index
+
+
+def _run_external(args, profiler):
+    '''limited infection with --external'''
+    if args.tolerance is None:
+        args.tolerance = 0
+    if args.tolerance > 1.0:
+        args.tolerance = int(args.tolerance)
+    if args.numToInfect > 1.0:
+        args.numToInfect = int(args.numToInfect)
+    time1 = time()
+    graph, infected = limited_infection_external(
+        args.input, args.numToInfect, args.external, args.tolerance,
+        method=args.method, verbose=args.verbose, observer=profiler)
+    if args.verbose:
+        print("\nThe algorithm took: " + str(round((time() - time1)/60, 2)) +
+              " minutes.")
+    if args.output is None:
+        print("No ouput file specified, so results won't be saved")
+    else:
+        print("Saving infected users to:", args.output)
+        with span(profiler, 'save'):
+            save_infected_external(graph, infected, args.output,
+                                   args.outputFormat)
+    if profiler is not None:
+        print("Saving profile to:", args.profile)
+        profiler.save(args.profile)
+
+
+def _serve(lookup, port):
+    '''Answer queries about components over HTTP on localhost until
+    interrupted:
+        GET /component/<uid>: {"uid": ..., "component": ..., "size": ...}
+        GET /members/<uid>: the same, with "members": [uids, ...]'''
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    class _Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            parts = self.path.strip('/').split('/')
+            if len(parts) != 2 or parts[0] not in ('component', 'members'):
+                return self.send_error(404, "Try /component/<uid> or "
+                                       "/members/<uid>")
+            uid = _try_converting_to_int(parts[1])
+            try:
+                comp = lookup.component_of(uid)
+            except KeyError:
+                return self.send_error(404, "No user with that uid")
+            answer = {'uid': uid, 'component': comp,
+                      'size': lookup.size(comp)}
+            if parts[0] == 'members':
+                answer['members'] = lookup.members(comp).tolist()
+            body = json.dumps(answer).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('localhost', port), _Handler)
+    print("Answering component queries on port", port, "(Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
 if __name__ == '__main__':
     main()
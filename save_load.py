@@ -5,7 +5,24 @@ Created on Fri Oct 31 20:29:57 2014
 @author: garrett
 """
 
+import numpy as np
 from user import User
+from graph import Graph, STUDENT, _row_positions
+
+# bytes read from the file at a time by load_graph
+CHUNK_SIZE = 2**24
+# first bytes of a binary graph file (see save_graph)
+GRAPH_MAGIC = b'INFGRAPH'
+# the arrays of a Graph in a binary graph file, in order
+_GRAPH_ARRAYS = ('uids', 'indptr', 'indices', 'kinds')
+# arrays which may follow them, if the graph has weights
+_GRAPH_WEIGHTS = ('edge_weights', 'node_weights')
+# every array of a binary graph file starts at a multiple of this many bytes
+_GRAPH_ALIGNMENT = 64
+# users written at a time by save_infected
+ROWS_PER_WRITE = 10**5
+# formats save_infected can write
+OUTPUT_FORMATS = ('csv', 'uids', 'npy')
 
 
 def save_users(users, filename='output.csv'):
@@ -35,35 +52,403 @@ def load_users(filename):
     (if the user has any).  Note: the uid is not assumed to be an integer,
     so it read in as a string, which shouldn't matter anyway.
 
-    TODO: we could probably speed this up by loading multiple lines at a time.
-
     INPUT:
         > filename: filename to read .csv from
 
     RETURN:
        > users: a set of User objects'''
 
-    users = dict()
-
-    # On first read, we create Users, on the following read, we save student
-    # connections
-    with open(filename, 'r') as file:
-        for line in file:
-            line = line.split('\n')[0]
-            split_line = line.split(',')
-            new_uid = _try_converting_to_int(split_line[0])
-            new_user = User(new_uid)
-            users.update({new_user.get_uid(): new_user})
-    with open(filename, 'r') as file:
-        for line in file:
-            line = line.split('\n')[0]
-            split_line = line.split(',')
-            current_uid = _try_converting_to_int(split_line[0])
-            for student_uid in split_line[1:]:
-                student_uid = _try_converting_to_int(student_uid)
-                users[current_uid].add_students(users[student_uid])
-
-    return set(users.values())
+    graph = load_graph(filename)
+    # the users are only unique among themselves, so the same file can be
+    # loaded more than once
+    registry = set()
+    users = [User(uid, registry) for uid in graph.keys()]
+    for coach_i, user in enumerate(users):
+        students = graph.students(coach_i)
+        if len(students):
+            user.add_students([users[student_i]
+                               for student_i in students.tolist()])
+
+    return set(users)
+
+
+def save_infected(graph, infected, filename, output_format='csv',
+                  rows_per_write=ROWS_PER_WRITE):
+    '''Save the infected users of a graph straight from its arrays
+
+    Users are written in the order of the graph, a large block of them at a
+    time, without making a User object for any of them.
+
+    INPUT:
+        > graph: a Graph
+        > infected: boolean array telling which users to save (or an array
+                    of their node indices)
+        > filename: filename to save to
+        > output_format: one of OUTPUT_FORMATS:
+                         'csv': the format of save_users, where each row is
+                                a user's uid followed by its students' uids
+                         'uids': only the uids, one per line
+                         'npy': a NumPy .npy file with an array of the uids
+        > rows_per_write: number of users written at a time'''
+    nodes = np.asarray(infected)
+    if nodes.dtype == bool:
+        nodes = np.flatnonzero(nodes)
+    if output_format == 'npy':
+        with open(filename, 'wb') as file:
+            np.save(file, graph.uids[nodes], allow_pickle=True)
+        return
+    if output_format not in OUTPUT_FORMATS:
+        raise RuntimeError("Unknown output format:", output_format)
+
+    with open(filename, 'w') as file:
+        for start in range(0, len(nodes), rows_per_write):
+            block = nodes[start:start + rows_per_write]
+            if output_format == 'uids':
+                file.write('\n'.join(map(str, graph.uids[block].tolist())) +
+                           '\n')
+            else:
+                file.write(_csv_rows(graph, block))
+
+
+def _csv_rows(graph, nodes):
+    '''rows of the .csv format for the given nodes, as one string'''
+    # positions in graph.indices of the connections of every node
+    positions, counts = _row_positions(graph.indptr, nodes)
+    is_student = (graph.kinds[positions] & STUDENT) > 0
+    rows = np.repeat(np.arange(len(nodes)), counts)[is_student]
+    num_students = np.bincount(rows, minlength=len(nodes))
+
+    # every row is the user's uid followed by its students' uids
+    row_starts = np.cumsum(num_students + 1) - (num_students + 1)
+    tokens = np.empty(len(rows) + len(nodes), dtype=graph.uids.dtype)
+    is_row_uid = np.zeros(len(tokens), dtype=bool)
+    is_row_uid[row_starts] = True
+    tokens[is_row_uid] = graph.uids[nodes]
+    tokens[~is_row_uid] = graph.uids[graph.indices[positions[is_student]]]
+    separators = np.full(len(tokens), ',')
+    separators[np.append(row_starts[1:], len(tokens)) - 1] = '\n'
+    return ''.join(np.char.add(tokens.astype(str), separators).tolist())
+
+
+def load_uids(filename):
+    '''Load the set of user IDs saved with save_users or save_infected
+
+    For .csv files, only the first uid of each row counts, the students
+    listed after it don't.
+
+    INPUT:
+        > filename: filename to read .csv, uids or .npy file from
+
+    RETURN:
+        > uids: a set of user IDs'''
+    with open(filename, 'rb') as file:
+        is_npy = file.read(len(np.lib.format.MAGIC_PREFIX)) == \
+            np.lib.format.MAGIC_PREFIX
+        file.seek(0)
+        if is_npy:
+            return set(np.load(file, allow_pickle=True).tolist())
+        text = file.read()
+    row_uids, _, _ = _parse_lines(text + b'\n')
+    return set(row_uids.tolist())
+
+
+def save_graph(graph, filename):
+    '''Save a Graph to a binary graph file
+
+    The file is GRAPH_MAGIC followed by the uids, indptr, indices and kinds
+    arrays of the graph, each one in the .npy format and starting on a 64 byte
+    boundary, so that load_graph can memory map them instead of parsing
+    anything.  If the graph is weighted, the edge and node weights follow
+    (as empty arrays if they're None).
+
+    INPUT:
+        > graph: a Graph
+        > filename: filename to save the graph to'''
+    names = _GRAPH_ARRAYS
+    if graph.edge_weights is not None or graph.node_weights is not None:
+        names += _GRAPH_WEIGHTS
+    with open(filename, 'wb') as file:
+        file.write(GRAPH_MAGIC)
+        for name in names:
+            array = getattr(graph, name)
+            if array is None:
+                array = np.zeros(0, dtype=np.int64)
+            file.write(b'\0' * (-file.tell() % _GRAPH_ALIGNMENT))
+            np.lib.format.write_array(file, array, allow_pickle=True)
+
+
+def load_graph(filename, chunk_size=CHUNK_SIZE):
+    '''Load a Graph from a .csv file or a binary graph file
+
+    The .csv file has the same format as for load_users.  It's read in one
+    pass, a large chunk at a time, and each chunk is parsed into arrays of
+    user IDs with NumPy, so we never make a Python object per relationship.
+    Users who only appear as students get a node of their own too.
+
+    A binary graph file (see save_graph) is memory mapped, so loading is
+    almost instant and processes loading the same file share its memory.
+
+    INPUT:
+        > filename: filename to read from
+        > chunk_size: number of bytes of the .csv file to read at a time
+
+    RETURN:
+       > graph: a Graph with the users in the order of the file'''
+
+    if _is_graph_file(filename):
+        return _load_graph_file(filename)
+    return graph_from_batches(_parse_lines(lines) for lines
+                              in _csv_chunks(filename, chunk_size))
+
+
+def graph_from_batches(batches):
+    '''Build a Graph from batches of users and relationships, as they're
+    read from a .csv file or a database (see sources.py)
+
+    INPUT:
+        > batches: iterable of (row_uids, coach_uids, student_uids) arrays,
+                   where row_uids are users in the order they're to be
+                   numbered, and student_uids[k] is a student of
+                   coach_uids[k].  Users who only appear in relationships
+                   are numbered after all the rows.
+
+    RETURN:
+       > graph: a Graph'''
+    row_uids = []
+    coach_uids = []
+    student_uids = []
+    for batch in batches:
+        for uid_list, uids in zip((row_uids, coach_uids, student_uids),
+                                  batch):
+            uid_list.append(uids)
+
+    row_uids, coach_uids, student_uids = (_concatenate_uids(uid_list)
+                                          for uid_list in (row_uids,
+                                                           coach_uids,
+                                                           student_uids))
+    uids, (coaches, students) = _intern_uids(row_uids,
+                                             (coach_uids, student_uids))
+    return Graph.from_edges(uids, coaches, students)
+
+
+def _csv_chunks(filename, chunk_size=CHUNK_SIZE):
+    '''Read a .csv file about chunk_size bytes at a time, yielding whole
+    lines only (the rest of a chunk is kept for the next one).  Every chunk
+    ends with a newline.'''
+    leftover = b''
+    with open(filename, 'rb') as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            last_newline = chunk.rfind(b'\n')
+            if last_newline == -1:
+                leftover += chunk
+                continue
+            yield leftover + chunk[:last_newline + 1]
+            leftover = chunk[last_newline + 1:]
+    if leftover.strip():
+        yield leftover + b'\n'
+
+
+def _is_graph_file(filename):
+    '''True if filename is a binary graph file'''
+    with open(filename, 'rb') as file:
+        return file.read(len(GRAPH_MAGIC)) == GRAPH_MAGIC
+
+
+def _load_graph_file(filename):
+    '''Memory map the arrays of a binary graph file into a Graph'''
+    arrays = []
+    with open(filename, 'rb') as file:
+        file_size = file.seek(0, 2)
+        file.seek(len(GRAPH_MAGIC))
+        for name in _GRAPH_ARRAYS + _GRAPH_WEIGHTS:
+            if name in _GRAPH_WEIGHTS and file.tell() == file_size:
+                # the graph isn't weighted
+                break
+            file.seek(-file.tell() % _GRAPH_ALIGNMENT, 1)
+            start = file.tell()
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(file)
+            else:
+                header = np.lib.format.read_array_header_2_0(file)
+            shape, fortran_order, dtype = header
+            if dtype.hasobject:
+                # uids which aren't numbers can't be memory mapped
+                file.seek(start)
+                arrays.append(np.lib.format.read_array(file,
+                                                       allow_pickle=True))
+                continue
+            array = np.memmap(filename, dtype=dtype, mode='r',
+                              offset=file.tell(), shape=shape,
+                              order='F' if fortran_order else 'C')
+            file.seek(array.nbytes, 1)
+            arrays.append(array)
+    # empty weights stand for None
+    arrays[len(_GRAPH_ARRAYS):] = [array if len(array) else None
+                                   for array in arrays[len(_GRAPH_ARRAYS):]]
+    return Graph(*arrays)
+
+
+def _parse_lines(text):
+    '''Parse whole lines of the .csv format
+
+    INPUT:
+        > text: bytes ending with a newline
+
+    RETURN:
+        > row_uids: the first uid of every (non empty) line
+        > coach_uids: uid of the coach for every relationship
+        > student_uids: uid of the student for every relationship'''
+    chars = np.frombuffer(text, dtype=np.uint8)
+    is_blank = (chars == ord('\r')) | (chars == ord(' '))
+    if is_blank.any():
+        chars = chars[~is_blank]
+    is_newline = chars == ord('\n')
+    is_delimiter = is_newline | (chars == ord(','))
+    is_digit = (chars >= ord('0')) & (chars <= ord('9'))
+    if not np.all(is_digit | is_delimiter):
+        return _parse_lines_slowly(text)
+
+    # the delimiter ending every token, and where each token starts
+    token_ends = np.flatnonzero(is_delimiter)
+    token_starts = np.empty_like(token_ends)
+    token_starts[0] = 0
+    token_starts[1:] = token_ends[:-1] + 1
+    num_digits = token_ends - token_starts
+    if num_digits.max() > 18:
+        # the uid may not fit in 64 bits
+        return _parse_lines_slowly(text)
+    # read the tokens one digit at a time, all tokens at once
+    digits = chars.astype(np.int64) - ord('0')
+    values = np.zeros(len(token_ends), dtype=np.int64)
+    for digit_i in range(num_digits.max()):
+        longer = np.flatnonzero(num_digits > digit_i)
+        values[longer] = values[longer] * 10 + \
+            digits[token_starts[longer] + digit_i]
+
+    # drop empty tokens (empty lines, trailing commas, etc.)
+    non_empty = num_digits > 0
+    line_of_token = np.cumsum(is_newline[token_ends]) - \
+        is_newline[token_ends]
+    values = values[non_empty]
+    line_of_token = line_of_token[non_empty]
+    is_row_uid = np.ones(len(values), dtype=bool)
+    is_row_uid[1:] = line_of_token[1:] != line_of_token[:-1]
+    row_positions = np.flatnonzero(is_row_uid)
+    # the row uid of the line each token is on
+    coach_uids = values[row_positions][np.cumsum(is_row_uid) - 1]
+    return (values[is_row_uid], coach_uids[~is_row_uid],
+            values[~is_row_uid])
+
+
+def _parse_lines_slowly(text):
+    '''Same as _parse_lines, for uids that aren't all integers'''
+    tokens = []
+    is_row_uid = []
+    for line in text.decode().splitlines():
+        split_line = [token.strip() for token in line.split(',')
+                      if token.strip()]
+        if not split_line:
+            continue
+        tokens.extend(split_line)
+        is_row_uid.append(True)
+        is_row_uid.extend([False] * (len(split_line) - 1))
+    uids = _convert_tokens(tokens)
+    is_row_uid = np.array(is_row_uid, dtype=bool)
+    # the row uid of the line each token is on
+    coach_uids = uids[is_row_uid][np.cumsum(is_row_uid) - 1]
+    return (uids[is_row_uid], coach_uids[~is_row_uid], uids[~is_row_uid])
+
+
+def _convert_tokens(tokens):
+    '''Array of uids from string tokens, where the ones which are integers
+    become ints (like _try_converting_to_int, but for all tokens at once)'''
+    uids = _object_array(tokens)
+    if not len(tokens):
+        return uids
+    strings = np.array(tokens, dtype=str)
+    unsigned = np.char.lstrip(strings, '-')
+    num_signs = np.char.str_len(strings) - np.char.str_len(unsigned)
+    # longer ones may not fit in 64 bits, and are left to int()
+    is_int = np.char.isdigit(unsigned) & (num_signs <= 1) & \
+        (np.char.str_len(unsigned) <= 18)
+    if is_int.all():
+        return strings.astype(np.int64)
+    uids[is_int] = strings[is_int].astype(np.int64).tolist()
+    is_long = np.char.isdigit(unsigned) & (num_signs <= 1) & ~is_int
+    uids[is_long] = [int(token) for token in strings[is_long].tolist()]
+    return uids
+
+
+def _object_array(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def _concatenate_uids(uid_list):
+    '''concatenate arrays of uids, which are integers unless one of the
+    arrays holds other kinds of uid'''
+    if any(uids.dtype == object for uids in uid_list):
+        return _object_array([uid for uids in uid_list
+                              for uid in uids.tolist()])
+    if not uid_list:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(uid_list)
+
+
+def _intern_uids(row_uids, uid_arrays):
+    '''Turn uids into node indices
+
+    INPUT:
+        > row_uids: array of the uids of the rows, in order.  Their indices
+                    are the node indices.
+        > uid_arrays: arrays of uids to convert to node indices.  Any uid not
+                      in row_uids is given a new node index, after all the
+                      rows.
+
+    RETURN:
+        > uids: array of uid for every node
+        > node_arrays: node indices for each of uid_arrays'''
+    if row_uids.dtype == object or any(uids.dtype == object
+                                       for uids in uid_arrays):
+        node_of = {}
+        for uid in row_uids.tolist():
+            if uid in node_of:
+                _raise_duplicate(uid)
+            node_of[uid] = len(node_of)
+        node_arrays = [np.array([node_of.setdefault(uid, len(node_of))
+                                 for uid in uids.tolist()], dtype=np.int64)
+                       for uids in uid_arrays]
+        return _object_array(list(node_of)), node_arrays
+
+    row_order = np.argsort(row_uids, kind='stable')
+    sorted_rows = row_uids[row_order]
+    if len(sorted_rows) and np.any(sorted_rows[1:] == sorted_rows[:-1]):
+        _raise_duplicate(sorted_rows[1:][sorted_rows[1:] ==
+                                         sorted_rows[:-1]][0])
+    # uids which don't have a row of their own are added after the rows
+    positions = [np.searchsorted(sorted_rows, uids) for uids in uid_arrays]
+    is_new = [sorted_rows[np.minimum(pos, len(sorted_rows) - 1)] != uids
+              if len(sorted_rows) else np.ones(len(uids), dtype=bool)
+              for pos, uids in zip(positions, uid_arrays)]
+    new_uids = np.unique(np.concatenate([uids[new] for uids, new
+                                         in zip(uid_arrays, is_new)]))
+    node_arrays = []
+    for pos, uids, new in zip(positions, uid_arrays, is_new):
+        nodes = row_order[np.minimum(pos, len(row_order) - 1)] \
+            if len(row_order) else np.zeros(len(uids), dtype=np.int64)
+        nodes[new] = len(row_uids) + np.searchsorted(new_uids, uids[new])
+        node_arrays.append(nodes)
+    return np.concatenate((row_uids, new_uids)), node_arrays
+
+
+def _raise_duplicate(uid):
+    raise RuntimeError("You tried to create more than one user with "
+                       "uid:", uid, ". uids must be unique!")
 
 
 def _try_converting_to_int(num):
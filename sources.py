@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Garrett Reynolds
+"""
+
+import re
+import sqlite3
+from functools import partial
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+from save_load import (CHUNK_SIZE, _csv_chunks, _parse_lines,
+                       _concatenate_uids, graph_from_batches)
+
+# rows fetched from a database at a time
+BATCH_SIZE = 10**5
+# schemes of the URIs open_source understands
+SOURCE_SCHEMES = ('sqlite',)
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class EdgeSource:
+    '''Where the users and relationships of a graph are read from.
+
+    Sources stream them in batches of arrays, so that a graph can be built
+    (with load_source) without ever having a Python object per
+    relationship, however they're stored.'''
+
+    def batches(self):
+        '''Yield (row_uids, coach_uids, student_uids) arrays, see
+        save_load.graph_from_batches'''
+        raise NotImplementedError
+
+
+class CsvSource(EdgeSource):
+    '''The users of a .csv file in the format of load_users'''
+
+    def __init__(self, filename, chunk_size=CHUNK_SIZE):
+        self.filename = filename
+        self.chunk_size = chunk_size
+
+    def batches(self):
+        for lines in _csv_chunks(self.filename, self.chunk_size):
+            yield _parse_lines(lines)
+
+
+class SQLSource(EdgeSource):
+    '''Relationships from a table of a database with a DB-API connection,
+    fetched batch_size rows at a time.
+
+    The users who don't have any relationships are only in the graph if
+    there's a table of users too.  With several workers, the relationships
+    are read by that many processes, each reading ranges of the integer
+    key column (the rows in between a lowest and a highest key) over a
+    connection of its own.  The graph is the same for any number of
+    workers.'''
+
+    def __init__(self, connect, edge_table, coach_column='coach',
+                 student_column='student', user_table=None,
+                 uid_column='uid', key_column=None, batch_size=BATCH_SIZE,
+                 workers=1):
+        '''
+        INPUT:
+            > connect: function without arguments which opens a DB-API
+                       connection.  It must be picklable (e.g. a
+                       functools.partial of a module's connect function)
+                       if there are several workers.
+            > edge_table: table with a row per relationship
+            > coach_column, student_column: its columns with the uids of
+                                            the coach and the student
+            > user_table: (optional) table with a row per user, numbered
+                          in the order of the key column if there is one
+            > uid_column: its column of uids
+            > key_column: (optional) integer column of both tables to order
+                          and range-partition the rows by, e.g. rowid
+            > batch_size: number of rows fetched at a time, and about the
+                          number of keys read by a worker at a time
+            > workers: number of processes reading relationships'''
+        for name in (edge_table, coach_column, student_column, user_table,
+                     uid_column, key_column):
+            if name is not None and not _IDENTIFIER.match(name):
+                raise RuntimeError("Not a valid table or column name:", name)
+        if workers > 1 and key_column is None:
+            raise RuntimeError("Reading with several workers needs a key "
+                               "column to split the rows by.")
+        self.connect = connect
+        self.edge_table = edge_table
+        self.coach_column = coach_column
+        self.student_column = student_column
+        self.user_table = user_table
+        self.uid_column = uid_column
+        self.key_column = key_column
+        self.batch_size = batch_size
+        self.workers = workers
+
+    def batches(self):
+        empty = np.zeros(0, dtype=np.int64)
+        if self.user_table is not None:
+            query = self._query(self.user_table, (self.uid_column,))
+            for uids, in _read(self.connect, query, 1, self.batch_size):
+                yield uids, empty, empty
+        if self.workers == 1:
+            for coaches, students in _read(self.connect, self._edge_query(),
+                                           2, self.batch_size):
+                yield empty, coaches, students
+            return
+
+        from multiprocessing import Pool
+        pool = Pool(self.workers)
+        try:
+            tasks = [(self.connect, self._edge_query(key_range),
+                      self.batch_size) for key_range in self._key_ranges()]
+            # in order, but as soon as each range has been read
+            for coaches, students in pool.imap(_read_edges, tasks):
+                yield empty, coaches, students
+        finally:
+            pool.close()
+            pool.join()
+
+    def _query(self, table, columns, key_range=None):
+        query = 'SELECT ' + ', '.join(columns) + ' FROM ' + table
+        if self.key_column is None:
+            return query
+        if key_range is not None:
+            # the bounds are integers we made, so they're safe to format
+            query += ' WHERE {0} >= {1:d} AND {0} < {2:d}'.format(
+                self.key_column, *key_range)
+        return query + ' ORDER BY ' + self.key_column
+
+    def _edge_query(self, key_range=None):
+        return self._query(self.edge_table, (self.coach_column,
+                                             self.student_column), key_range)
+
+    def _key_ranges(self):
+        '''ranges of keys of the relationships, of about batch_size keys
+        each'''
+        query = 'SELECT MIN({0}), MAX({0}) FROM {1}'.format(self.key_column,
+                                                          self.edge_table)
+        lowest, highest = [column.tolist()[0] for column
+                           in next(_read(self.connect, query, 2, 1))]
+        if lowest is None:
+            return []
+        num_ranges = max(1, -(-(highest - lowest + 1) // self.batch_size))
+        bounds = np.linspace(lowest, highest + 1, num_ranges + 1)
+        bounds = np.unique(np.round(bounds).astype(np.int64)).tolist()
+        return list(zip(bounds[:-1], bounds[1:]))
+
+
+class SQLiteSource(SQLSource):
+    '''An SQLSource for an SQLite database file, ordered (and split
+    between workers) by rowid'''
+
+    def __init__(self, path, edge_table, coach_column='coach',
+                 student_column='student', user_table=None,
+                 uid_column='uid', batch_size=BATCH_SIZE, workers=1):
+        SQLSource.__init__(self, partial(sqlite3.connect, path), edge_table,
+                           coach_column, student_column, user_table,
+                           uid_column, 'rowid', batch_size, workers)
+
+
+def load_source(source):
+    '''Build a Graph from an EdgeSource'''
+    return graph_from_batches(source.batches())
+
+
+def is_source_uri(name):
+    '''True if name is the URI of a database rather than a filename'''
+    return name.split('://', 1)[0] in SOURCE_SCHEMES and '://' in name
+
+
+def open_source(uri, batch_size=BATCH_SIZE, workers=1):
+    '''EdgeSource for a database URI, e.g.
+
+        sqlite:///path/to/users.db?edges=relationships&users=users
+
+    where the query gives the table of relationships ('edges', with
+    columns 'coach' and 'student' unless 'coach=' and 'student=' name
+    others), and optionally a table of users ('users', with a column 'uid'
+    unless 'uid=' names another).  sqlite://relative/path.db works too.'''
+    parts = urlsplit(uri)
+    if parts.scheme not in SOURCE_SCHEMES:
+        raise RuntimeError("Unknown kind of database:", parts.scheme)
+    options = dict((key, values[-1])
+                   for key, values in parse_qs(parts.query).items())
+    if 'edges' not in options:
+        raise RuntimeError("The URI must name the table of relationships, "
+                           "e.g. '?edges=relationships'")
+    unknown = set(options) - set(('edges', 'coach', 'student', 'users',
+                                  'uid'))
+    if unknown:
+        raise RuntimeError("Unknown options in the URI:", sorted(unknown))
+    path = parts.netloc + parts.path
+    return SQLiteSource(path, options['edges'],
+                        options.get('coach', 'coach'),
+                        options.get('student', 'student'),
+                        options.get('users'), options.get('uid', 'uid'),
+                        batch_size, workers)
+
+
+def _read(connect, query, num_columns, batch_size):
+    '''Yield the columns of the rows of a query as arrays, batch_size rows
+    at a time, over a connection of its own'''
+    connection = connect()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield _columns(rows, num_columns)
+        cursor.close()
+    finally:
+        connection.close()
+
+
+def _read_edges(task):
+    '''all the relationships of a query, as (coach_uids, student_uids), in
+    a worker process'''
+    connect, query, batch_size = task
+    columns = list(_read(connect, query, 2, batch_size))
+    return tuple(_concatenate_uids([batch[column] for batch in columns])
+                 for column in range(2))
+
+
+def _columns(rows, num_columns):
+    '''arrays of the columns of rows, which are integers unless some uids
+    are something else'''
+    array = np.array(rows)
+    if array.dtype.kind not in 'iu':
+        # e.g. strings, which NumPy would also make of any numbers
+        array = np.empty((len(rows), num_columns), dtype=object)
+        array[:] = rows
+    return tuple(array[:, column] for column in range(num_columns))
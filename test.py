@@ -7,9 +7,36 @@
 
 from __future__ import print_function, division
 from user import User
-from infections import total_infection, limited_infection
-from save_load import save_users, load_users
+from graph import Graph, UidIndex
+from components import (label_components, ComponentIndex, ComponentLookup,
+                        PARALLEL_MAX_CROSSING)
+from infections import (total_infection, limited_infection, evaluate_split,
+                        limited_infection_groups, infection_sweep,
+                        _split_component, _split_graph, _select_components,
+                        _multi_start_split, _kernighan_lin,
+                        _uid_mask, PARTITIONERS)
+from save_load import (save_users, load_users, load_graph, save_graph,
+                       save_infected, load_uids)
+from benchmark import generate_graph, _kernighan_lin_sets
+from profiling import Profiler
+from external import (ExternalGraph, limited_infection_external,
+                      save_infected_external)
+from sources import SQLiteSource, load_source, open_source
+from assignment import Assignment, SPLIT
+import numpy as np
 from numpy import random
+import os
+import shutil
+import sqlite3
+import tempfile
+
+# directory the tests write their files to, made by run_tests
+_temp_dir = None
+
+
+def _temp_path(name):
+    '''path of a file in the directory the tests write to'''
+    return os.path.join(_temp_dir, name)
 
 
 def _create_users(num_users=1000, max_comp_size=50, prob_students=0.1,
@@ -136,6 +163,209 @@ def _test_limited_infection_example_small():
     return True
 
 
+def _test_graph_example_small():
+    users = _create_example_small()
+    graph = Graph.from_users(users.values())
+    assert(len(graph) == 10 and graph.num_edges == 11)
+    assert(set(user.get_uid() for user in graph[2].get_students())
+           == set((0, 3)))
+    assert(set(user.get_uid() for user in graph[8].get_coaches())
+           == set((4, 5, 7)))
+    assert(total_infection(graph[7]) == set((4, 5, 6, 7, 8)))
+    for num_to_infect in [4, 5, 9]:
+        assert(limited_infection(graph, num_to_infect)
+               == limited_infection(users, num_to_infect))
+    sub = graph.subgraph([4, 5, 6])
+    assert(sub.keys() == [4, 5, 6] and sub.num_edges == 3)
+
+    # uids which don't fit in an int64 are kept as Python ints
+    User.clear_users()
+    users = {uid: User(uid) for uid in (2**64 - 1, 1, 2)}
+    users[1].add_students(users[2**64 - 1])
+    graph = Graph.from_users(users.values())
+    assert(graph.uids.dtype == object and 2**64 - 1 in graph)
+    assert(limited_infection(users, 2) == set((1, 2**64 - 1)))
+    assert(graph.get_uid_index().indices_of([2**64 - 1, 2**70]).tolist()
+           == [0, -1])
+    # and NumPy integers are integers too
+    graph = Graph.from_edges([np.int64(5), np.int32(6)], [0], [1])
+    assert(graph.uids.dtype == np.int64)
+    assert(Graph.from_edges([5, 6], [0], [1]).get_uid_index()
+           .indices_of([2**64 - 1, 6]).tolist() == [-1, 1])
+    return True
+
+
+def _test_components_long_chain(chain_length=20000):
+    '''a teacher of a teacher of a teacher ... used to break the recursion'''
+    User.clear_users()
+    users = {uid: User(uid) for uid in range(chain_length + 1)}
+    for uid in range(chain_length - 1):
+        users[uid].add_students(users[uid + 1])
+    assert(len(total_infection(users[0])) == chain_length)
+
+    labels, sizes = label_components(Graph.from_users(users.values()))
+    assert(list(sizes) == [chain_length, 1])
+    assert(labels[0] == labels[chain_length - 1] == 0)
+    assert(limited_infection(users, 1) == set((chain_length,)))
+    return True
+
+
+def _test_component_index_example_small():
+    filename = _temp_path('index.npz')
+    users = _create_example_small()
+    index = ComponentIndex.build(users)
+    assert(limited_infection(users, 5, component_index=index)
+           == set((4, 5, 6, 7, 8)))
+    # join the first and third components
+    users[9].add_coaches(users[3])
+    assert(index.component_of(9) == index.component_of(0))
+    assert(sorted(index.components()[1]) == [5, 5])
+    # splits {4, 5, 6, 8} from {7}
+    users[7].remove_students(users[8])
+    assert(limited_infection(users, 1, component_index=index) == set((7,)))
+    # new users join as components of their own
+    users[10] = User(10)
+    users[10].add_students(users[7])
+    assert(sorted(index.components()[1]) == [2, 4, 5])
+
+    index.save(filename)
+    index.unwatch()
+    loaded = ComponentIndex.load(filename)
+    assert(loaded.component_of(10) == loaded.component_of(7))
+    assert(loaded.component_of(10) != loaded.component_of(8))
+
+    # users of another group, with the same uids, don't change the index
+    User.clear_users()
+    users = {uid: User(uid) for uid in range(4)}
+    users[0].add_students(users[1])
+    index = ComponentIndex.build(users)
+    with open(filename, 'w') as file:
+        file.write('0,2\n1\n2\n3,100\n')
+    load_users(filename)
+    labels, sizes = index.components()
+    assert(labels.tolist() == [0, 0, 1, 2] and sizes.tolist() == [2, 1, 1])
+    # but new users of the group do, once they're added to it
+    users[4] = User(4)
+    assert(index.components()[1].tolist() == [2, 1, 1, 1])
+    users[4].add_coaches(users[3])
+    assert(index.components()[1].tolist() == [2, 1, 2])
+    index.unwatch()
+
+    # a user given relationships before it's added to the group keeps them
+    User.clear_users()
+    users = _create_example_small()
+    index = ComponentIndex.build(users)
+    user = User(10)
+    user.add_coaches(users[9])
+    users[10] = user
+    assert(sorted(index.components()[1]) == [2, 4, 5])
+    assert(index.component_of(10) == index.component_of(9))
+    # and a component which may have fallen apart is searched again even
+    # when its users have relationships with users outside the group
+    users[3].add_students(User(99))
+    users[10].add_students(users[0])
+    users[10].remove_students(users[0])
+    assert(sorted(index.components()[1]) == [2, 4, 5])
+    index.unwatch()
+
+    # a saved index tells whether it was built from the same graph
+    users = _create_example_small()
+    graph = Graph.from_users(users.values())
+    ComponentIndex.build(graph).save(filename)
+    assert(ComponentIndex.load(filename).matches(graph))
+    users[9].add_students(users[8])
+    assert(not ComponentIndex.load(filename).matches(
+        Graph.from_users(users.values())))
+    return True
+
+
+def _test_uid_index():
+    filename = _temp_path('example_small.csv')
+    index = UidIndex(np.array([40, 10, 30, 20], dtype=np.int64))
+    assert(index.indices_of([10, 20, 50, 40, 'a']).tolist() ==
+           [1, 3, -1, 0, -1])
+    assert(index.index_of(30) == 2 and 30 in index and 'a' not in index)
+    assert(index.mask_of(np.array([20, 30])).tolist() ==
+           [False, False, True, True])
+    try:
+        index.index_of(50)
+        assert(False)
+    except KeyError:
+        pass
+    mixed = UidIndex(np.array(['a', 2, 'b'], dtype=object))
+    assert(mixed.indices_of(['b', 2, 3]).tolist() == [2, 1, -1])
+
+    # graphs (and users loaded from a file) with the same uids don't clash
+    save_users(_create_example_small().values(), filename)
+    first, second = load_graph(filename), load_graph(filename)
+    assert(first.index_of(7) == second.index_of(7))
+    assert(len(load_users(filename)) == len(load_users(filename)) == 10)
+    return True
+
+
+def _test_load_graph_example_small():
+    filename = _temp_path('example_small.csv')
+    users = _create_example_small()
+    save_users(users.values(), filename)
+    graph = load_graph(filename, chunk_size=16)
+    assert(graph.keys() == list(range(10)))
+    for uid, user in users.items():
+        assert(set(student.get_uid() for student in graph[uid].get_students())
+               == set(student.get_uid() for student in user.get_students()))
+
+    # uids don't have to be integers
+    with open(filename, 'w') as file:
+        file.write('a,b,2\r\nb\n2,a\n\n')
+    graph = load_graph(filename)
+    assert(graph.keys() == ['a', 'b', 2] and graph.num_edges == 2)
+    User.clear_users()
+    assert(set(user.get_uid() for user in load_users(filename))
+           == set(('a', 'b', 2)))
+    # uids too long for 64 bits stay exact
+    with open(filename, 'w') as file:
+        file.write('18446744073709551615,1\n12345678901234567890\n')
+    graph = load_graph(filename)
+    assert(graph.keys() == [18446744073709551615, 12345678901234567890, 1])
+    return True
+
+
+def _test_graph_file_example_small():
+    filename = _temp_path('example_small.bin')
+    users = _create_example_small()
+    graph = Graph.from_users(users.values())
+    save_graph(graph, filename)
+    loaded = load_graph(filename)
+    assert(loaded.keys() == graph.keys())
+    assert((loaded.indptr == graph.indptr).all())
+    assert((loaded.indices == graph.indices).all())
+    assert((loaded.kinds == graph.kinds).all())
+    assert(limited_infection(loaded, 5) == set((4, 5, 6, 7, 8)))
+    return True
+
+
+def _test_save_infected_example_small():
+    filename = _temp_path('infected')
+    users = _create_example_small()
+    graph = Graph.from_users(users.values())
+    infected = np.zeros(len(graph), dtype=bool)
+    infected[[0, 2, 4, 9]] = True
+    save_users([users[uid] for uid in [0, 2, 4, 9]], filename + '.csv')
+    with open(filename + '.csv') as file:
+        expected_rows = set(frozenset(line.strip().split(','))
+                            for line in file)
+    # a few users at a time, to check the blocks join up
+    save_infected(graph, infected, filename + '.csv', rows_per_write=3)
+    with open(filename + '.csv') as file:
+        rows = [frozenset(line.strip().split(',')) for line in file]
+    assert(set(rows) == expected_rows and len(rows) == 4)
+    for output_format in ['csv', 'uids', 'npy']:
+        save_infected(graph, infected, filename + '.' + output_format,
+                      output_format, rows_per_write=3)
+        assert(load_uids(filename + '.' + output_format) ==
+               set([0, 2, 4, 9]))
+    return True
+
+
 def _test_total_infection_example_large(users_example_large):
     infected_user = users_example_large[0]
     try:
@@ -168,12 +398,520 @@ def _test_limited_infection_example_large(users_example_large):
     return True
 
 
+def _test_incremental_rollout_example_large(users_example_large):
+    previous = limited_infection(users_example_large, num_to_infect=1500)
+    for num_to_infect in [3000, 4550, 1000]:
+        # uids which aren't users any more are ignored
+        infected_users = limited_infection(users_example_large,
+                                           num_to_infect=num_to_infect,
+                                           previous=previous | set([-1]))
+        assert(len(infected_users) == num_to_infect)
+        if num_to_infect > len(previous):
+            assert(previous <= infected_users)
+        else:
+            assert(infected_users <= previous)
+        previous = infected_users
+    return True
+
+
+def _test_workers_example_large(users_example_large):
+    graph = Graph.from_users(users_example_large.values())
+    labels, sizes = label_components(graph)
+    # in no particular order, most relationships cross between the ranges
+    # of the workers, so they're left out; in the order of the components,
+    # few do (only those of components split between ranges)
+    ordered = graph.subgraph(np.argsort(labels, kind='stable'))
+    chunk_size = -(-len(graph) // 3)
+    crossing = (ordered.edge_sources() // chunk_size !=
+                ordered.indices // chunk_size)
+    assert(0 < crossing.mean() <= PARALLEL_MAX_CROSSING)
+    for test_graph in [graph, ordered]:
+        labels, sizes = label_components(test_graph)
+        labels_parallel, sizes_parallel = label_components(
+            test_graph, workers=3, min_parallel_users=0)
+        assert(np.array_equal(labels, labels_parallel))
+        assert(np.array_equal(sizes, sizes_parallel))
+    assert(limited_infection(graph, 2345, workers=3) ==
+           limited_infection(graph, 2345))
+    return True
+
+
+def _test_profiler_example_large(users_example_large):
+    profiler = Profiler()
+    # no whole components add up to 50, so one has to be split
+    limited_infection(users_example_large, 50, method='fm',
+                      observer=profiler)
+    report = profiler.report()
+    for phase in ['components', 'selection', 'split', 'partition']:
+        assert(report['spans'][phase]['calls'] == 1)
+    assert(report['counters']['fm_passes'] ==
+           len(report['values']['fm_gain']))
+    assert(sum(count for _, _, count in
+               report['histograms']['component_sizes']) == 28)
+    return True
+
+
+def _test_evaluate_split_example_large(users_example_large):
+    graph = Graph.from_users(users_example_large.values())
+    infected_uids = limited_infection(graph, 50)
+    infected = np.array([uid in infected_uids for uid in graph.keys()])
+    num_conflicts, comp_conflicts, boundary = evaluate_split(graph, infected)
+    # pairs of users (counted once, even if they coach each other) split up
+    conflicts = set(frozenset((uid, student.get_uid()))
+                    for uid, user in users_example_large.items()
+                    for student in user.get_students()
+                    if (uid in infected_uids) !=
+                    (student.get_uid() in infected_uids))
+    assert(num_conflicts == len(conflicts))
+    # only the split component has conflicts
+    assert(comp_conflicts.sum() == num_conflicts)
+    assert((comp_conflicts > 0).sum() == 1)
+    assert(graph.get_uids(boundary) == set(uid for pair in conflicts
+                                           for uid in pair))
+    return True
+
+
+def _test_component_lookup_example_large(users_example_large):
+    graph = Graph.from_users(users_example_large.values())
+    lookup = ComponentLookup.build(graph, cache_size=2)
+    assert(len(lookup) == 28)
+    comp = lookup.component_of(0)
+    assert(lookup.size(comp) == 38)
+    assert(lookup.member_set(comp) == total_infection(graph[0]))
+    assert(total_infection(graph[0], component_lookup=lookup) is
+           lookup.member_set(comp))
+    # members are a view of the index, not a copy (the users are loaded
+    # in no particular order, so comp may be the last component)
+    other_comp = comp + 1 if comp + 1 < len(lookup) else comp - 1
+    assert(lookup.members(comp).base is lookup.members(other_comp).base)
+    for uid in [100, 5000, 9999]:
+        assert(total_infection(graph[uid], component_lookup=lookup) ==
+               total_infection(graph[uid]))
+    # only the last two member sets are kept
+    assert(len(lookup._cache) == 2)
+    # the uids are dense, so they're looked up in a table, and spreading
+    # them out leaves the binary search, with the same answers
+    assert(lookup._table is not None)
+    sparse = ComponentLookup(graph.uids * 1000, lookup.components_of(
+        graph.uids))
+    assert(sparse._table is None)
+    for uid in [0, 100, 5000, 9999]:
+        assert(sparse.component_of(uid * 1000) == lookup.component_of(uid))
+    for bad_uid in [-1, 10000, 'a', 2**70]:
+        try:
+            lookup.component_of(bad_uid)
+            raise AssertionError(bad_uid)
+        except KeyError:
+            pass
+    return True
+
+
+def _test_weighted_split(num_users=20):
+    # a ring where users 7 to 16 share a zip code, and the rest share
+    # another one.  Unweighted, every half of the ring is as good as any
+    # other, but with attribute weights only one is.
+    ring = np.arange(num_users)
+    graph = Graph.from_edges(ring, ring, (ring + 1) % num_users)
+    zip_codes = (ring + 3) // 10 % 2
+    graph = graph.with_weights(graph.attribute_weights(zip_codes))
+    for method in sorted(PARTITIONERS):
+        split = _split_graph(graph, num_users // 2, method=method)
+        assert(split.sum() == num_users // 2)
+        assert(evaluate_split(graph, split)[0] == 2)
+        assert(len(set(zip_codes[split].tolist())) == 1)
+    return True
+
+
+def _test_node_weights_example_large(users_example_large):
+    graph = Graph.from_users(users_example_large.values())
+    labels, sizes = label_components(graph)
+    # a component which has to be split
+    comp = np.flatnonzero(labels == np.argmin(np.abs(sizes - 300)))
+    random_state = np.random.RandomState(0)
+    for max_weight in [3, 4, 8]:
+        node_weights = random_state.randint(1, max_weight + 1, len(graph))
+        weighted = graph.with_weights(node_weights=node_weights)
+        comp_graph = weighted.subgraph(comp)
+        comp_weight = comp_graph.total_weight()
+        for method in sorted(PARTITIONERS):
+            for num_to_infect in [50, 2345, 7001]:
+                infected = _uid_mask(graph.uids, limited_infection(
+                    weighted, num_to_infect, method=method))
+                # within half the weight of the heaviest user
+                assert(abs(int(node_weights[infected].sum()) -
+                           num_to_infect) <= max_weight // 2)
+            for num_to_infect in [comp_weight // 7, comp_weight // 3,
+                                  comp_weight // 2 + 1]:
+                infected = _split_graph(comp_graph, num_to_infect,
+                                        method=method)
+                assert(abs(int(comp_graph.node_weights[infected].sum()) -
+                           num_to_infect) <= max_weight // 2)
+    return True
+
+
+def _test_external_example_large(filename='test_data/example_large.csv'):
+    work_dir = _temp_path('external')
+    graph = load_graph(filename)
+    # small chunks and blocks, so the file and users are gone through in
+    # many pieces
+    external = ExternalGraph(filename, work_dir, chunk_size=4096,
+                             block_size=1000)
+    assert(np.array_equal(external.uids, graph.uids))
+    labels, sizes = external.label_components()
+    expected_labels, expected_sizes = label_components(graph)
+    assert(np.array_equal(labels, expected_labels))
+    assert(np.array_equal(sizes, expected_sizes))
+    for num_to_infect in [2345, 50]:
+        external, infected = limited_infection_external(
+            filename, num_to_infect, work_dir, chunk_size=4096,
+            block_size=1000)
+        assert(infected.sum() == num_to_infect)
+        for output_format in ['csv', 'uids', 'npy']:
+            output = os.path.join(work_dir, 'infected.' + output_format)
+            save_infected_external(external, infected, output, output_format)
+            assert(load_uids(output) == set(graph.uids[infected].tolist()))
+    return True
+
+
+def _test_multi_start(num_users=20000):
+    graph = generate_graph(num_users, seed=3)
+    labels, sizes = label_components(graph)
+    comp_graph = graph.subgraph(np.flatnonzero(labels == np.argmax(sizes)))
+    num_to_infect = len(comp_graph) // 3
+    infected, seed, cuts = _multi_start_split(comp_graph, num_to_infect,
+                                              method='fm', starts=10, seed=0)
+    assert(infected.sum() == num_to_infect)
+    assert(evaluate_split(comp_graph, infected)[0] == min(cuts))
+    # stops after 3 starts in a row without improving
+    assert(len(cuts) < 10)
+    # the same starts are kept when they're run two at a time
+    infected_2, seed_2, cuts_2 = _multi_start_split(
+        comp_graph, num_to_infect, method='fm', starts=10, seed=0,
+        workers=2)
+    assert(np.array_equal(infected, infected_2) and cuts == cuts_2 and
+           seed == seed_2)
+    # and the best start can be made again from its seed
+    profiler = Profiler()
+    assert(np.array_equal(_split_graph(comp_graph, num_to_infect,
+                                       method='fm', seed=seed,
+                                       observer=profiler), infected))
+    assert(profiler.values['split_seed'] == [seed])
+    # with 'grow', every start grows from its own random user
+    infected, seed, cuts = _multi_start_split(comp_graph, num_to_infect,
+                                              method='grow', starts=4,
+                                              seed=0, patience=4)
+    assert(infected.sum() == num_to_infect and len(set(cuts)) > 1)
+    return True
+
+
+def _test_grow(num_users=200000):
+    # classes hanging off schools: every component is a tree
+    graph = generate_graph(num_users, seed=5, prob_coach=0.)
+    labels, sizes = label_components(graph)
+    comp_graph = graph.subgraph(np.flatnonzero(labels == np.argmax(sizes)))
+    num_to_infect = len(comp_graph) // 3
+    grown = _split_graph(comp_graph, num_to_infect, method='grow')
+    assert(grown.sum() == num_to_infect)
+    refined = _split_graph(comp_graph, num_to_infect, method='fm',
+                           initial='grow')
+    from_first = _split_graph(comp_graph, num_to_infect, method='fm')
+    assert(refined.sum() == num_to_infect)
+    # growing is far better on trees, and refining it can only help
+    assert(evaluate_split(comp_graph, refined)[0] <=
+           evaluate_split(comp_graph, grown)[0] <
+           evaluate_split(comp_graph, from_first)[0] / 4)
+    return True
+
+
+def _test_kernighan_lin_example_large(users_example_large):
+    graph = Graph.from_users(users_example_large.values())
+    labels, sizes = label_components(graph)
+    # the same splits as the original implementation
+    for comp in np.flatnonzero((sizes > 2) & (sizes < 150)).tolist():
+        comp_graph = graph.subgraph(np.flatnonzero(labels == comp))
+        infected = np.zeros(len(comp_graph), dtype=bool)
+        infected[:len(comp_graph) // 3] = True
+        assert(np.array_equal(_kernighan_lin(comp_graph, infected),
+                              _kernighan_lin_sets(comp_graph, infected)))
+    return True
+
+
+def _test_groups(num_users=20000):
+    graph = generate_graph(num_users, seed=3)
+    labels, sizes = label_components(graph)
+    comp_graph = graph.subgraph(np.flatnonzero(labels == np.argmax(sizes)))
+    num_users = len(comp_graph)
+    group_uids = limited_infection_groups(comp_graph, [50., 30., 20.],
+                                          method='fm')
+    assert([len(uids) for uids in group_uids] ==
+           [num_users // 2, int(round(0.8 * num_users)) - num_users // 2,
+            num_users - int(round(0.8 * num_users))])
+    groups = np.zeros(num_users, dtype=np.int64)
+    for group, uids in enumerate(group_uids):
+        groups[_uid_mask(comp_graph.uids, uids)] = group
+
+    # better than splitting off one group at a time
+    first = _uid_mask(comp_graph.uids, limited_infection(
+        comp_graph, len(group_uids[0]), method='fm'))
+    rest = np.flatnonzero(~first)
+    rest_graph = comp_graph.subgraph(rest)
+    second = _uid_mask(rest_graph.uids, limited_infection(
+        rest_graph, len(group_uids[1]), method='fm'))
+    one_at_a_time = np.full(num_users, 2, dtype=np.int64)
+    one_at_a_time[first] = 0
+    one_at_a_time[rest[second]] = 1
+    assert(evaluate_split(comp_graph, groups)[0] <
+           evaluate_split(comp_graph, one_at_a_time)[0])
+    try:
+        limited_infection_groups(comp_graph, [50., 50.], tol=1.5)
+        assert(False)
+    except RuntimeError:
+        pass
+    return True
+
+
+def _test_groups_example_large(users_example_large):
+    graph = Graph.from_users(users_example_large.values())
+    group_uids = limited_infection_groups(graph, [2000, 3000, 5000])
+    assert([len(uids) for uids in group_uids] == [2000, 3000, 5000])
+    assert(set.union(*group_uids) == set(graph.uids.tolist()))
+    # whole components fit these, so no relationship is between groups
+    groups = np.zeros(len(graph), dtype=np.int64)
+    for group, uids in enumerate(group_uids):
+        groups[_uid_mask(graph.uids, uids)] = group
+    assert(evaluate_split(graph, groups)[0] == 0)
+    return True
+
+
+def _count_conflicts(users, infected_uids):
+    '''number of coach-student relationships between the groups'''
+    return sum(1 for uid, user in users.items()
+               for student in user.get_students()
+               if (uid in infected_uids) != (student.get_uid() in
+                                             infected_uids))
+
+
+def _test_split_methods_example_large(users_example_large):
+    # a component of the large example, in a fixed order
+    component = Graph.from_users(users_example_large[uid] for uid in
+                                 sorted(total_infection(
+                                     users_example_large[0])))
+    # the splits start off by infecting the first users
+    start_conflicts = _count_conflicts(users_example_large,
+                                       set(component.uids[:10].tolist()))
+    for method in ['kl', 'fm', 'multilevel']:
+        infected_uids = _split_component(component, 10, method=method)
+        assert(len(infected_uids) == 10)
+        assert(_count_conflicts(users_example_large, infected_uids) <
+               start_conflicts)
+    return True
+
+
+def _test_select_components():
+    comp_counts = np.array([1000] * 50 + [999] * 3 + [7])
+    comps_to_keep = _select_components(comp_counts, 3997)
+    assert(comp_counts[comps_to_keep].sum() == 3997)
+    # mostly greedy when the target is large
+    comp_counts_large = np.array([1000] * 50 + [3] * 5)
+    comps_to_keep = _select_components(comp_counts_large, 20012,
+                                       max_work=10**4)
+    assert(comp_counts_large[comps_to_keep].sum() == 20012)
+    assert(_select_components(comp_counts, 3996) is None)
+    assert(comp_counts[_select_components(comp_counts, 3996, tol=1)].sum()
+           == 3997)
+    return True
+
+
+def _test_multilevel_shuffled_chain(chain_length=5000):
+    '''the best split of a chain cuts it once, wherever the users are in the
+    graph's order'''
+    order = random.RandomState(0).permutation(chain_length)
+    graph = Graph.from_edges(order.argsort(), order[:-1], order[1:])
+    infected_uids = _split_component(graph, 1234, method='multilevel')
+    assert(len(infected_uids) == 1234)
+    num_conflicts = sum(1 for uid in range(chain_length - 1)
+                        if (uid in infected_uids) != (uid + 1 in
+                                                      infected_uids))
+    assert(num_conflicts <= 2)
+    return True
+
+
+def _test_multilevel_stars(num_coaches=20, num_students=100):
+    '''coaches in a chain, each with students who aren't related to each
+    other, only shrink when students of the same coach are matched up'''
+    coaches = np.arange(num_coaches) * (num_students + 1)
+    students = np.arange(num_coaches * (num_students + 1))
+    students = students[~np.isin(students, coaches)]
+    graph = Graph.from_edges(
+        np.arange(len(students) + num_coaches),
+        np.concatenate((coaches[:-1], np.repeat(coaches, num_students))),
+        np.concatenate((coaches[1:], students)))
+    profiler = Profiler()
+    num_to_infect = len(graph) // 2
+    split = _split_graph(graph, num_to_infect, method='multilevel',
+                         observer=profiler)
+    assert(split.sum() == num_to_infect)
+    # half the coaches with all their students, so one conflict
+    assert(evaluate_split(graph, split)[0] == 1)
+    level_sizes = profiler.report()['values']['multilevel_level_sizes'][0]
+    assert(level_sizes[-1] <= 200)
+    return True
+
+
+def _test_generate_graph():
+    graph = generate_graph(20000, seed=3, max_comp_size=500)
+    assert(len(graph) == 20000)
+    _, sizes = label_components(graph)
+    assert(sizes.max() <= 500)
+    # lots of lone users, and the same graph for the same seed
+    assert(np.sum(sizes == 1) > len(sizes) // 4)
+    assert(np.array_equal(generate_graph(20000, seed=3,
+                                         max_comp_size=500).indices,
+                          graph.indices))
+    return True
+
+
+def _test_sweep_example_large(users_example_large):
+    graph = Graph.from_users(users_example_large.values())
+    targets = [50, 0.1, 2345, 5000]
+    # without the subset sum table, only the greedy pass picks components
+    for max_work in [None, 0]:
+        sweep = infection_sweep(graph, targets, method='fm',
+                                return_uids=True, max_work=max_work)
+        for target, result in zip(targets, sweep):
+            infected = _uid_mask(graph.uids, result['uids'])
+            uids = limited_infection(graph, target, method='fm')
+            assert(result['num_infected'] == len(uids) ==
+                   len(result['uids']))
+            assert(result['cut'] == evaluate_split(graph, infected)[0] ==
+                   evaluate_split(graph, _uid_mask(graph.uids, uids))[0])
+    assert([result['num_to_infect'] for result in sweep] ==
+           [50, 1000, 2345, 5000])
+    # floats are proportions, like for limited_infection
+    for targets, tol in [([2.5], 0), ([50], 1.5)]:
+        try:
+            infection_sweep(graph, targets, tol)
+            assert(False)
+        except RuntimeError:
+            pass
+    return True
+
+
+def _test_sql_source_example_large(users_example_large):
+    filename = _temp_path('example_large.db')
+    graph = Graph.from_users(users_example_large.values())
+    connection = sqlite3.connect(filename)
+    connection.execute('CREATE TABLE users (user_id INTEGER)')
+    connection.execute('CREATE TABLE relationships (coach_id, student_id)')
+    connection.executemany('INSERT INTO users VALUES (?)',
+                           [(uid,) for uid in graph.uids.tolist()])
+    is_student = (graph.kinds & 1) > 0
+    connection.executemany(
+        'INSERT INTO relationships VALUES (?, ?)',
+        zip(graph.uids[graph.edge_sources()[is_student]].tolist(),
+            graph.uids[graph.indices[is_student]].tolist()))
+    connection.commit()
+    connection.close()
+
+    uri = ('sqlite:///' + os.path.abspath(filename) + '?edges=relationships'
+           '&coach=coach_id&student=student_id&users=users&uid=user_id')
+    for workers in [1, 3]:
+        loaded = load_source(open_source(uri, batch_size=5000,
+                                         workers=workers))
+        for name in ['uids', 'indptr', 'indices', 'kinds']:
+            assert(np.array_equal(getattr(loaded, name),
+                                  getattr(graph, name)))
+    # without the users table, users without relationships are missing
+    loaded = load_source(SQLiteSource(filename, 'relationships', 'coach_id',
+                                      'student_id'))
+    assert(len(loaded) == (graph.degrees() > 0).sum())
+    assert(loaded.num_edges == graph.num_edges)
+    return True
+
+
+def _test_assignment_example_large(users_example_large):
+    filename = _temp_path('assignment.npz')
+    graph = Graph.from_users(users_example_large.values())
+    infected_uids = limited_infection(graph, 0.3)
+    assignment = Assignment.build(graph, infected_uids, 0.3)
+    assert(all(assignment.arm_of(uid) == (uid in infected_uids)
+               for uid in graph.uids.tolist()))
+    assert(assignment.drift() == 0 and not assignment.needs_rerun())
+    labels, comp_arms = assignment.components()
+    assert(len(labels) == len(graph) and labels.max() + 1 == len(comp_arms))
+    assert(SPLIT not in comp_arms.tolist())
+
+    # new users without relationships keep the proportion on target
+    for uid in range(10**6, 10**6 + 100):
+        assignment.add_user(uid)
+    assert(abs(assignment.drift()) < 1e-4)
+    infected = next(iter(infected_uids))
+    uninfected = next(uid for uid in graph.uids.tolist()
+                      if uid not in infected_uids)
+    # new users join the group of most of their coaches and students
+    assert(assignment.add_user('a', coaches=[infected]))
+    assert(not assignment.add_user('b', students=[uninfected, 'a']))
+    assert(assignment.new_cut == 1)
+    assert(assignment.component_of(infected) ==
+           assignment.component_of(uninfected))
+    assert(assignment.arm_of_component(
+        assignment.component_of('b')) == SPLIT)
+    assert(assignment.needs_rerun(max_new_cut=0))
+
+    assignment.save(filename)
+    loaded = Assignment.load(filename)
+    assert(len(loaded) == len(graph) + 102 and loaded.arm_of('a'))
+    assert(loaded.drift() == assignment.drift() and loaded.new_cut == 1)
+    assert(loaded.component_of('a') == loaded.component_of(uninfected))
+    return True
+
+
 def run_tests():
+    global _temp_dir
+    _temp_dir = tempfile.mkdtemp()
+    try:
+        _run_tests()
+    finally:
+        shutil.rmtree(_temp_dir)
+        _temp_dir = None
+
+
+def _run_tests():
     print('Starting tests with 10 users\n')
     if _test_total_infection_example_small():
         print("Total infection small example: PASSED")
     if _test_limited_infection_example_small():
         print("Limited infection small example: PASSED")
+    if _test_graph_example_small():
+        print("Graph small example: PASSED")
+    if _test_components_long_chain():
+        print("Components of a long chain: PASSED")
+    if _test_component_index_example_small():
+        print("Component index small example: PASSED")
+    if _test_load_graph_example_small():
+        print("Load graph small example: PASSED")
+    if _test_graph_file_example_small():
+        print("Binary graph file small example: PASSED")
+    if _test_save_infected_example_small():
+        print("Save infected small example: PASSED")
+    if _test_multilevel_shuffled_chain():
+        print("Multilevel split of a chain: PASSED")
+    if _test_select_components():
+        print("Selecting whole components: PASSED")
+    if _test_multilevel_stars():
+        print("Multilevel split of stars: PASSED")
+    if _test_generate_graph():
+        print("Generated graph: PASSED")
+    if _test_weighted_split():
+        print("Weighted split: PASSED")
+    if _test_multi_start():
+        print("Multi-start split: PASSED")
+    if _test_grow():
+        print("Growing a split: PASSED")
+    if _test_groups():
+        print("Splitting into groups: PASSED")
+    if _test_uid_index():
+        print("Uid index: PASSED")
 
     users_example_large = _create_example_large()
     print('\nStarting tests with 10,000 users\n')
@@ -184,6 +922,35 @@ def run_tests():
         return
     if _test_limited_infection_example_large(users_example_large):
         print("Limited infection large example: PASSED")
+    if _test_split_methods_example_large(users_example_large):
+        print("Split methods large example: PASSED")
+    if _test_incremental_rollout_example_large(users_example_large):
+        print("Incremental rollout large example: PASSED")
+    if _test_workers_example_large(users_example_large):
+        print("Multiple workers large example: PASSED")
+    if _test_profiler_example_large(users_example_large):
+        print("Profiler large example: PASSED")
+    if _test_evaluate_split_example_large(users_example_large):
+        print("Evaluate split large example: PASSED")
+    if _test_component_lookup_example_large(users_example_large):
+        print("Component lookup large example: PASSED")
+    if _test_node_weights_example_large(users_example_large):
+        print("Node weights large example: PASSED")
+    if _test_external_example_large():
+        print("External large example: PASSED")
+    if _test_kernighan_lin_example_large(users_example_large):
+        print("Kernighan-Lin large example: PASSED")
+    if _test_groups_example_large(users_example_large):
+        print("Groups large example: PASSED")
+
+    if _test_sweep_example_large(users_example_large):
+        print("Sweep large example: PASSED")
+
+    if _test_sql_source_example_large(users_example_large):
+        print("SQL source large example: PASSED")
+
+    if _test_assignment_example_large(users_example_large):
+        print("Assignment large example: PASSED")
 
     print('All tests passed')
 
@@ -8,26 +8,44 @@
 class User:
 
     __all_uids = set()
+    # objects told about new users and relationships (see add_listener)
+    __listeners = []
 
-    def __init__(self, uid):
+    def __init__(self, uid, registry=None):
+        '''
+        INPUT:
+            > uid: unique user ID
+            > registry: (optional) set of the uids of the users this one
+                        must be unique among.  By default that's every
+                        user made without a registry, until clear_users is
+                        called; give users which belong to a graph of their
+                        own (e.g. from load_users) a set of their own.'''
+        if registry is None:
+            registry = User._User__all_uids
         # check for duplicate Users
-        if uid in User._User__all_uids:
+        if uid in registry:
             raise RuntimeError("You tried to create more than one user with "
                                "uid:", uid, ". uids must be unique!")
         else:
-            User._User__all_uids.update((uid,))
+            registry.add(uid)
         self._uid = uid
         self._students = set()
         self._coaches = set()
+        for listener in User._User__listeners:
+            listener.user_added(self)
 
     def add_students(self, students):
         '''Add student to this user and register this user as a coach of
         those students'''
         students = _make_iterable(students)
-        self._students |= set(students)
+        new_students = set(students) - self._students
+        self._students |= new_students
         for student in students:
             if self not in student.get_coaches():
                 student.add_coaches(self)
+        for listener in User._User__listeners:
+            for student in new_students:
+                listener.edge_added(self, student)
 
     def add_coaches(self, coaches):
         '''Add coaches to this user and register this user as a student of
@@ -38,6 +56,28 @@ class User:
             if self not in coach.get_students():
                 coach.add_students(self)
 
+    def remove_students(self, students):
+        '''Remove students from this user and unregister this user as a coach
+        of those students'''
+        students = _make_iterable(students)
+        old_students = set(students) & self._students
+        self._students -= old_students
+        for student in students:
+            if self in student.get_coaches():
+                student.remove_coaches(self)
+        for listener in User._User__listeners:
+            for student in old_students:
+                listener.edge_removed(self, student)
+
+    def remove_coaches(self, coaches):
+        '''Remove coaches from this user and unregister this user as a
+        student of those coaches'''
+        coaches = _make_iterable(coaches)
+        self._coaches -= set(coaches)
+        for coach in coaches:
+            if self in coach.get_students():
+                coach.remove_students(self)
+
     def get_students(self):
         return self._students
 
@@ -52,6 +92,19 @@ class User:
         '''clear the user list, in order to create new group of users'''
         User.__all_uids = set()
 
+    @staticmethod
+    def add_listener(listener):
+        '''Tell listener about every new user and relationship from now on.
+
+        listener must have the methods user_added(user),
+        edge_added(coach, student) and edge_removed(coach, student).'''
+        User.__listeners.append(listener)
+
+    @staticmethod
+    def remove_listener(listener):
+        '''stop telling listener about changes'''
+        User.__listeners.remove(listener)
+
 
 def _make_iterable(obj):
     '''If the argument is not iterable, we turn it into a single element